@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+offline benchmark for src/server/dedalus-runner.py
+
+starts a local stand-in for the dedalus api (an openai-compatible
+/chat/completions endpoint that streams scripted tokens and tool calls at a
+fixed rate), points the runner at it with DEDALUS_BASE_URL, and measures:
+
+  cold start    one-shot processes: spawn to ready-for-input is not visible
+                from outside, so spawn to first chunk and spawn to exit
+  serve mode    at each concurrency level: time to first chunk, request
+                latency, per-token overhead over the scripted stream rate,
+                runner-side tool call latency and the runner's rss
+
+no network and no api key needed. the report is json with a fixed shape, so
+two runs can be compared with --baseline:
+
+  python scripts/bench-dedalus-runner.py --out before.json
+  python scripts/bench-dedalus-runner.py --baseline before.json --fail-over 15
+
+validated end to end against dedalus-labs 0.3.0 (the version the default
+--runner-cmd pins) installed into a local directory, with
+
+  PYTHONPATH=<sdk dir> python scripts/bench-dedalus-runner.py \
+      --runner-cmd "python3 src/server/dedalus-runner.py"
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shlex
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+REPO = Path(__file__).resolve().parent.parent
+RUNNER = REPO / "src" / "server" / "dedalus-runner.py"
+DEFAULT_RUNNER_CMD = f"uvx --from dedalus-labs==0.3.0 python {RUNNER}"
+
+
+class FakeModelServer:
+    """openai-compatible chat completions with a scripted reply
+
+    every request is answered with tool_calls until the conversation holds
+    tool_calls tool results (when the request offers tools), then with
+    tokens words of text, first_token_ms after the request and token_rate
+    words per second after that. tool results are counted rather than
+    assistant tool_calls turns because the 0.3.0 sdk's streaming loop only
+    sends the former back.
+    """
+
+    def __init__(
+        self,
+        tokens: int,
+        token_rate: float,
+        first_token_ms: float,
+        tool_calls: int,
+        tool: str,
+        tool_args: Dict[str, Any]
+    ):
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.first_token_ms = first_token_ms
+        self.tool_calls = tool_calls
+        self.tool = tool
+        self.tool_args = tool_args
+        self.requests = 0
+        self.port = 0
+        self.ready = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self) -> str:
+        """run in a thread of its own, so it never competes with the harness"""
+        threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        self.ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._on_connection, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # keep-alive: many requests per connection, as a real client does
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._handle(method, path.split("?")[0], body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        if method == "GET" and path.endswith("/models"):
+            return self._send_json(writer, {"object": "list", "data": [{"id": "bench/fake", "object": "model"}]})
+        if method != "POST" or not path.endswith("/chat/completions"):
+            return self._send_json(writer, {"error": {"message": f"no route for {method} {path}"}}, 404)
+
+        request = json.loads(body or b"{}")
+        self.requests += 1
+        done_calls = sum(1 for message in request.get("messages", []) if message.get("role") == "tool")
+        call = None
+        if request.get("tools") and done_calls < self.tool_calls:
+            call = {
+                "id": f"call_{self.requests}",
+                "type": "function",
+                "function": {"name": self.tool, "arguments": json.dumps(self.tool_args)}
+            }
+
+        model = request.get("model", "bench/fake")
+        if isinstance(model, list):
+            model = model[0]
+        await asyncio.sleep(self.first_token_ms / 1000)
+        if request.get("stream"):
+            await self._stream(writer, model, call)
+        else:
+            await self._complete(writer, model, call)
+
+    def _send_json(self, writer: asyncio.StreamWriter, payload: Dict[str, Any], status: int = 200):
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+            + data
+        )
+
+    async def _complete(self, writer: asyncio.StreamWriter, model: str, call: Optional[Dict[str, Any]]):
+        if call is None and self.token_rate:
+            await asyncio.sleep(self.tokens / self.token_rate)
+        message = {"role": "assistant", "content": None if call else self._text()}
+        if call:
+            message["tool_calls"] = [call]
+        self._send_json(writer, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if call else "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": self.tokens, "total_tokens": self.tokens + 1}
+        })
+        await writer.drain()
+
+    async def _stream(self, writer: asyncio.StreamWriter, model: str, call: Optional[Dict[str, Any]]):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+
+        async def event(delta: Dict[str, Any], finish: Optional[str] = None):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]
+            }
+            data = f"data: {json.dumps(chunk)}\n\n".encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+
+        if call:
+            await event({"role": "assistant", "tool_calls": [{"index": 0, **call}]})
+            await event({}, "tool_calls")
+        else:
+            interval = 1 / self.token_rate if self.token_rate else 0
+            started = time.perf_counter()
+            for i in range(self.tokens):
+                # paced against the start, so sleep overshoot doesn't add up
+                delay = started + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await event({"role": "assistant", "content": f"tok{i} "} if i == 0 else {"content": f"tok{i} "})
+            await event({}, "stop")
+
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        await writer.drain()
+
+    def _text(self) -> str:
+        return "".join(f"tok{i} " for i in range(self.tokens))
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values: List[float], scale: float = 1000) -> Dict[str, Optional[float]]:
+    """p50/p95/mean, in ms by default"""
+    if not values:
+        return {"p50": None, "p95": None, "mean": None}
+    return {
+        "p50": round(percentile(values, 50) * scale, 3),
+        "p95": round(percentile(values, 95) * scale, 3),
+        "mean": round(statistics.fmean(values) * scale, 3)
+    }
+
+
+def tree_rss_kb(pid: int) -> int:
+    """resident set of pid and all its descendants (uvx runs python as a child)"""
+    children: Dict[int, List[int]] = {}
+    rss: Dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss[int(entry)] = int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack += children.get(current, [])
+    return total
+
+
+def request_config(args: argparse.Namespace, **extra: Any) -> Dict[str, Any]:
+    return {
+        "input": "benchmark prompt",
+        "model": "bench/fake",
+        "use_local_tools": args.tool_calls > 0,
+        **extra
+    }
+
+
+async def cold_start(args: argparse.Namespace, env: Dict[str, str]) -> Dict[str, Any]:
+    """one-shot runs, each a fresh process"""
+    first_chunk, total = [], []
+    for _ in range(args.cold_runs):
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *shlex.split(args.runner_cmd),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env
+        )
+        process.stdin.write(json.dumps(request_config(args)).encode())
+        process.stdin.close()
+        seen_chunk = None
+        async for line in process.stdout:
+            event = json.loads(line)
+            if event.get("type") == "chunk" and seen_chunk is None:
+                seen_chunk = time.perf_counter() - started
+            elif event.get("type") == "error":
+                raise RuntimeError(f"runner error: {event.get('error')}")
+        await process.wait()
+        total.append(time.perf_counter() - started)
+        if seen_chunk is not None:
+            first_chunk.append(seen_chunk)
+    return {
+        "runs": args.cold_runs,
+        "spawn_to_first_chunk_ms": summarize(first_chunk),
+        "spawn_to_exit_ms": summarize(total),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+
+
+class ServeClient:
+    """one --serve runner, with requests matched to replies by id"""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.pending: Dict[str, asyncio.Queue] = {}
+        self.ready = asyncio.get_running_loop().create_future()
+        self.reader = asyncio.create_task(self._read())
+        self.next_id = 0
+
+    async def _read(self):
+        async for line in self.process.stdout:
+            event = json.loads(line)
+            if event.get("type") == "ready" and not self.ready.done():
+                self.ready.set_result(None)
+            queue = self.pending.get(event.get("id"))
+            if queue is not None:
+                queue.put_nowait((time.perf_counter(), event))
+
+    async def request(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        """send one request and time its events"""
+        self.next_id += 1
+        request_id = str(self.next_id)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.pending[request_id] = queue
+        started = time.perf_counter()
+        self.process.stdin.write(json.dumps({**config, "id": request_id}).encode() + b"\n")
+        await self.process.stdin.drain()
+
+        result: Dict[str, Any] = {"first_chunk": None, "last_chunk": None, "metrics": None}
+        try:
+            while True:
+                at, event = await queue.get()
+                kind = event.get("type")
+                if kind == "chunk":
+                    result["first_chunk"] = result["first_chunk"] or at - started
+                    result["last_chunk"] = at - started
+                elif kind == "metrics":
+                    result["metrics"] = event
+                elif kind == "complete":
+                    result["latency"] = at - started
+                    return result
+                elif kind == "error":
+                    raise RuntimeError(f"runner error: {event.get('error')}")
+        finally:
+            del self.pending[request_id]
+
+
+async def serve_levels(args: argparse.Namespace, env: Dict[str, str]) -> List[Dict[str, Any]]:
+    """fixed request count per concurrency level on one warm runner"""
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(args.runner_cmd), "--serve",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        env=env
+    )
+    client = ServeClient(process)
+    await asyncio.wait_for(client.ready, timeout=120)
+    # one untimed request so imports and the first connection aren't counted
+    await client.request(request_config(args))
+
+    levels = []
+    try:
+        for concurrency in args.concurrency:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def one():
+                async with semaphore:
+                    return await client.request(request_config(args))
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*(one() for _ in range(args.requests)))
+            elapsed = time.perf_counter() - started
+
+            ttfc = [r["first_chunk"] for r in results if r["first_chunk"] is not None]
+            latency = [r["latency"] for r in results]
+            # streaming time beyond the scripted pace, spread over the tokens
+            scripted = (args.tokens - 1) / args.token_rate if args.token_rate else 0
+            per_token = [
+                max(0.0, (r["last_chunk"] - r["first_chunk"]) - scripted) / args.tokens
+                for r in results if r["first_chunk"] is not None
+            ]
+            tool_calls = []
+            for r in results:
+                for stats in ((r["metrics"] or {}).get("tools") or {}).values():
+                    tool_calls += [stats["total_seconds"] / stats["calls"]] * stats["calls"]
+
+            levels.append({
+                "concurrency": concurrency,
+                "requests": args.requests,
+                "requests_per_second": round(args.requests / elapsed, 2),
+                "time_to_first_chunk_ms": summarize(ttfc),
+                "latency_ms": summarize(latency),
+                "per_token_overhead_us": summarize(per_token, 1e6),
+                "tool_call_ms": summarize(tool_calls),
+                "rss_kb": tree_rss_kb(process.pid)
+            })
+            print(f"concurrency {concurrency}: {levels[-1]['latency_ms']['p50']} ms p50", file=sys.stderr)
+    finally:
+        process.stdin.close()
+        await process.wait()
+        client.reader.cancel()
+    return levels
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], fail_over: Optional[float]) -> bool:
+    """print p50 changes against a baseline; false if any regressed past fail_over %"""
+    ok = True
+
+    def check(label: str, new: Optional[float], old: Optional[float]):
+        nonlocal ok
+        if not new or not old:
+            return
+        change = (new - old) / old * 100
+        flag = ""
+        if fail_over is not None and change > fail_over:
+            ok = False
+            flag = "  REGRESSION"
+        print(f"{label:45} {old:10.3f} -> {new:10.3f} ({change:+.1f}%){flag}")
+
+    for key in ("spawn_to_first_chunk_ms", "spawn_to_exit_ms"):
+        check(f"cold {key} p50", report["cold_start"][key]["p50"], baseline["cold_start"][key]["p50"])
+    old_levels = {level["concurrency"]: level for level in baseline["serve"]}
+    for level in report["serve"]:
+        old = old_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        for key in ("time_to_first_chunk_ms", "latency_ms", "per_token_overhead_us", "tool_call_ms"):
+            check(f"c={level['concurrency']} {key} p50", level[key]["p50"], old[key]["p50"])
+        check(f"c={level['concurrency']} rss_kb", level["rss_kb"], old["rss_kb"])
+    return ok
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runner-cmd", default=DEFAULT_RUNNER_CMD, help="command that starts the runner")
+    parser.add_argument("--tokens", type=int, default=200, help="words in each scripted reply")
+    parser.add_argument("--token-rate", type=float, default=500, help="words per second, 0 for unpaced")
+    parser.add_argument("--first-token-ms", type=float, default=50, help="delay before each reply")
+    parser.add_argument("--tool-calls", type=int, default=1, help="tool calls per request before the reply")
+    parser.add_argument("--tool", default="read_file", help="tool the scripted calls use")
+    parser.add_argument("--tool-args", default=json.dumps({"file_path": str(RUNNER), "limit": 50}))
+    parser.add_argument("--cold-runs", type=int, default=5)
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--out", default="bench-report.json")
+    parser.add_argument("--baseline", help="report to compare against")
+    parser.add_argument("--fail-over", type=float, help="exit 1 if a p50 regresses by more than this %%")
+    args = parser.parse_args()
+
+    fake = FakeModelServer(
+        args.tokens, args.token_rate, args.first_token_ms,
+        args.tool_calls, args.tool, json.loads(args.tool_args)
+    )
+    base_url = fake.start()
+    env = {
+        **os.environ,
+        "DEDALUS_API_KEY": "bench",
+        "DEDALUS_BASE_URL": base_url,
+        # keep the benchmark's history and response caches out of the real ones
+        "XDG_CACHE_HOME": str(Path(os.getenv("TMPDIR", "/tmp")) / "vibeos-bench-cache")
+    }
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": sys.version.split()[0],
+            "runner_cmd": args.runner_cmd,
+            "script": {
+                "tokens": args.tokens,
+                "token_rate": args.token_rate,
+                "first_token_ms": args.first_token_ms,
+                "tool_calls": args.tool_calls,
+                "tool": args.tool
+            }
+        },
+        "cold_start": await cold_start(args, env),
+        "serve": await serve_levels(args, env)
+    }
+    report["meta"]["model_requests"] = fake.requests
+
+    Path(args.out).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"wrote {args.out}", file=sys.stderr)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if not compare(report, baseline, args.fail_over):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
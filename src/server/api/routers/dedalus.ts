@@ -85,6 +85,9 @@ export const dedalusRouter = router({
             stream: true,
             mcp_servers: input.mcpServers,
             use_local_tools: input.useLocalTools,
+            // the runner keeps the history for this session and sends a
+            // token-budgeted window, so only the new message goes over
+            session_id: input.sessionId,
             api_key: DEDALUS_API_KEY,
           };
 
@@ -213,6 +216,7 @@ export const dedalusRouter = router({
           stream: false,
           mcp_servers: input.mcpServers,
           use_local_tools: input.useLocalTools,
+          session_id: input.sessionId,
           api_key: DEDALUS_API_KEY,
         };
         
@@ -2,22 +2,82 @@
 """
 browser-use runner with streaming support
 spawnable from node.js with streaming support
+
+one-shot: a single json config on stdin, runs one task and exits.
+serve:    `browser-use-runner.py --serve [--cdp-url URL]` attaches to chromium
+          once and keeps the browser session and llm clients warm, then runs
+          newline-delimited json task requests ({"id", "task", "model",
+          "cdp_url"}) from stdin one after another. every emitted line carries
+          the "id" of the request it belongs to.
+
+batch:    `browser-use-runner.py --batch FILE|- [--cdp-url URL] [--concurrency N]
+          [--isolate]` runs a jsonl file of tasks concurrently on the same
+          chromium, each in a tab of its own (and with --isolate, or
+          "isolated": true on the task, in its own browser context, so no
+          cookies or storage are shared). events stream as they happen,
+          tagged with the task's "id" (its line number if it has none).
+
+serve also takes {"type": "cancel", "id": ...} requests, which end a task
+with a "cancelled" event, and `--metrics HOST:PORT` (or a socket path) to
+expose prometheus metrics. every task emits a "step" event as each agent
+step finishes, a "metrics" event (see runner_metrics.py) just before its
+last event, and ends with a complete event carrying the structured run
+history.
+
+a task config may also carry "page_state" options that shrink what each step
+sends the model (see PAGE_STATE_OPTIONS); with any of the shrinking ones
+set, step events report the request bytes and estimated tokens before and
+after.
+
+with "replay": true, the action trace of a successful task is recorded under
+its normalized task and start url (see TraceStore), and later runs of the
+same task replay it without the model, handing over to the agent from the
+first step whose page doesn't match; the complete event reports the replay.
+secrets belong in "sensitive_data" (browser-use's {name: value}, or
+{domain: {name: value}}): the model only sees <secret>name</secret>, traces
+store that placeholder instead of the value, and a replay types the value
+from its own config.
+
+a task config may name a "block" profile, see BLOCK_PROFILES, to fail the
+requests the agent doesn't need (images, fonts, ads...) before they are sent.
+
+every mode takes --framed to swap jsonl for the length-prefixed frames
+described in runner_protocol.py; batch only for its output, the task file
+stays jsonl.
 """
 
 import asyncio
+import base64
+import binascii
+import contextlib
+import hashlib
+import io
 import json
+import math
 import os
+import re
+import signal
+import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
 
-# Set UTF-8 encoding for Windows
+# Set UTF-8 encoding for Windows (events already go to stdout.buffer as utf-8)
 if sys.platform == "win32":
     import codecs
-    sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
     sys.stderr = codecs.getwriter("utf-8")(sys.stderr.detach())
 
+# sdk import time is reported as a metric
+_import_started = time.perf_counter()
+
 try:
     from browser_use import Agent, BrowserSession
+    from browser_use.agent.views import AgentHistoryList
     from browser_use.llm import ChatAnthropic, ChatOpenAI
+    # a dependency of browser-use itself
+    from PIL import Image
 except ImportError as e:
     print(json.dumps({
         "type": "error",
@@ -25,55 +85,1172 @@ except ImportError as e:
     }), flush=True)
     sys.exit(1)
 
+_import_seconds = time.perf_counter() - _import_started
+
+import runner_metrics
+import runner_protocol
+
+# replaced by a FramedWriter under --framed
+_stdout = runner_protocol.JsonlWriter(sys.stdout.buffer)
+
+METRICS = runner_metrics.Registry("vibeos_browser_use")
+runner_metrics.record_startup(METRICS, _import_seconds)
+
+
+def emit(event: dict, request_id=None):
+    """write one event, tagged with a request id in serve mode"""
+    if request_id is not None:
+        event = {"id": request_id, **event}
+    _stdout.write_event(event)
+
+
+def _dump(value):
+    """json-safe form of a browser-use (pydantic) object"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_unset=True, exclude_none=True, mode="json")
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _call(obj, name: str, default=None):
+    """obj.name(), or default if it's missing or fails
+
+    browser-use's history api shifts between releases, so every read of it
+    is best effort rather than a reason to lose the task's result.
+    """
+    try:
+        return getattr(obj, name)()
+    except Exception:
+        return default
+
+
+def _usage_entries(agent) -> list:
+    """the agent's per-llm-call token usage so far"""
+    service = getattr(agent, "token_cost_service", None)
+    return getattr(service, "usage_history", None) or []
+
+
+def step_event(agent, seconds: float, usage_seen: int = 0) -> dict:
+    """the step that just finished, from the agent's history
+
+    token counts cover the llm calls after the first usage_seen ones.
+    """
+    event = {"type": "step", "duration_seconds": round(seconds, 3)}
+    state = getattr(agent, "state", None)
+    event["step"] = getattr(state, "n_steps", None)
+
+    items = getattr(getattr(agent, "history", None), "history", None) or []
+    if not items:
+        return event
+    last = items[-1]
+
+    model_output = getattr(last, "model_output", None)
+    if model_output is not None:
+        event["actions"] = [_dump(action) for action in getattr(model_output, "action", None) or []]
+        for field in ("next_goal", "evaluation_previous_goal", "memory"):
+            if getattr(model_output, field, None):
+                event[field] = getattr(model_output, field)
+
+    event["results"] = [
+        {
+            key: getattr(result, key)
+            for key in ("extracted_content", "error", "is_done", "success")
+            if getattr(result, key, None) is not None
+        }
+        for result in getattr(last, "result", None) or []
+    ]
+
+    browser_state = getattr(last, "state", None)
+    if browser_state is not None:
+        event["url"] = getattr(browser_state, "url", None)
+        event["title"] = getattr(browser_state, "title", None)
+
+    metadata = getattr(last, "metadata", None)
+    if metadata is not None:
+        event["step"] = getattr(metadata, "step_number", None) or event["step"]
+
+    usages = [getattr(entry, "usage", None) for entry in _usage_entries(agent)[usage_seen:]]
+    usages = [usage for usage in usages if usage is not None]
+    if usages:
+        event["llm_calls"] = len(usages)
+        event["input_tokens"] = sum(getattr(usage, "prompt_tokens", 0) or 0 for usage in usages)
+        event["cached_input_tokens"] = sum(getattr(usage, "prompt_cached_tokens", 0) or 0 for usage in usages)
+        event["output_tokens"] = sum(getattr(usage, "completion_tokens", 0) or 0 for usage in usages)
+    return event
+
+
+def history_summary(history) -> dict:
+    """structured form of the AgentHistoryList a run returns"""
+    items = getattr(history, "history", None)
+    if items is None:
+        # not a history object (an older or stubbed browser-use)
+        return {"final_result": str(history)}
+
+    summary = {
+        "final_result": _call(history, "final_result"),
+        "is_done": _call(history, "is_done"),
+        "is_successful": _call(history, "is_successful"),
+        "steps": len(items),
+        "duration_seconds": _call(history, "total_duration_seconds"),
+        "urls": [url for url in _call(history, "urls", []) if url],
+        "actions": _call(history, "action_names", []),
+        "errors": [error for error in _call(history, "errors", []) if error],
+    }
+    usage = getattr(history, "usage", None)
+    if usage is not None:
+        summary["usage"] = _dump(usage)
+    return summary
+
+
+def complete_event(result, replay=None) -> dict:
+    """the final event of a task: its result text plus the structured history"""
+    history = history_summary(result)
+    event = {
+        "type": "complete",
+        "content": history["final_result"] if history.get("final_result") is not None else str(result),
+        "history": history,
+        "status": "success"
+    }
+    if replay is not None:
+        event["replay"] = replay
+    return event
+
+
+# resource types and url patterns each "block" profile fails. stylesheets
+# and scripts are never blocked: the agent reads layout and visibility.
+_MEDIA = ("Image", "Media", "Font")
+_TRACKERS = tuple(
+    f"*{domain}/*" for domain in (
+        "doubleclick.net", "googlesyndication.com", "google-analytics.com",
+        "googletagmanager.com", "googleadservices.com", "adservice.google.com",
+        "facebook.net", "connect.facebook.com", "hotjar.com", "segment.io",
+        "segment.com", "mixpanel.com", "amplitude.com", "scorecardresearch.com",
+        "adnxs.com", "taboola.com", "outbrain.com", "criteo.com",
+    )
+)
+BLOCK_PROFILES = {
+    "none": ((), ()),
+    "no-media": (_MEDIA, ()),
+    "minimal": (_MEDIA + ("TextTrack", "Ping", "Prefetch", "Manifest", "CSPViolationReport"), _TRACKERS),
+}
+
+
+class ResourceBlocker:
+    """fails the requests of a blocking profile through cdp Fetch interception
+
+    only requests matching the profile's patterns are paused, and every
+    paused one is failed, so allowed requests never round-trip through here.
+    interception is per tab: cover() is called before the task and before
+    each step so tabs the agent opens mid-task are covered from their next
+    step on.
+
+    cdp_use keeps one handler per event, and with proxy credentials
+    browser-use has its own Fetch.requestPaused handler for auth; requests
+    paused on tabs this blocker doesn't cover go on to that handler, and
+    covered tabs keep handling auth challenges.
+    """
+
+    def __init__(self, profile: str, browser_session, metrics: runner_metrics.RunMetrics):
+        if profile not in BLOCK_PROFILES:
+            raise ValueError(f"unknown block profile {profile!r}, expected one of {', '.join(BLOCK_PROFILES)}")
+        resource_types, url_patterns = BLOCK_PROFILES[profile]
+        self.patterns = (
+            [{"resourceType": kind, "requestStage": "Request"} for kind in resource_types]
+            + [{"urlPattern": pattern, "requestStage": "Request"} for pattern in url_patterns]
+        )
+        self.browser_session = browser_session
+        self.metrics = metrics
+        self.sessions = set()
+        self.active = True
+        proxy = getattr(getattr(browser_session, "browser_profile", None), "proxy", None)
+        self.proxy_auth = bool(proxy and proxy.username and proxy.password)
+        self.registered = False
+        # the handler this one replaced, if any
+        self.chained = None
+
+    async def cover(self):
+        """enable interception on the tab the agent is focused on"""
+        if not self.patterns:
+            return
+        get_session = getattr(self.browser_session, "get_or_create_cdp_session", None)
+        if get_session is None:
+            raise RuntimeError("this browser-use version doesn't expose its cdp sessions to block requests on")
+        # the focused tab's session, without moving the focus
+        session_id = (await get_session(focus=False)).session_id
+        cdp = self.browser_session.cdp_client
+        if not self.registered:
+            self.chained = _event_handler(cdp, "Fetch.requestPaused")
+            cdp.register.Fetch.requestPaused(self.on_paused)
+            self.registered = True
+        if session_id not in self.sessions:
+            params = {"patterns": self.patterns}
+            if self.proxy_auth:
+                # Fetch.enable replaces the session's settings, keep browser-use's
+                params["handleAuthRequests"] = True
+            # added first, its requests may pause before the reply comes
+            self.sessions.add(session_id)
+            try:
+                await cdp.send.Fetch.enable(params=params, session_id=session_id)
+            except BaseException:
+                self.sessions.discard(session_id)
+                raise
+
+    def on_paused(self, event: dict, session_id=None):
+        if session_id not in self.sessions and self.chained is not None:
+            # paused by someone else's interception
+            return self.chained(event, session_id)
+        request_id = event["requestId"]
+        if self.active:
+            self.metrics.block(event.get("resourceType") or "Other")
+            reply = self.browser_session.cdp_client.send.Fetch.failRequest(
+                params={"requestId": request_id, "errorReason": "BlockedByClient"}, session_id=session_id
+            )
+        else:
+            # paused just before release()
+            reply = self.browser_session.cdp_client.send.Fetch.continueRequest(
+                params={"requestId": request_id}, session_id=session_id
+            )
+        asyncio.ensure_future(reply).add_done_callback(_ignore_result)
+
+    async def release(self):
+        """stop intercepting, so a warm session's next task starts clean"""
+        self.active = False
+        cdp = self.browser_session.cdp_client
+        for session_id in self.sessions:
+            with contextlib.suppress(Exception):
+                # the tab may be gone already
+                if self.proxy_auth:
+                    await cdp.send.Fetch.enable(params={"handleAuthRequests": True}, session_id=session_id)
+                else:
+                    await cdp.send.Fetch.disable(session_id=session_id)
+        self.sessions.clear()
+        if self.chained is not None:
+            cdp.register.Fetch.requestPaused(self.chained)
+
+
+def _event_handler(cdp, method: str):
+    """the handler cdp_use has registered for an event, or None
+
+    cdp_use only exposes registering, so this reads its registry.
+    """
+    registry = getattr(cdp, "_event_registry", None)
+    return getattr(registry, "_handlers", {}).get(method)
+
+
+def _ignore_result(future: asyncio.Future):
+    """retrieve a fire-and-forget cdp reply's error, a closed tab is expected"""
+    if not future.cancelled():
+        future.exception()
+
+
+# "page_state" options: the first four are browser-use's own agent settings,
+# the rest are applied by PageStateShrinker to every request
+PAGE_STATE_OPTIONS = {
+    "screenshot_size": "llm_screenshot_size",  # [width, height] the model sees
+    "detail": "vision_detail_level",  # "low", "high" or "auto"
+    "vision": "use_vision",  # false sends no screenshots at all
+    "max_dom_chars": "max_clickable_elements_length",
+    "image_format": None,  # "jpeg", "webp" or "png"
+    "quality": None,  # 1-100, for jpeg and webp
+    "grayscale": None,
+    "max_elements": None,  # interactive elements listed per step
+}
+
+# an element line of browser-use's dom listing, e.g. "\t*[12]<button ..."
+_ELEMENT_LINE = re.compile(r"^\t*[^\[\n]{0,8}\[\d+\]<", re.MULTILINE)
+
+
+def agent_options(page_state: dict) -> dict:
+    """Agent keyword arguments for the page_state options browser-use applies itself"""
+    unknown = set(page_state) - set(PAGE_STATE_OPTIONS)
+    if unknown:
+        raise ValueError(f"unknown page_state options {sorted(unknown)}, expected {', '.join(PAGE_STATE_OPTIONS)}")
+    options = {
+        PAGE_STATE_OPTIONS[key]: value
+        for key, value in page_state.items()
+        if PAGE_STATE_OPTIONS[key] is not None
+    }
+    if "llm_screenshot_size" in options:
+        options["llm_screenshot_size"] = tuple(options["llm_screenshot_size"])
+    return options
+
+
+def _image_tokens(width: int, height: int, provider: str, detail: str) -> int:
+    """estimated input tokens of one image, by the provider's published sizing"""
+    if provider == "openai":
+        if detail == "low":
+            return 85
+        # fit in 2048x2048, shortest side down to 768, then 170 per 512px tile
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+    # anthropic, and a fair guess elsewhere: about one token per 750 pixels
+    return math.ceil(width * height / 750)
+
+
+class TaskLlm:
+    """llm client of one task, passing every request to a worker's shared client
+
+    browser-use's agents patch their usage tracking onto the llm they're
+    given; a fresh object per task keeps that off the shared clients.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    def __getattr__(self, name: str):
+        # everything but ainvoke is the wrapped client's (model, provider, ...)
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    async def ainvoke(self, messages, output_format=None, **kwargs):
+        return await self.llm.ainvoke(messages, output_format, **kwargs)
+
+
+class PageStateShrinker(TaskLlm):
+    """llm client of one task that shrinks each request's page state before it's sent
+
+    screenshots are re-encoded (image_format, quality, grayscale; never
+    resized, browser-use maps click coordinates onto the size it chose) and
+    the interactive element listing is cut after max_elements. every request
+    is measured before and after; take_stats() returns the totals since the
+    last call, for the step event.
+    """
+
+    def __init__(self, llm, page_state: dict):
+        super().__init__(llm)
+        self.image_format = page_state.get("image_format")
+        if self.image_format not in (None, "jpeg", "webp", "png"):
+            raise ValueError(f"unsupported image_format {self.image_format!r}")
+        self.quality = int(page_state.get("quality", 75))
+        self.grayscale = bool(page_state.get("grayscale"))
+        self.max_elements = page_state.get("max_elements")
+        if ("quality" in page_state or self.grayscale) and self.image_format is None:
+            # quality and grayscale need a re-encode; jpeg is the smallest safe one
+            self.image_format = "jpeg"
+        self.detail = page_state.get("detail", "auto")
+        # the same screenshot is resent as the "previous" one on the next step
+        self.images = {}
+        self.calls = []
+
+    @staticmethod
+    def wanted(page_state: dict) -> bool:
+        """whether page_state sets any option the shrinker applies"""
+        return any(PAGE_STATE_OPTIONS[key] is None for key in page_state)
+
+    async def ainvoke(self, messages, output_format=None, **kwargs):
+        before = after = self.measure(messages)
+        if self.image_format is not None or self.max_elements is not None:
+            messages = [self.shrink(message) for message in messages]
+            after = self.measure(messages)
+        self.calls.append((before, after))
+        return await self.llm.ainvoke(messages, output_format, **kwargs)
+
+    def take_stats(self):
+        """request sizes since the last call, or None without requests"""
+        calls, self.calls = self.calls, []
+        if not calls:
+            return None
+        stats = {"llm_calls": len(calls)}
+        for side, index in (("before", 0), ("after", 1)):
+            stats[f"bytes_{side}"] = sum(call[index][0] for call in calls)
+            stats[f"tokens_{side}"] = sum(call[index][1] for call in calls)
+        stats["images"] = calls[-1][1][2]
+        return stats
+
+    def measure(self, messages) -> tuple:
+        """(bytes, estimated tokens, images) of a request's messages"""
+        size = tokens = images = 0
+        provider = str(getattr(self.llm, "provider", ""))
+        for message in messages:
+            content = getattr(message, "content", None)
+            for part in [content] if isinstance(content, str) else content or []:
+                text = part if isinstance(part, str) else getattr(part, "text", None)
+                if text is not None:
+                    length = len(text.encode("utf-8"))
+                    size += length
+                    tokens += length // 4
+                    continue
+                image_url = getattr(part, "image_url", None)
+                if image_url is None:
+                    continue
+                size += len(image_url.url)
+                images += 1
+                dimensions = _image_size(image_url.url)
+                if dimensions is not None:
+                    tokens += _image_tokens(*dimensions, provider, getattr(image_url, "detail", self.detail))
+        return size, tokens, images
+
+    def shrink(self, message):
+        """a user message with its screenshots re-encoded and element listing capped"""
+        content = getattr(message, "content", None)
+        if getattr(message, "role", None) != "user" or content is None:
+            return message
+        if isinstance(content, str):
+            capped = self.cap_elements(content)
+            return message if capped is content else message.model_copy(update={"content": capped})
+
+        parts = []
+        for part in content:
+            if getattr(part, "text", None) is not None and self.max_elements is not None:
+                capped = self.cap_elements(part.text)
+                part = part if capped is part.text else part.model_copy(update={"text": capped})
+            elif getattr(part, "image_url", None) is not None and self.image_format is not None:
+                part = self.reencode(part)
+            parts.append(part)
+        return message.model_copy(update={"content": parts})
+
+    def cap_elements(self, text: str) -> str:
+        """text with the dom listing cut after max_elements element lines"""
+        if self.max_elements is None or "</browser_state>" not in text:
+            return text
+        lines = list(_ELEMENT_LINE.finditer(text))
+        if len(lines) <= self.max_elements:
+            return text
+        cut = lines[self.max_elements].start()
+        end = text.find("</browser_state>", cut)
+        dropped = len(lines) - self.max_elements
+        return (
+            text[:cut]
+            + f"[{dropped} more elements not listed]\n"
+            + text[end:]
+        )
+
+    def reencode(self, part):
+        """an image part in image_format, kept as is when that isn't smaller"""
+        url = part.image_url.url
+        if url in self.images:
+            return self.images[url]
+        shrunk = part
+        with contextlib.suppress(ValueError, OSError, binascii.Error):
+            header, data = url.split(",", 1)
+            image = Image.open(io.BytesIO(base64.b64decode(data)))
+            if self.grayscale:
+                image = image.convert("L")
+            elif self.image_format == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.image_format.upper(), quality=self.quality, optimize=True)
+            encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+            media_type = f"image/{self.image_format}"
+            if len(encoded) < len(data):
+                shrunk = part.model_copy(update={"image_url": part.image_url.model_copy(update={
+                    "url": f"data:{media_type};base64,{encoded}",
+                    "media_type": media_type,
+                })})
+        if len(self.images) >= 4:
+            self.images.pop(next(iter(self.images)))
+        self.images[url] = shrunk
+        return shrunk
+
+
+def _image_size(url: str):
+    """(width, height) of a base64 data url image, None if it isn't one"""
+    if not url.startswith("data:"):
+        return None
+    try:
+        # Image.open only parses the header
+        return Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))).size
+    except (ValueError, OSError, binascii.Error, IndexError):
+        return None
+
+
+async def run_agent(agent, metrics: runner_metrics.RunMetrics, request_id=None, blocker=None):
+    """run an agent, emitting a step event as each of its steps finishes
+
+    blocker, a ResourceBlocker, covers each tab the agent steps on.
+    """
+    step_started = None
+    usage_seen = 0
+
+    shrinker = getattr(agent, "llm", None)
+    if not isinstance(shrinker, PageStateShrinker):
+        shrinker = None
+
+    async def on_step_start(agent):
+        nonlocal step_started, usage_seen
+        usage_seen = len(_usage_entries(agent))
+        if shrinker is not None:
+            # requests outside any step (e.g. the initial planning) aren't one's
+            shrinker.take_stats()
+        if blocker is not None:
+            await blocker.cover()
+        step_started = time.perf_counter()
+
+    async def on_step_end(agent):
+        if step_started is None:
+            return
+        seconds = time.perf_counter() - step_started
+        metrics.step(seconds)
+        try:
+            event = step_event(agent, seconds, usage_seen)
+        except Exception as e:
+            # a progress event is never worth failing the task over
+            event = {"type": "step", "duration_seconds": round(seconds, 3), "note": str(e)}
+        if shrinker is not None:
+            payload = shrinker.take_stats()
+            if payload is not None:
+                event["payload"] = payload
+        emit(event, request_id)
+
+    try:
+        return await agent.run(on_step_start=on_step_start, on_step_end=on_step_end)
+    except asyncio.CancelledError:
+        await close_agent(agent)
+        raise
+
+
+class TraceStore:
+    """action traces of successful runs in sqlite, for replaying repeated tasks
+
+    keyed on a hash of the whitespace- and case-normalized task and the url
+    the task started on. a trace is the run's AgentHistoryList as json, which
+    keeps each action's target element (hashes, xpath, accessible name) so
+    browser-use can find it again on the live page. typed sensitive_data
+    values are stored as their <secret> placeholders.
+    """
+
+    _shared = None
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "vibeos"
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            path = str(cache_dir / "browser-traces.sqlite")
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS traces ("
+            "key TEXT PRIMARY KEY, task TEXT, start_url TEXT, history TEXT, steps INTEGER, "
+            "created REAL, used REAL, hits INTEGER)"
+        )
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls) -> "TraceStore":
+        """shared store, kept open for the life of the process"""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @staticmethod
+    def key(task: str, start_url: str) -> str:
+        material = json.dumps([" ".join(task.lower().split()), _normalize_url(start_url)])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """the recorded history dict, or None"""
+        with self.lock:
+            row = self.db.execute("SELECT history FROM traces WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, task: str, start_url: str, history: dict):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO traces VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, task, start_url, json.dumps(history), len(history["history"]), now, now)
+            )
+            self.db.commit()
+
+    def hit(self, key: str):
+        with self.lock:
+            self.db.execute("UPDATE traces SET used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+
+def _normalize_url(url: str) -> str:
+    """host and path of a url, without query, fragment or trailing slash"""
+    parts = urllib.parse.urlsplit(url or "")
+    return f"{parts.netloc.lower()}{parts.path.rstrip('/')}" or (url or "")
+
+
+def page_fingerprint(url: str, title: str) -> str:
+    """cheap identity of a page: its normalized url and title, digits masked
+
+    masking digits lets dated or numbered pages (/reports/2026-10-17,
+    "Inbox (3)") match from one run to the next.
+    """
+    return re.sub(r"\d+", "#", f"{_normalize_url(url)}|{' '.join((title or '').lower().split())}")
+
+
+# how long a replayed step waits for the page to become the recorded one
+_SETTLE_SECONDS = 10.0
+
+
+async def replay_trace(agent, trace, metrics: runner_metrics.RunMetrics, request_id=None, blocker=None):
+    """replay a trace's steps, all but the final one, on the agent's browser
+
+    returns (steps replayed, why it stopped early or None). before each step
+    the live page must reach the recorded step's fingerprint; each action's
+    element is then re-found by browser-use, and a step whose element is gone
+    or whose action fails ends the replay there. the final step, the done
+    action and its answer, is always left to the model so the answer is
+    about today's page.
+    """
+    session = agent.browser_session
+    execute = getattr(agent, "_execute_history_step", None)
+    if execute is None:
+        return 0, "this browser-use version can't replay steps"
+
+    steps = trace.history[:-1]
+    for index, item in enumerate(steps):
+        started = time.perf_counter()
+        if blocker is not None:
+            await blocker.cover()
+
+        # step 0 is the navigation to a url in the task, which browser-use
+        # runs before the first model step and records with the page it
+        # opens; the live tab hasn't gone there yet
+        if getattr(item.metadata, "step_number", None) != 0:
+            recorded = page_fingerprint(item.state.url, item.state.title)
+            deadline = time.monotonic() + _SETTLE_SECONDS
+            while True:
+                live = page_fingerprint(await session.get_current_page_url(), await session.get_current_page_title())
+                if live == recorded or time.monotonic() > deadline:
+                    break
+                # the previous step's navigation may still be loading
+                await asyncio.sleep(0.25)
+            if live != recorded:
+                return index, f"step {index + 1}: page is {live!r}, recorded {recorded!r}"
+
+        actions = getattr(item.model_output, "action", None) or []
+        if any(result.error for result in item.result):
+            # a step that failed when recorded; its retry is the next step
+            continue
+        missing = _missing_secrets(actions, getattr(agent, "sensitive_data", None))
+        if missing:
+            return index, f"step {index + 1}: no sensitive_data value for {', '.join(missing)}"
+        if actions:
+            try:
+                results = await execute(item, 0.0)
+            except Exception as e:
+                return index, f"step {index + 1}: {e}"
+            errors = [result.error for result in results if result.error]
+            if errors:
+                return index, f"step {index + 1}: {errors[0]}"
+
+        seconds = time.perf_counter() - started
+        metrics.step(seconds)
+        emit({
+            "type": "step",
+            "replayed": True,
+            "step": index + 1,
+            "duration_seconds": round(seconds, 3),
+            "actions": [_dump(action) for action in actions],
+            "url": item.state.url,
+            "title": item.state.title,
+        }, request_id)
+    return len(steps), None
+
+
+_SECRET = re.compile(r"<secret>(.*?)</secret>")
+
+
+def _missing_secrets(actions, sensitive_data) -> list:
+    """placeholders in recorded actions that sensitive_data has no value for
+
+    browser-use would type such a placeholder literally.
+    """
+    known = set()
+    for name, value in (sensitive_data or {}).items():
+        # {domain: {name: value}} or the legacy {name: value}
+        known.update(value if isinstance(value, dict) else (name,))
+    used = _SECRET.findall(json.dumps([_dump(action) for action in actions]))
+    return sorted(set(used) - known)
+
+
+def _continued_task(task: str, steps) -> str:
+    """the task for the agent taking over after steps were replayed"""
+    done = []
+    for number, item in enumerate(steps, 1):
+        goal = getattr(item.model_output, "next_goal", None) if item.model_output else None
+        done.append(f"{number}. {goal or 'step replayed'} (page: {item.state.url})")
+    return (
+        f"{task}\n\nthe first steps of this task were already carried out in this browser, "
+        "continue from the current page:\n" + "\n".join(done)
+    )
+
+
+async def run_browser_task(config: dict, browser_session, llm, metrics: runner_metrics.RunMetrics, request_id=None):
+    """run one task config on browser_session, returns (history, replay summary or None)
+
+    applies the task's "page_state" and "block" options, and with "replay"
+    replays a recorded trace before handing over to the agent.
+    """
+    page_state = config.get("page_state") or {}
+    options = agent_options(page_state)
+    # measuring and re-encoding every request only pays off when something is shrunk
+    shrink = PageStateShrinker.wanted(page_state)
+    block = config.get("block")
+    blocker = ResourceBlocker(block, browser_session, metrics) if block and block != "none" else None
+    sensitive_data = config.get("sensitive_data") or None
+
+    def new_agent(task: str, **extra):
+        return Agent(
+            task=task,
+            browser_session=browser_session,
+            llm=PageStateShrinker(llm, page_state) if shrink else TaskLlm(llm),
+            sensitive_data=sensitive_data,
+            **options,
+            **extra,
+        )
+
+    try:
+        if blocker is not None:
+            # a url in the task is opened before the first step
+            await browser_session.start()
+            await blocker.cover()
+
+        if not config.get("replay"):
+            return await run_agent(new_agent(config["task"]), metrics, request_id, blocker), None
+
+        store = TraceStore.open()
+        await browser_session.start()
+        start_url = await browser_session.get_current_page_url()
+        key = TraceStore.key(config["task"], start_url)
+        recorded = store.get(key)
+
+        agent = new_agent(config["task"])
+        replayed, reason, steps = 0, None, []
+        if recorded is not None:
+            trace = AgentHistoryList.load_from_dict(recorded, agent.AgentOutput)
+            replayed, reason = await replay_trace(agent, trace, metrics, request_id, blocker)
+            steps = trace.history[:replayed]
+            if replayed:
+                # a url in the task would otherwise be opened again first
+                agent = new_agent(_continued_task(config["task"], steps), directly_open_url=False)
+
+        result = await run_agent(agent, metrics, request_id, blocker)
+        replay = {
+            "hit": recorded is not None and reason is None,
+            "steps_replayed": replayed,
+            "steps_recorded": len(recorded["history"]) if recorded is not None else 0,
+        }
+        if reason is not None:
+            replay["diverged"] = reason
+
+        if replay["hit"]:
+            store.hit(key)
+        elif _call(result, "is_successful"):
+            # the replayed prefix plus what the agent did from there, with
+            # typed secrets back to placeholders
+            history = result.model_dump(sensitive_data=sensitive_data)
+            history["history"] = [step.model_dump(sensitive_data=sensitive_data) for step in steps] + history["history"]
+            store.put(key, config["task"], start_url, history)
+        return result, replay
+    finally:
+        if blocker is not None:
+            await blocker.release()
+
+
+async def close_agent(agent):
+    """stop a cancelled agent and release what it holds
+
+    with a keep_alive session (serve mode) the browser stays up for the next
+    task; in one-shot mode this also closes the session.
+    """
+    with contextlib.suppress(Exception):
+        stop = getattr(agent, "stop", None)
+        if stop is not None:
+            stop()
+    with contextlib.suppress(Exception):
+        close = getattr(agent, "close", None)
+        if close is not None:
+            await close()
+
+
+def create_llm(model: str):
+    """pick the llm client for a model name"""
+    # Previously no llm was passed at all, so browser-use silently fell back to
+    # its OpenAI default and the `model` sent by the caller was ignored.
+    if model.startswith("claude"):
+        return ChatAnthropic(model=model, api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    return ChatOpenAI(model=model, api_key=os.environ.get("OPENAI_API_KEY"))
+
+
+class BrowserWorker:
+    """long-lived browser session and llm clients shared by many tasks"""
+
+    def __init__(self, cdp_url=None, llms=None):
+        self.cdp_url = cdp_url
+        self.browser_session = None
+        # batch workers share their llm clients
+        self.llms = llms if llms is not None else {}
+
+    async def attach(self, cdp_url: str):
+        """attach to chromium at cdp_url, reusing the session when unchanged"""
+        if self.browser_session is not None and cdp_url == self.cdp_url:
+            return self.browser_session
+
+        await self.close()
+        # keep_alive stops Agent.run() from tearing the session down at the
+        # end of each task, which is the whole point of the worker
+        self.browser_session = BrowserSession(cdp_url=cdp_url, keep_alive=True)
+        await self.browser_session.start()
+        self.cdp_url = cdp_url
+        return self.browser_session
+
+    def llm_for(self, model: str):
+        """cached llm client per model"""
+        if model not in self.llms:
+            self.llms[model] = create_llm(model)
+        return self.llms[model]
+
+    async def open_tab(self, isolated: bool) -> dict:
+        """point the session at a fresh tab, in a new browser context if isolated"""
+        cdp = getattr(self.browser_session, "cdp_client", None)
+        if cdp is None:
+            raise RuntimeError("this browser-use version can't open tabs over cdp")
+        from browser_use.browser.events import SwitchTabEvent
+
+        tab = {}
+        params = {"url": "about:blank"}
+        if isolated:
+            context = await cdp.send.Target.createBrowserContext(params={"disposeOnDetach": True})
+            tab["browserContextId"] = params["browserContextId"] = context["browserContextId"]
+        try:
+            target = await cdp.send.Target.createTarget(params=params)
+            tab["targetId"] = target["targetId"]
+            await self.browser_session.event_bus.dispatch(SwitchTabEvent(target_id=target["targetId"]))
+        except BaseException:
+            await self.close_tab(tab)
+            raise
+        return tab
+
+    async def close_tab(self, tab: dict):
+        """close a tab from open_tab, and its browser context"""
+        cdp = self.browser_session.cdp_client
+        if "targetId" in tab:
+            with contextlib.suppress(Exception):
+                await cdp.send.Target.closeTarget(params={"targetId": tab["targetId"]})
+        if "browserContextId" in tab:
+            with contextlib.suppress(Exception):
+                await cdp.send.Target.disposeBrowserContext(
+                    params={"browserContextId": tab["browserContextId"]}
+                )
+
+    async def run_task(self, config: dict, metrics: runner_metrics.RunMetrics, request_id=None, own_tab=False):
+        """run one task on the warm session, in a tab of its own if own_tab
+
+        request_id tags the task's step events, and should be the id the
+        caller tags its other events with. returns what run_browser_task does.
+        """
+        cdp_url = config.get("cdp_url") or self.cdp_url
+        if not cdp_url:
+            raise ValueError("cdp_url required")
+
+        browser_session = await self.attach(cdp_url)
+        model = config.get("model") or "claude-sonnet-5"
+        tab = await self.open_tab(bool(config.get("isolated"))) if own_tab else None
+
+        try:
+            return await run_browser_task(config, browser_session, self.llm_for(model), metrics, request_id)
+        finally:
+            if tab is not None:
+                await self.close_tab(tab)
+
+    async def close(self):
+        """detach from chromium"""
+        if self.browser_session is None:
+            return
+        try:
+            await self.browser_session.stop()
+        except Exception:
+            # the browser may already be gone (chromium-supervise restarts it)
+            pass
+        self.browser_session = None
+
+
+async def serve(cdp_url=None, framed=False, metrics_address=None):
+    """run task requests from stdin on one warm worker until eof
+
+    tasks run one at a time in arrival order. {"type": "cancel", "id": ...}
+    stops the running task, or drops a queued one, with a "cancelled" event.
+    """
+    loop = asyncio.get_running_loop()
+    worker = BrowserWorker(cdp_url)
+    if metrics_address is not None:
+        # listens until the process exits
+        await runner_metrics.serve_metrics(METRICS, metrics_address)
+
+    messages = asyncio.Queue()
+
+    def read_forever():
+        while True:
+            message = runner_protocol.read_message(sys.stdin.buffer, framed)
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+            if message is None:
+                return
+
+    # a daemon thread rather than run_in_executor, so stdin is read while a
+    # task runs (cancel requests) and a blocked read can't outlive SIGTERM
+    threading.Thread(target=read_forever, daemon=True).start()
+
+    tasks = asyncio.Queue()
+    cancelled = set()
+    current = {}
+
+    async def run_tasks():
+        while True:
+            config = await tasks.get()
+            if config is None:
+                return
+            request_id = str(config.get("id", ""))
+            if request_id in cancelled:
+                cancelled.discard(request_id)
+                emit({"type": "cancelled"}, request_id)
+                continue
+
+            metrics = runner_metrics.RunMetrics(METRICS)
+            run = asyncio.create_task(worker.run_task(config, metrics, request_id))
+            current[request_id] = run
+            try:
+                await asyncio.wait([run])
+            except asyncio.CancelledError:
+                run.cancel()
+                await asyncio.wait([run])
+                raise
+            finally:
+                current.pop(request_id, None)
+
+            if run.cancelled():
+                emit(metrics.finish("cancelled"), request_id)
+                emit({"type": "cancelled"}, request_id)
+            elif run.exception() is not None:
+                emit(metrics.finish("error"), request_id)
+                emit({"type": "error", "error": str(run.exception())}, request_id)
+                # a broken cdp connection would fail every later task too
+                await worker.close()
+            else:
+                emit(metrics.finish("success"), request_id)
+                emit(complete_event(*run.result()), request_id)
+
+    runner = asyncio.create_task(run_tasks())
+    emit({"type": "ready"})
+    runner_metrics.record_ready(METRICS)
+
+    try:
+        while True:
+            message = await messages.get()
+            if message is None:
+                break
+            if not message:
+                continue
+
+            try:
+                config = json.loads(message)
+            except ValueError as e:
+                emit({"type": "error", "error": f"invalid json request: {e}"})
+                continue
+            if not isinstance(config, dict):
+                emit({"type": "error", "error": f"invalid request: expected a json object, got {type(config).__name__}"})
+                continue
+
+            request_id = str(config.get("id", ""))
+            if config.get("type") == "cancel":
+                if request_id in current:
+                    current[request_id].cancel()
+                else:
+                    # still queued, or unknown and then harmless
+                    cancelled.add(request_id)
+                continue
+            tasks.put_nowait(config)
+
+        tasks.put_nowait(None)
+        await runner
+    finally:
+        runner.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await runner
+        await worker.close()
+
+
+async def run_batch(source: str, cdp_url=None, concurrency: int = 4, isolate=False) -> bool:
+    """run every task of a jsonl file ("-" for stdin), returns false if any failed
+
+    each concurrent task gets a worker of its own, so its own browser session
+    attached to the shared chromium, and runs in a fresh tab there.
+    """
+    llms = {}
+    workers = asyncio.Queue()
+    for _ in range(concurrency):
+        workers.put_nowait(BrowserWorker(cdp_url, llms))
+    attached = []
+    counts = {"succeeded": 0, "failed": 0}
+    tasks = set()
+    started = time.monotonic()
+
+    async def run_one(worker: BrowserWorker, config: dict):
+        request_id = config["id"]
+        metrics = runner_metrics.RunMetrics(METRICS)
+        try:
+            result, replay = await worker.run_task(config, metrics, request_id, own_tab=True)
+        except asyncio.CancelledError:
+            emit(metrics.finish("cancelled"), request_id)
+            emit({"type": "cancelled"}, request_id)
+            raise
+        except Exception as e:
+            counts["failed"] += 1
+            emit(metrics.finish("error"), request_id)
+            emit({"type": "error", "error": str(e)}, request_id)
+            # reattach for the next task in case the session itself broke
+            await worker.close()
+        else:
+            counts["succeeded"] += 1
+            emit(metrics.finish("success"), request_id)
+            emit(complete_event(result, replay), request_id)
+        finally:
+            workers.put_nowait(worker)
+
+    stream = sys.stdin.buffer if source == "-" else open(source, "rb")
+    loop = asyncio.get_running_loop()
+    line_number = 0
+    try:
+        while True:
+            line = await loop.run_in_executor(None, stream.readline)
+            if not line:
+                break
+            line_number += 1
+            if not line.strip():
+                continue
+
+            try:
+                config = json.loads(line)
+            except ValueError as e:
+                counts["failed"] += 1
+                emit({"type": "error", "error": f"invalid json task: {e}"}, str(line_number))
+                continue
+            if not isinstance(config, dict):
+                counts["failed"] += 1
+                emit({"type": "error", "error": f"invalid task: expected a json object, got {type(config).__name__}"}, str(line_number))
+                continue
+            config["id"] = str(config.get("id", line_number))
+            config.setdefault("isolated", isolate)
+
+            # a free worker before the task, so a huge file never becomes a
+            # huge number of waiting tasks
+            worker = await workers.get()
+            if worker not in attached:
+                attached.append(worker)
+            task = asyncio.create_task(run_one(worker, config))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for worker in attached:
+            await worker.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+    emit({
+        "type": "batch_complete",
+        **counts,
+        "seconds": round(time.monotonic() - started, 3)
+    })
+    return counts["failed"] == 0
+
 
 async def main():
     """main entry point"""
+    global _stdout
+
+    # node stops a task by killing the process; as cancellation the agent
+    # and the browser session are closed properly first
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signum, main_task.cancel)
+
+    # opt-in length-prefixed frames instead of jsonl, in both directions
+    framed = "--framed" in sys.argv
+    if framed:
+        sys.argv.remove("--framed")
+        _stdout = runner_protocol.FramedWriter(sys.stdout.buffer)
+
+    # long-lived worker mode
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        cdp_url = None
+        if "--cdp-url" in sys.argv[2:]:
+            cdp_url = sys.argv[sys.argv.index("--cdp-url") + 1]
+        metrics_address = None
+        if "--metrics" in sys.argv[2:]:
+            metrics_address = sys.argv[sys.argv.index("--metrics") + 1]
+        try:
+            await serve(cdp_url, framed, metrics_address)
+        except asyncio.CancelledError:
+            # the stdin reader thread may be blocked in a read, and a normal
+            # interpreter shutdown aborts on its lock; every event is flushed
+            os._exit(0)
+        return
+    
+    # many tasks at once, each in its own tab
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        cdp_url = None
+        if "--cdp-url" in sys.argv[3:]:
+            cdp_url = sys.argv[sys.argv.index("--cdp-url") + 1]
+        concurrency = 4
+        if "--concurrency" in sys.argv[3:]:
+            concurrency = int(sys.argv[sys.argv.index("--concurrency") + 1])
+        try:
+            ok = await run_batch(
+                sys.argv[2] if len(sys.argv) > 2 else "-",
+                cdp_url,
+                concurrency,
+                "--isolate" in sys.argv[3:]
+            )
+        except asyncio.CancelledError:
+            # see serve mode
+            os._exit(1)
+        if not ok:
+            sys.exit(1)
+        return
     
     # parse config from stdin
-    config_str = sys.stdin.read()
-    config = json.loads(config_str)
+    if framed:
+        message = runner_protocol.read_message(sys.stdin.buffer, True)
+        if message is None:
+            emit({"type": "error", "error": "no request frame on stdin"})
+            sys.exit(1)
+        config = json.loads(message)
+    else:
+        config = json.loads(sys.stdin.read())
     
+    metrics = runner_metrics.RunMetrics(METRICS)
     try:
         # Connect to Chrome via CDP
         browser_session = BrowserSession(cdp_url=config["cdp_url"])
 
-        # Pick the LLM from the configured model. Previously no llm was passed
-        # at all, so browser-use silently fell back to its OpenAI default and
-        # the `model` sent by the caller was ignored.
+        # Pick the LLM from the configured model.
         model = config.get("model") or "claude-sonnet-5"
-        if model.startswith("claude"):
-            llm = ChatAnthropic(model=model, api_key=os.environ.get("ANTHROPIC_API_KEY"))
-        else:
-            llm = ChatOpenAI(model=model, api_key=os.environ.get("OPENAI_API_KEY"))
+        llm = create_llm(model)
 
-        # Create agent
-        agent = Agent(
-            task=config["task"],
-            browser_session=browser_session,
-            llm=llm,
-        )
-        
         # Run agent
-        result = await agent.run()
+        result, replay = await run_browser_task(config, browser_session, llm, metrics)
         
-        # Convert result to string if it's not JSON serializable
-        if hasattr(result, '__dict__'):
-            result_str = str(result)
-        else:
-            result_str = str(result)
-        
-        # send completion signal
-        print(json.dumps({
-            "type": "complete",
-            "content": result_str,
-            "status": "success"
-        }), flush=True)
+        # send completion signal, after the run's metrics
+        emit(metrics.finish("success"))
+        emit(complete_event(result, replay))
             
+    except asyncio.CancelledError:
+        emit(metrics.finish("cancelled"))
+        emit({"type": "cancelled"})
+        sys.exit(1)
     except Exception as e:
-        print(json.dumps({
+        emit(metrics.finish("error"))
+        emit({
             "type": "error",
             "error": str(e)
-        }), flush=True)
+        })
         sys.exit(1)
 
 
@@ -2,44 +2,1207 @@
 """
 dedalus runner with mcp integration and local tools
 spawnable from node.js with streaming support
+
+one-shot: a single json config on stdin (or positional args), jsonl out.
+serve:    `dedalus-runner.py --serve [--socket PATH]` keeps one runner alive
+          and reads newline-delimited json requests, each with an "id", from
+          stdin or a unix socket. requests run concurrently on one event loop
+          and every emitted line carries the "id" of the request it belongs to.
+          requests sharing a "session_id" share one persistent bash shell.
+          `--metrics HOST:PORT` (or a socket path) serves prometheus metrics.
+          {"type": "cancel", "id": ...} cancels a running request, killing
+          its shell's process group, and the run ends with a "cancelled" event.
+
+every run emits a "metrics" event (see runner_metrics.py) just before its
+complete or error event.
+
+with a "session_id" the runner also keeps the chat history itself (see
+ConversationStore) and sends the model a window of at most "history_tokens",
+so callers only ever send the new message.
+
+batch:    `dedalus-runner.py --batch FILE|- [--concurrency N] [--rate PER_SEC]
+          [--checkpoint PATH] [--max-retries N]` runs a jsonl file of requests
+          in one process with bounded concurrency, backing off on rate limits.
+          results come out as each request finishes, tagged with its "line"
+          (its frame number under --framed); completed ids go to the
+          checkpoint, and a rerun skips them.
+
+every mode takes --framed to swap jsonl for the length-prefixed frames
+described in runner_protocol.py, in both directions.
 """
 
 import asyncio
+import bisect
+import codecs
+import contextlib
+import contextvars
+import fnmatch
+import functools
+import hashlib
+import inspect
+import itertools
 import json
+import mmap
 import os
-import subprocess
+import random
+import re
+import shlex
+import shutil
+import signal
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+try:
+    # python 3.11+ deprecates the public sre_* aliases
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+# sdk import time is reported as a metric
+_import_started = time.perf_counter()
 
 from dedalus_labs import AsyncDedalus, DedalusRunner
-from dedalus_labs.utils.streaming import stream_async
 
+try:
+    # a dependency of dedalus-labs; only used to tune its connection pool
+    import httpx
+except ImportError:
+    httpx = None
 
-class LocalTools:
-    """local filesystem and bash tools"""
+_import_seconds = time.perf_counter() - _import_started
+
+import runner_metrics
+import runner_protocol
+
+
+# request id and output sink of the run on the current task. in serve mode
+# many runs share one loop, so these are per-task rather than module globals.
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "request_id", default=None
+)
+_sink: contextvars.ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = contextvars.ContextVar(
+    "sink", default=None
+)
+
+
+# replaced by a FramedWriter under --framed
+_stdout = runner_protocol.JsonlWriter(sys.stdout.buffer)
+
+METRICS = runner_metrics.Registry("vibeos_dedalus")
+runner_metrics.record_startup(METRICS, _import_seconds)
+
+# timings of the run on the current task
+_run_metrics: contextvars.ContextVar[Optional[runner_metrics.RunMetrics]] = contextvars.ContextVar(
+    "run_metrics", default=None
+)
+
+
+async def _stream_text(response):
+    """text deltas of a DedalusRunner.run(stream=True) response
+    
+    with an async client the sdk returns an async generator of chat
+    completion chunks (not a coroutine), running tool calls between model
+    turns itself; only the content deltas are output.
+    """
+    if inspect.isawaitable(response):
+        response = await response
+    async for chunk in response:
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        content = getattr(choices[0].delta, "content", None)
+        if content:
+            yield content
+
+
+class ChunkCoalescer:
+    """buffers stream chunks and emits them as fewer, larger chunk events
+
+    a batch goes out once it reaches max_bytes, max_latency after its first
+    chunk, before any other event of the same run, or at end of stream.
+    max_bytes <= 0 emits every chunk as it comes.
+    """
+    
+    def __init__(self, max_bytes: int = 4096, max_latency: float = 0.015):
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.parts: List[str] = []
+        self.size = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.chunks = 0
+        self.flushes = 0
+        self.bytes = 0
+        self.largest = 0
+    
+    def add(self, chunk: str):
+        self.chunks += 1
+        self.parts.append(chunk)
+        self.size += len(chunk.encode("utf-8"))
+        if self.size >= self.max_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_latency, self.flush)
+    
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.parts:
+            return
+        content = "".join(self.parts)
+        self.flushes += 1
+        self.bytes += self.size
+        self.largest = max(self.largest, self.size)
+        self.parts = []
+        self.size = 0
+        _emit_now({
+            "type": "chunk",
+            "content": content
+        })
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chunks": self.chunks,
+            "flushes": self.flushes,
+            "bytes": self.bytes,
+            "largest_flush": self.largest
+        }
+
+
+# coalescer of the run on the current task, so other events can flush it
+# first and never overtake text that was streamed before them
+_coalescer: contextvars.ContextVar[Optional[ChunkCoalescer]] = contextvars.ContextVar(
+    "coalescer", default=None
+)
+
+
+def emit(event: Dict[str, Any]) -> None:
+    """write one jsonl event, tagged with the current request id if any"""
+    coalescer = _coalescer.get()
+    if coalescer is not None:
+        coalescer.flush()
+    _emit_now(event)
+
+
+def _error_event(error: Exception) -> Dict[str, Any]:
+    """error event of a failed run, with the api's http status if it has one"""
+    event = {"type": "error", "error": str(error)}
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        event["status_code"] = status
+    return event
+
+
+def _emit_now(event: Dict[str, Any]) -> None:
+    request_id = _request_id.get()
+    if request_id is not None:
+        event = {"id": request_id, **event}
+    sink = _sink.get()
+    if sink is None:
+        _stdout.write_event(event)
+    else:
+        sink(event)
+
+
+class ShellSession:
+    """one long-lived shell that bash tool calls are sent to
+
+    cd, exported variables and activated virtualenvs survive between calls.
+    completion is detected by a sentinel line printed after each command, and
+    a timed-out command is interrupted with SIGINT without losing the shell.
+    """
+    
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.lock = asyncio.Lock()
+    
+    async def _start(self):
+        """start the shell in its own process group"""
+        self.process = await asyncio.create_subprocess_exec(
+            shutil.which("bash") or "/bin/sh",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+        )
+        # a handler rather than an ignore: the shell survives the SIGINT sent
+        # to its group on timeout, while commands it execs get the default
+        # action back and die
+        self.process.stdin.write(b"trap ':' INT\n")
+        await self.process.stdin.drain()
+    
+    async def close(self):
+        """kill the shell and anything still running in its group"""
+        process, self.process = self.process, None
+        if process is None or process.returncode is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
     
     @staticmethod
-    def bash(command: str) -> Dict[str, Any]:
-        """execute bash command"""
+    async def _read_until(
+        stream: asyncio.StreamReader,
+        marker: bytes,
+        on_output: Callable[[str], None]
+    ):
+        """pass output up to the sentinel line to on_output as it comes
+
+        returns the number after the marker, or None if the marker carries
+        none or the shell exited first.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        needle = b"\n" + marker
+        buf = bytearray()
+        
+        def flush(upto: int, final: bool = False):
+            text = decoder.decode(bytes(buf[:upto]), final=final)
+            del buf[:upto]
+            if text:
+                on_output(text)
+        
+        while True:
+            data = await stream.read(4096)
+            if not data:
+                flush(len(buf), final=True)
+                return None
+            
+            start = max(0, len(buf) - len(needle))
+            buf += data
+            index = buf.find(needle, start)
+            if index == -1:
+                # hold back only what could be the start of the marker
+                flush(len(buf) - ShellSession._marker_prefix(buf, needle))
+                continue
+            
+            end = buf.find(b"\n", index + len(needle))
+            while end == -1:
+                data = await stream.read(4096)
+                if not data:
+                    break
+                buf += data
+                end = buf.find(b"\n", index + len(needle))
+            
+            status = bytes(buf[index + len(needle):end if end != -1 else len(buf)]).strip()
+            flush(index, final=True)
+            return int(status) if status else None
+    
+    @staticmethod
+    def _marker_prefix(buf: bytearray, needle: bytes) -> int:
+        """length of the longest end of buf that needle starts with"""
+        newline = buf.find(b"\n", max(0, len(buf) - len(needle) + 1))
+        while newline != -1:
+            if needle.startswith(buf[newline:]):
+                return len(buf) - newline
+            newline = buf.find(b"\n", newline + 1)
+        return 0
+    
+    async def _interrupt(self, readers: List[asyncio.Task]) -> bool:
+        """stop the running command, true if the shell survived
+
+        SIGINT goes to the shell's whole process group, so background and
+        piped children die with the command; the trap keeps the shell.
+        """
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.process.pid, signal.SIGINT)
+        _, pending = await asyncio.wait(readers, timeout=2)
+        if not pending:
+            return True
+        # the command ignored SIGINT, so the shell goes with it
+        for task in pending:
+            task.cancel()
+        await self.close()
+        return False
+    
+    @staticmethod
+    async def _exited(process: asyncio.subprocess.Process):
+        """return once process has exited
+
+        polls returncode, which is set when the process exits: wait() also
+        waits for its pipes to close, and a background job can hold those
+        open long after.
+        """
+        while process.returncode is None:
+            await asyncio.sleep(0.05)
+    
+    async def _kill_stragglers(self):
+        """SIGKILL whatever is left in the shell's process group but the shell
+
+        background jobs ignore SIGINT in a shell without job control, so they
+        outlive _interrupt. without /proc the whole shell is restarted instead.
+        """
+        shell_pid = self.process.pid
         try:
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            return {
+            entries = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+        except OSError:
+            await self.close()
+            return
+        for entry in entries:
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    pgrp = int(f.read().rsplit(")", 1)[1].split()[2])
+                if pgrp == shell_pid and int(entry) != shell_pid:
+                    os.kill(int(entry), signal.SIGKILL)
+            except (OSError, ValueError, IndexError):
+                continue
+    
+    async def run(self, command: str, on_output: Callable[[str, str], None]) -> Dict[str, Any]:
+        """run one command in the shell and wait for its sentinel
+
+        output goes only to on_output(stream, text); the caller decides how
+        much of it to keep.
+        """
+        async with self.lock:
+            if self.process is None or self.process.returncode is not None:
+                await self._start()
+            
+            marker = f"__vibeos_done_{uuid.uuid4().hex}__".encode()
+            # eval so a syntax error fails the command instead of the shell;
+            # stdin from /dev/null so a command can't swallow the next script
+            script = (
+                f"eval {shlex.quote(command)} < /dev/null\n"
+                f"printf '\\n%s %d\\n' {marker.decode()} $?\n"
+                f"printf '\\n%s\\n' {marker.decode()} >&2\n"
+            ).encode()
+            self.process.stdin.write(script)
+            await self.process.stdin.drain()
+            
+            readers = [
+                asyncio.create_task(self._read_until(
+                    self.process.stdout, marker, lambda text: on_output("stdout", text)
+                )),
+                asyncio.create_task(self._read_until(
+                    self.process.stderr, marker, lambda text: on_output("stderr", text)
+                )),
+            ]
+            # a command that ends the shell (e.g. `exit`) prints no sentinel,
+            # and a background job it left may hold the pipes open past it
+            exited = asyncio.create_task(self._exited(self.process))
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            pending = set(readers)
+            try:
+                while pending and not exited.done():
+                    done, _ = await asyncio.wait(
+                        pending | {exited},
+                        timeout=deadline - loop.time(),
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        break
+                    pending -= done
+            except asyncio.CancelledError:
+                # the run was cancelled: stop the command and everything it
+                # started before giving the shell back
+                exited.cancel()
+                if await self._interrupt(readers):
+                    await self._kill_stragglers()
+                raise
+            
+            if pending and exited.done():
+                returncode = None
+                # what the shell left behind dies with it, as on close(), and
+                # its pipes close so the readers can finish
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                _, pending = await asyncio.wait(pending, timeout=2)
+                for task in pending:
+                    task.cancel()
+            elif pending:
+                exited.cancel()
+                if not await self._interrupt(readers):
+                    return {
+                        "success": False,
+                        "error": f"command timed out after {self.timeout:g} seconds; "
+                                 "shell was restarted and its state was lost"
+                    }
+                return {
+                    "success": False,
+                    "error": f"command timed out after {self.timeout:g} seconds"
+                }
+            else:
+                exited.cancel()
+                returncode = readers[0].result()
+            
+            result = {
                 "success": True,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode
+                "returncode": returncode
             }
-        except subprocess.TimeoutExpired:
-            return {
+            
+            if returncode is None:
+                # the command ended the shell itself
+                await self.process.wait()
+                result["returncode"] = self.process.returncode
+                result["message"] = "shell exited; a new shell starts on the next call"
+                self.process = None
+            
+            return result
+
+
+# read_file sniffs this much of a file to tell text from binary, and maps
+# files of at least MMAP_THRESHOLD bytes instead of reading them
+BINARY_SNIFF_BYTES = 8192
+MMAP_THRESHOLD = 1 << 20
+
+
+def _looks_binary(block: bytes) -> bool:
+    """nul bytes or invalid utf-8 in the first block of a file"""
+    if b"\0" in block:
+        return True
+    try:
+        # not final: a multi-byte character cut at the block end is fine
+        codecs.getincrementaldecoder("utf-8")().decode(block)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+class LineIndex:
+    """newline counts per fixed-size block of a file
+
+    enough to seek to any line by scanning a single block, at one int per
+    block rather than one per line.
+    """
+    
+    BLOCK = 1 << 20
+    
+    def __init__(self, data):
+        self.size = len(data)
+        # lines_before[i]: newlines in blocks 0..i-1
+        self.lines_before = array("q")
+        newlines = 0
+        for start in range(0, self.size, self.BLOCK):
+            self.lines_before.append(newlines)
+            newlines += data[start:start + self.BLOCK].count(b"\n")
+        self.newlines = newlines
+        unterminated = self.size and data[self.size - 1:self.size] != b"\n"
+        self.line_count = newlines + (1 if unterminated else 0)
+        self.footprint = 64 + self.lines_before.itemsize * len(self.lines_before)
+    
+    def offset_of_line(self, data, line: int) -> int:
+        """byte offset where 0-based line `line` starts"""
+        if line <= 0:
+            return 0
+        if line > self.newlines:
+            return self.size
+        # last block that starts before the line's preceding newline
+        block = bisect.bisect_left(self.lines_before, line) - 1
+        pos = block * self.BLOCK
+        for _ in range(line - self.lines_before[block]):
+            pos = data.find(b"\n", pos) + 1
+        return pos
+
+
+# edit_file streams files through in chunks of this size
+EDIT_CHUNK = 1 << 20
+
+
+def _stream_replace(src, dst, replacements: Dict[bytes, bytes]) -> Dict[bytes, int]:
+    """copy src to dst replacing every key of replacements in one pass
+
+    matches are leftmost and non-overlapping, and the longest key wins at any
+    position, so edits never see each other's output. only one chunk plus the
+    longest key is held in memory.
+    """
+    olds = sorted(replacements, key=len, reverse=True)
+    pattern = re.compile(b"|".join(re.escape(old) for old in olds))
+    longest = len(olds[0])
+    counts = dict.fromkeys(olds, 0)
+    carry = b""
+    
+    while True:
+        chunk = src.read(EDIT_CHUNK)
+        buf = carry + chunk
+        # a match starting before `safe` is complete within buf; later ones
+        # might still grow into a longer key with the next chunk
+        safe = len(buf) if not chunk else len(buf) - longest + 1
+        pos = 0
+        for match in pattern.finditer(buf):
+            if match.start() >= safe:
+                break
+            dst.write(buf[pos:match.start()])
+            dst.write(replacements[match.group()])
+            counts[match.group()] += 1
+            pos = match.end()
+        keep = max(pos, safe)
+        dst.write(buf[pos:keep])
+        carry = buf[keep:]
+        if not chunk:
+            return counts
+
+
+def _rewrite_atomically(path: Path, rewrite: Callable, accept: Callable) -> Any:
+    """rewrite(src, dst) into a temp file next to path, then rename it over path
+
+    the temp file is discarded unless accept(result) holds, so a failed
+    check or a crash mid-write never leaves a half-written file behind.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            result = rewrite(src, dst)
+            accepted = accept(result)
+            if accepted:
+                dst.flush()
+                os.fsync(dst.fileno())
+                os.chmod(tmp_path, os.fstat(src.fileno()).st_mode & 0o7777)
+        if accepted:
+            os.replace(tmp_path, path)
+        return result
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """translate a gitignore-style glob (with **) into a regex body"""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class GitIgnore:
+    """rules of one .gitignore file, matched against paths relative to its directory"""
+    
+    def __init__(self, base: str, lines: List[str], prefix: str = ""):
+        # base: where the file sits, relative to the listing root. prefix:
+        # the listing root relative to the file, for .gitignores above it
+        self.base = base
+        self.prefix = prefix
+        # (regex, negated, directories only)
+        self.rules: List[Tuple[Any, bool, bool]] = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            # a slash anywhere but the end anchors the pattern to this directory
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line:
+                continue
+            prefix = "" if anchored else "(?:.*/)?"
+            self.rules.append((re.compile(prefix + _glob_to_regex(line) + "$"), negated, dir_only))
+    
+    @classmethod
+    def load(cls, directory: str, base: str, prefix: str = "") -> Optional["GitIgnore"]:
+        """rules from directory/.gitignore, if there is one"""
+        try:
+            with open(os.path.join(directory, ".gitignore"), encoding="utf-8", errors="replace") as f:
+                return cls(base, f.readlines(), prefix)
+        except OSError:
+            return None
+    
+    @classmethod
+    def load_ancestors(cls, root: Path) -> List["GitIgnore"]:
+        """.gitignore files between the enclosing git checkout and root"""
+        ignores = []
+        for parent in root.parents:
+            ignore = cls.load(str(parent), "", root.relative_to(parent).as_posix() + "/")
+            if ignore is not None:
+                ignores.insert(0, ignore)
+            if (parent / ".git").exists():
+                return ignores
+        # not inside a checkout: parent .gitignores don't apply
+        return []
+    
+    def match(self, rel_path: str, is_dir: bool) -> Optional[bool]:
+        """True if ignored, False if re-included, None if no rule applies"""
+        if self.base:
+            if not rel_path.startswith(self.base + "/"):
+                return None
+            rel_path = rel_path[len(self.base) + 1:]
+        rel_path = self.prefix + rel_path
+        verdict = None
+        for regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                verdict = not negated
+        return verdict
+
+
+def _walk_directory(
+    root: Path,
+    max_depth: int,
+    include: List[str],
+    exclude: List[str],
+    respect_gitignore: bool,
+    cache: Optional["FileCache"] = None
+):
+    """yield list_directory items depth-first in name order
+
+    built on os.scandir so type and size come from the cached DirEntry
+    instead of separate is_dir/is_file/stat calls per entry. with a cache,
+    each directory's names and types are reused while its stat is unchanged;
+    file sizes are always read fresh, since writing a file doesn't touch its
+    directory's mtime.
+    """
+    
+    def scan(directory: str) -> List[Tuple[str, bool, bool, bool, Optional[os.DirEntry]]]:
+        """(name, is_dir, is_file, is_symlink, entry) per child, by name"""
+        if cache is not None:
+            key = _stat_key(os.stat(directory))
+            listing = cache.get("dir", directory, key)
+            if listing is not None:
+                return [(*child, None) for child in listing]
+        
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        children = [
+            (entry.name, entry.is_dir(), entry.is_file(), entry.is_symlink())
+            for entry in entries
+        ]
+        if cache is not None:
+            cache.put("dir", directory, key, children, 64 + sum(64 + len(c[0]) for c in children))
+        return [(*child, entry) for child, entry in zip(children, entries)]
+    
+    def matches(patterns: List[str], rel_path: str, name: str) -> bool:
+        return any(
+            fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern)
+            for pattern in patterns
+        )
+    
+    def walk(directory: str, rel_dir: str, depth: int, ignores: List[GitIgnore]):
+        children = scan(directory)
+        if respect_gitignore and any(child[0] == ".gitignore" for child in children):
+            ignore = GitIgnore.load(directory, rel_dir)
+            if ignore is not None:
+                ignores = ignores + [ignore]
+        
+        for name, is_dir, is_file, is_symlink, entry in children:
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            child_path = os.path.join(directory, name)
+            
+            if respect_gitignore:
+                if name == ".git":
+                    continue
+                ignored = None
+                for ignore in ignores:
+                    verdict = ignore.match(rel_path, is_dir)
+                    if verdict is not None:
+                        ignored = verdict
+                if ignored:
+                    continue
+            if matches(exclude, rel_path, name):
+                continue
+            
+            if is_dir:
+                yield {
+                    "name": name,
+                    "path": rel_path,
+                    "type": "directory",
+                    "size": None
+                }
+                # symlinked directories are listed but not followed, so a
+                # link cycle can't recurse forever
+                if (max_depth <= 0 or depth < max_depth) and not is_symlink:
+                    yield from walk(child_path, rel_path, depth + 1, ignores)
+            elif not include or matches(include, rel_path, name):
+                size = None
+                if is_file:
+                    size = (entry.stat() if entry is not None else os.stat(child_path)).st_size
+                yield {
+                    "name": name,
+                    "path": rel_path,
+                    "type": "file",
+                    "size": size
+                }
+    
+    ancestors = GitIgnore.load_ancestors(root) if respect_gitignore else []
+    yield from walk(str(root), "", 1, ancestors)
+
+
+def _trigrams(data: bytes) -> Set[bytes]:
+    """distinct 3-byte sequences of data"""
+    return {data[i:i + 3] for i in range(len(data) - 2)}
+
+
+def _required_literals(pattern: str, is_regex: bool) -> List[str]:
+    """literal runs every match of pattern must contain
+
+    only top-level literals are used; anything under a branch, repeat or
+    class just ends the current run, which keeps the result a safe subset.
+    """
+    if not is_regex:
+        return [pattern]
+    
+    runs: List[str] = []
+    run: List[str] = []
+    for op, arg in sre_parse.parse(pattern):
+        if op is sre_constants.LITERAL:
+            run.append(chr(arg))
+            continue
+        runs.append("".join(run))
+        run = []
+    runs.append("".join(run))
+    return [run for run in runs if len(run) >= 3]
+
+
+class TrigramIndex:
+    """on-disk trigram index of a directory tree
+
+    each file's trigrams (lowercased) are kept as a bloom filter in sqlite,
+    so a query only reads files whose filter holds all its trigrams. text
+    files over MAX_FILE_BYTES get no filter and are candidates for every
+    query. refresh re-indexes just the files whose (mtime_ns, size, ino)
+    changed.
+    """
+    
+    MAX_FILE_BYTES = 1 << 20
+    _open: Dict[str, "TrigramIndex"] = {}
+    
+    def __init__(self, root: Path):
+        self.root = root
+        cache_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "vibeos"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha1(str(root).encode("utf-8")).hexdigest()[:16]
+        self.db = sqlite3.connect(str(cache_dir / f"search-{digest}.sqlite"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, ino INTEGER, "
+            "nbits INTEGER, bloom BLOB)"
+        )
+        self.lock = threading.Lock()
+        # path -> (key, nbits, bloom as int); nbits 0 = binary, -1 = too large
+        self.files: Dict[str, Tuple[Tuple[int, int, int], int, int]] = {}
+        for path, mtime_ns, size, ino, nbits, bloom in self.db.execute("SELECT * FROM files"):
+            if nbits == 0 and size > self.MAX_FILE_BYTES:
+                # indexed when large files were left out, sniff them again
+                continue
+            self.files[path] = ((mtime_ns, size, ino), nbits, int.from_bytes(bloom or b"", "little"))
+    
+    @classmethod
+    def open(cls, root: Path) -> "TrigramIndex":
+        """shared index for root, kept open for the life of the process"""
+        if str(root) not in cls._open:
+            cls._open[str(root)] = cls(root)
+        return cls._open[str(root)]
+    
+    @staticmethod
+    def _bits(trigram: bytes, nbits: int) -> Tuple[int, int]:
+        """the two filter bits of a trigram"""
+        value = int.from_bytes(trigram, "little")
+        return (
+            ((value * 0x9E3779B1) & 0xFFFFFFFF) % nbits,
+            ((value * 0x85EBCA77) & 0xFFFFFFFF) % nbits
+        )
+    
+    def _index_file(self, rel_path: str, key: Tuple[int, int, int]) -> Tuple[int, bytes]:
+        """bloom filter of one file, (-1, b"") if it's too large to index, or
+        (0, b"") if it can't be searched"""
+        with open(self.root / rel_path, 'rb') as f:
+            if key[1] > self.MAX_FILE_BYTES:
+                return (0 if b"\0" in f.read(BINARY_SNIFF_BYTES) else -1), b""
+            data = f.read()
+        if b"\0" in data[:BINARY_SNIFF_BYTES]:
+            return 0, b""
+        trigrams = _trigrams(data.lower())
+        # ~8 bits per trigram with two probes: ~5% false positives per trigram
+        nbits = 512
+        while nbits < 8 * len(trigrams):
+            nbits *= 2
+        bloom = bytearray(nbits // 8)
+        for trigram in trigrams:
+            for bit in self._bits(trigram, nbits):
+                bloom[bit >> 3] |= 1 << (bit & 7)
+        return nbits, bytes(bloom)
+    
+    def refresh(self) -> Dict[str, int]:
+        """bring the index up to date with the tree"""
+        stats = {"indexed": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        with self.lock:
+            for item in _walk_directory(self.root, 0, [], [], True):
+                if item["type"] != "file":
+                    continue
+                rel_path = item["path"]
+                try:
+                    st = os.stat(self.root / rel_path)
+                except OSError:
+                    continue
+                seen.add(rel_path)
+                key = (st.st_mtime_ns, st.st_size, st.st_ino)
+                cached = self.files.get(rel_path)
+                if cached is not None and cached[0] == key:
+                    stats["unchanged"] += 1
+                    continue
+                try:
+                    nbits, bloom = self._index_file(rel_path, key)
+                except OSError:
+                    continue
+                self.files[rel_path] = (key, nbits, int.from_bytes(bloom, "little"))
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (rel_path, *key, nbits, bloom)
+                )
+                stats["indexed"] += 1
+            
+            for rel_path in set(self.files) - seen:
+                del self.files[rel_path]
+                self.db.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+                stats["removed"] += 1
+            self.db.commit()
+        return stats
+    
+    def candidates(self, literals: List[str]) -> Tuple[List[str], int]:
+        """files that may contain every literal, and how many were unsearchable
+
+        unindexed large files always may, the pattern decides for them.
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams |= _trigrams(literal.encode("utf-8").lower())
+        
+        masks: Dict[int, int] = {}
+        found = []
+        skipped = 0
+        with self.lock:
+            for rel_path, (_, nbits, bloom) in self.files.items():
+                if nbits == 0:
+                    skipped += 1
+                    continue
+                if nbits < 0:
+                    found.append(rel_path)
+                    continue
+                if nbits not in masks:
+                    mask = 0
+                    for trigram in trigrams:
+                        for bit in self._bits(trigram, nbits):
+                            mask |= 1 << bit
+                    masks[nbits] = mask
+                if bloom & masks[nbits] == masks[nbits]:
+                    found.append(rel_path)
+        return sorted(found), skipped
+
+
+class OutputCapture:
+    """bounded capture of one output stream
+
+    the first half of the byte/line budget is kept as the head and the last
+    half in a ring buffer as the tail. once anything would be dropped, the
+    whole stream is spilled to a temp file so nothing is lost.
+    """
+    
+    def __init__(self, max_bytes: int, max_lines: int):
+        self.head_bytes = max_bytes // 2
+        self.head_lines = max_lines // 2
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.tail_lines = max_lines - self.head_lines
+        self.head = bytearray()
+        self.head_full = False
+        self.tail: Deque[bytes] = deque()
+        self.tail_size = 0
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.spill: Optional[Any] = None
+    
+    def write(self, text: str):
+        """append decoded output"""
+        data = text.encode("utf-8")
+        self.total_bytes += len(data)
+        self.total_lines += data.count(b"\n")
+        if self.spill is not None:
+            self.spill.write(data)
+        
+        if not self.head_full:
+            room = self.head_bytes - len(self.head)
+            take = len(self.clip_head(data[:room], self.head_lines - self.head.count(b"\n")))
+            self.head += data[:take]
+            data = data[take:]
+            if not data:
+                return
+            self.head_full = True
+        
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.tail_bytes:
+            self._spill()
+            overflow = self.tail_size - self.tail_bytes
+            if len(self.tail[0]) <= overflow:
+                self.tail_size -= len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][overflow:]
+                self.tail_size -= overflow
+    
+    def _spill(self):
+        """start writing the full stream to disk, while it is still whole"""
+        if self.spill is not None:
+            return
+        self.spill = tempfile.NamedTemporaryFile(
+            prefix="vibeos-output-", suffix=".log", delete=False
+        )
+        self.spill.write(self.head)
+        for data in self.tail:
+            self.spill.write(data)
+    
+    @staticmethod
+    def clip_head(data: bytes, lines: int) -> bytes:
+        """data up to and including its lines-th newline"""
+        newline = -1
+        for _ in range(max(0, lines)):
+            newline = data.find(b"\n", newline + 1)
+            if newline == -1:
+                return data
+        return data[:newline + 1]
+    
+    @staticmethod
+    def clip_tail(data: bytes, lines: int) -> bytes:
+        """the last lines lines of data, counting a final unterminated one"""
+        cut = len(data) - 1 if data.endswith(b"\n") else len(data)
+        for _ in range(max(0, lines)):
+            cut = data.rfind(b"\n", 0, cut)
+            if cut == -1:
+                return data
+        return data[cut + 1:]
+    
+    @staticmethod
+    def render(head: bytes, tail: bytes, total_bytes: int, total_lines: Optional[int] = None) -> str:
+        """head and tail joined by a note on what was left out"""
+        lines = f", {total_lines} lines" if total_lines is not None else ""
+        omitted = (
+            f"\n... [{total_bytes - len(head) - len(tail)} bytes omitted "
+            f"of {total_bytes}{lines}] ...\n"
+        )
+        return (
+            head.decode("utf-8", errors="replace")
+            + omitted
+            + tail.decode("utf-8", errors="replace")
+        )
+    
+    def finish(self) -> Tuple[str, Optional[str]]:
+        """bounded text, and the spill file path if anything was cut"""
+        tail = b"".join(self.tail)
+        # the byte budget is enforced on the fly, the line budget here
+        clipped = self.clip_tail(tail, self.tail_lines)
+        if len(clipped) < len(tail):
+            self._spill()
+            tail = clipped
+        
+        if self.spill is None:
+            return (bytes(self.head) + tail).decode("utf-8", errors="replace"), None
+        
+        self.spill.close()
+        text = self.render(bytes(self.head), tail, self.total_bytes, self.total_lines)
+        return text, self.spill.name
+
+
+def _stat_key(st: os.stat_result) -> Tuple[int, int, int]:
+    """what FileCache entries are validated against"""
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class FileCache:
+    """lru of data derived from files, bounded by total bytes
+
+    entries are keyed by (kind, resolved path) and only served while the
+    file's (mtime_ns, size, ino) still matches what they were built from.
+    tool calls run on worker threads, so every operation takes the lock.
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # (kind, path) -> (stat key, value, size)
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[Tuple[int, int, int], Any, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, kind: str, path: str, key: Tuple[int, int, int]) -> Any:
+        """cached value, or None if missing or stale"""
+        with self.lock:
+            entry = self.entries.get((kind, path))
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((kind, path))
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, kind: str, path: str, key: Tuple[int, int, int], value: Any, size: int):
+        """store a value, evicting least recently used entries to fit"""
+        with self.lock:
+            self._drop((kind, path))
+            if size > self.max_bytes:
+                return
+            self.entries[(kind, path)] = (key, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+    
+    def invalidate(self, path: str):
+        """forget everything derived from path"""
+        with self.lock:
+            for entry in [entry for entry in self.entries if entry[1] == path]:
+                self._drop(entry)
+    
+    def _drop(self, entry: Tuple[str, str]):
+        removed = self.entries.pop(entry, None)
+        if removed is not None:
+            self.size -= removed[2]
+    
+    def stats(self) -> Dict[str, int]:
+        """hit/miss counters and current footprint"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size
+        }
+
+
+class LocalTools:
+    """local filesystem and bash tools
+    
+    one instance per run or per chat session, which owns the persistent shell
+    behind the bash tool and the file cache shared by its tool calls.
+    """
+    
+    def __init__(
+        self,
+        max_output_bytes: int = 32 * 1024,
+        max_output_lines: int = 400,
+        cache_max_bytes: int = 64 * 1024 * 1024
+    ):
+        self.shell = ShellSession()
+        self.max_output_bytes = max_output_bytes
+        self.max_output_lines = max_output_lines
+        # handle -> (path, whether the file is ours to delete)
+        self.outputs: Dict[str, Tuple[str, bool]] = {}
+        self.cache = FileCache(cache_max_bytes)
+    
+    async def close(self):
+        """release the persistent shell and spilled outputs"""
+        await self.shell.close()
+        for path, owned in self.outputs.values():
+            if owned:
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+        self.outputs.clear()
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """file cache counters, reported with each run's result"""
+        return self.cache.stats()
+    
+    def _register_output(self, path: str, owned: bool) -> str:
+        """hand out a read_output handle for a file"""
+        handle = f"out-{uuid.uuid4().hex[:12]}"
+        self.outputs[handle] = (path, owned)
+        return handle
+    
+    async def bash(self, command: str) -> Dict[str, Any]:
+        """execute bash command in a persistent shell (cd and exports carry over between calls). long output is cut to head and tail; fetch the rest with read_output"""
+        
+        captures = {
+            "stdout": OutputCapture(self.max_output_bytes, self.max_output_lines),
+            "stderr": OutputCapture(self.max_output_bytes, self.max_output_lines),
+        }
+        
+        def on_output(stream: str, text: str):
+            captures[stream].write(text)
+            emit({
+                "type": "tool_output",
+                "tool": "bash",
+                "stream": stream,
+                "content": text
+            })
+        
+        try:
+            result = await self.shell.run(command, on_output)
+        except Exception as e:
+            await self.shell.close()
+            result = {
                 "success": False,
-                "error": "command timed out after 30 seconds"
+                "error": str(e)
+            }
+        
+        for stream, capture in captures.items():
+            text, spill_path = capture.finish()
+            if not result["success"]:
+                if spill_path:
+                    os.unlink(spill_path)
+                continue
+            result[stream] = text
+            if spill_path:
+                result[f"{stream}_truncated"] = True
+                result[f"{stream}_handle"] = self._register_output(spill_path, owned=True)
+        return result
+    
+    def read_output(self, handle: str, offset: int = 0, length: int = 16384) -> Dict[str, Any]:
+        """read a byte range of a truncated tool output by its handle"""
+        try:
+            if handle not in self.outputs:
+                return {
+                    "success": False,
+                    "error": f"unknown output handle: {handle}"
+                }
+            
+            path, _ = self.outputs[handle]
+            length = max(0, min(length, self.max_output_bytes))
+            with open(path, 'rb') as f:
+                total = os.fstat(f.fileno()).st_size
+                f.seek(max(0, offset))
+                data = f.read(length)
+            
+            return {
+                "success": True,
+                "content": data.decode("utf-8", errors="replace"),
+                "offset": offset,
+                "length": len(data),
+                "total_bytes": total,
+                "eof": offset + len(data) >= total
             }
         except Exception as e:
             return {
@@ -47,9 +1210,14 @@ class LocalTools:
                 "error": str(e)
             }
     
-    @staticmethod
-    def read_file(file_path: str) -> Dict[str, Any]:
-        """read contents of a file"""
+    def read_file(
+        self,
+        file_path: str,
+        offset: Optional[int] = None,
+        limit: Optional[int] = None,
+        unit: str = "lines"
+    ) -> Dict[str, Any]:
+        """read contents of a file. pass offset/limit to read a window in "lines" or "bytes" (unit); a negative offset counts from the end, e.g. offset=-200 for the last 200 lines; on a large file that hasn't been read by line yet it reports byte_offset instead of offset and total_lines. large files read without a window are cut to head and tail; fetch the rest with read_output"""
         try:
             path = Path(file_path).expanduser().resolve()
             if not path.exists():
@@ -58,23 +1226,189 @@ class LocalTools:
                     "error": f"file not found: {file_path}"
                 }
             
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            if unit not in ("lines", "bytes"):
+                return {
+                    "success": False,
+                    "error": f"unit must be 'lines' or 'bytes', got {unit!r}"
+                }
             
-            return {
-                "success": True,
-                "content": content,
-                "path": str(path)
-            }
+            stat = os.stat(path)
+            with self._file_view(path, stat) as data:
+                size = len(data)
+                if _looks_binary(data[:BINARY_SNIFF_BYTES]):
+                    return {
+                        "success": False,
+                        "error": f"binary file ({size} bytes): {file_path}",
+                        "path": str(path),
+                        "size": size,
+                        "binary": True
+                    }
+                
+                if offset is None and limit is None:
+                    return self._read_whole(data, path, stat)
+                if unit == "bytes":
+                    return self._read_bytes(data, path, size, offset or 0, limit)
+                return self._read_lines(data, path, stat, offset or 0, limit)
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
             }
     
-    @staticmethod
-    def edit_file(file_path: str, old_content: str, new_content: str) -> Dict[str, Any]:
-        """edit file by replacing old content with new content"""
+    def _file_view(self, path: Path, stat: os.stat_result):
+        """file contents as bytes (cached) or, for large files, an mmap
+
+        large files are mapped so a window costs only the pages it touches,
+        not a read of everything before it.
+        """
+        if stat.st_size >= MMAP_THRESHOLD:
+            with open(path, 'rb') as f:
+                # an empty file can't be mapped, and mmap sizes itself from
+                # the file as it is now, not as it was at stat time
+                if os.fstat(f.fileno()).st_size == 0:
+                    return contextlib.nullcontext(b"")
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        data = self.cache.get("bytes", str(path), _stat_key(stat))
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+                self.cache.put("bytes", str(path), _stat_key(os.fstat(f.fileno())), data, len(data))
+        return contextlib.nullcontext(data)
+    
+    def _line_index(self, path: Path, stat: os.stat_result, data) -> "LineIndex":
+        """line index of a file, rebuilt only when the file changed"""
+        index = self.cache.get("lines", str(path), _stat_key(stat))
+        if index is None:
+            index = LineIndex(data)
+            self.cache.put("lines", str(path), _stat_key(stat), index, index.footprint)
+        return index
+    
+    def _known_line_count(self, path: Path, stat: os.stat_result) -> Optional[int]:
+        """line count if the file is already indexed, without indexing it"""
+        entry = self.cache.entries.get(("lines", str(path)))
+        if entry is not None and entry[0] == _stat_key(stat):
+            return entry[1].line_count
+        return None
+    
+    def _read_whole(self, data, path: Path, stat: os.stat_result) -> Dict[str, Any]:
+        """whole file if it fits the output caps, head and tail otherwise"""
+        size = len(data)
+        limits = OutputCapture(self.max_output_bytes, self.max_output_lines)
+        if size <= self.max_output_bytes:
+            total_lines = data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+            if data.count(b"\n") <= self.max_output_lines:
+                content = self.cache.get("text", str(path), _stat_key(stat))
+                if content is None:
+                    content = data.decode("utf-8")
+                    self.cache.put("text", str(path), _stat_key(stat), content, size)
+                return {
+                    "success": True,
+                    "content": content,
+                    "path": str(path),
+                    "size": size,
+                    "total_lines": total_lines
+                }
+            head = OutputCapture.clip_head(data, limits.head_lines)
+            tail = OutputCapture.clip_tail(data[len(head):], limits.tail_lines)
+        else:
+            # only the two ends are read; the middle stays on disk and
+            # the handle points at the file itself
+            total_lines = self._known_line_count(path, stat)
+            head = OutputCapture.clip_head(data[:limits.head_bytes], limits.head_lines)
+            tail = OutputCapture.clip_tail(data[size - limits.tail_bytes:], limits.tail_lines)
+        
+        return {
+            "success": True,
+            "content": OutputCapture.render(head, tail, size, total_lines),
+            "path": str(path),
+            "truncated": True,
+            "size": size,
+            "total_lines": total_lines,
+            "handle": self._register_output(str(path), owned=False)
+        }
+    
+    def _read_bytes(self, data, path: Path, size: int, offset: int, limit: Optional[int]) -> Dict[str, Any]:
+        """a byte window of a file"""
+        start = max(0, size + offset) if offset < 0 else min(offset, size)
+        length = min(limit if limit is not None else self.max_output_bytes, self.max_output_bytes)
+        end = min(size, start + max(0, length))
+        return {
+            "success": True,
+            "content": data[start:end].decode("utf-8", errors="replace"),
+            "path": str(path),
+            "size": size,
+            "offset": start,
+            "length": end - start,
+            "next_offset": end,
+            "eof": end >= size
+        }
+    
+    def _read_lines(self, data, path: Path, stat: os.stat_result, offset: int, limit: Optional[int]) -> Dict[str, Any]:
+        """a line window of a file"""
+        size = stat.st_size
+        count = min(limit if limit is not None else self.max_output_lines, self.max_output_lines)
+        
+        if offset < 0:
+            # walk back from the end, touching only the tail pages
+            cut = size - 1 if data[size - 1:size] == b"\n" else size
+            for _ in range(-offset):
+                cut = data.rfind(b"\n", 0, cut)
+                if cut == -1:
+                    break
+            start = cut + 1
+            if size < MMAP_THRESHOLD:
+                total_lines = self._line_index(path, stat, data).line_count
+            else:
+                # counting lines would read the whole file; only an index an
+                # earlier read built is used
+                total_lines = self._known_line_count(path, stat)
+            first_line = None if total_lines is None else max(0, total_lines + offset)
+        else:
+            index = self._line_index(path, stat, data)
+            total_lines = index.line_count
+            first_line = min(offset, total_lines)
+            start = index.offset_of_line(data, first_line)
+        
+        end = start
+        lines = 0
+        while lines < count and end < size:
+            newline = data.find(b"\n", end)
+            end = size if newline == -1 else newline + 1
+            lines += 1
+        
+        truncated = end - start > self.max_output_bytes
+        if truncated:
+            end = start + self.max_output_bytes
+        
+        result = {
+            "success": True,
+            "content": data[start:end].decode("utf-8", errors="replace"),
+            "path": str(path),
+            "size": size,
+            "offset": first_line,
+            "lines": lines,
+            "total_lines": total_lines,
+            "eof": end >= size
+        }
+        if first_line is None:
+            # the caller pages back from here with unit="bytes"
+            result["byte_offset"] = start
+        elif not truncated:
+            result["next_offset"] = first_line + lines
+        if truncated:
+            result["truncated"] = True
+            result["next_byte_offset"] = end
+        return result
+    
+    def edit_file(
+        self,
+        file_path: str,
+        old_content: str = "",
+        new_content: str = "",
+        edits: Optional[List[Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """edit file by replacing old content with new content (every occurrence). to make several edits in one call pass edits=[{"old": ..., "new": ..., "expected_count": n}, ...]; they are applied in one pass over the original file, and if any expected_count does not match nothing is written"""
         try:
             path = Path(file_path).expanduser().resolve()
             
@@ -84,24 +1418,60 @@ class LocalTools:
                     "error": f"file not found: {file_path}"
                 }
             
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            if edits is None:
+                edits = [{"old": old_content, "new": new_content}]
+            if not edits:
+                return {
+                    "success": False,
+                    "error": "no edits given"
+                }
             
-            if old_content not in content:
+            olds = [edit["old"].encode("utf-8") for edit in edits]
+            if not all(olds):
                 return {
                     "success": False,
-                    "error": "old content not found in file"
+                    "error": "old content must not be empty"
+                }
+            if len(set(olds)) != len(olds):
+                return {
+                    "success": False,
+                    "error": "each edit needs a distinct old content"
                 }
             
-            updated_content = content.replace(old_content, new_content)
+            replacements = {
+                old: edit["new"].encode("utf-8") for old, edit in zip(olds, edits)
+            }
+            self.cache.invalidate(str(path))
+            counts = _rewrite_atomically(
+                path,
+                lambda src, dst: _stream_replace(src, dst, replacements),
+                lambda counts: all(
+                    counts[old] == edit["expected_count"]
+                    if edit.get("expected_count") is not None else counts[old] > 0
+                    for old, edit in zip(olds, edits)
+                )
+            )
             
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(updated_content)
+            found = [counts[old] for old in olds]
+            for i, edit in enumerate(edits):
+                expected = edit.get("expected_count")
+                if expected is None and found[i] == 0:
+                    error = "old content not found in file"
+                elif expected is not None and found[i] != expected:
+                    error = f"expected {expected} occurrence(s), found {found[i]}"
+                else:
+                    continue
+                return {
+                    "success": False,
+                    "error": error if len(edits) == 1 else f"edit {i}: {error}",
+                    "counts": found
+                }
             
             return {
                 "success": True,
                 "path": str(path),
-                "message": "file updated successfully"
+                "message": "file updated successfully",
+                "counts": found
             }
         except Exception as e:
             return {
@@ -109,15 +1479,19 @@ class LocalTools:
                 "error": str(e)
             }
     
-    @staticmethod
-    def write_file(file_path: str, content: str) -> Dict[str, Any]:
+    def write_file(self, file_path: str, content: str) -> Dict[str, Any]:
         """write content to a file"""
         try:
             path = Path(file_path).expanduser().resolve()
             path.parent.mkdir(parents=True, exist_ok=True)
             
+            self.cache.invalidate(str(path))
             with open(path, 'w', encoding='utf-8') as f:
                 f.write(content)
+                f.flush()
+                # what was just written is what the next read_file would load
+                data = content.encode("utf-8")
+                self.cache.put("bytes", str(path), _stat_key(os.fstat(f.fileno())), data, len(data))
             
             return {
                 "success": True,
@@ -130,9 +1504,124 @@ class LocalTools:
                 "error": str(e)
             }
     
+    async def search(
+        self,
+        query: str,
+        directory: str = ".",
+        regex: bool = True,
+        case_sensitive: bool = True,
+        include: Optional[List[str]] = None,
+        max_results: int = 100,
+        max_per_file: int = 20
+    ) -> Dict[str, Any]:
+        """search file contents under a directory (honoring .gitignore) using an incrementally refreshed trigram index. query is a python regex unless regex is false; include is an optional list of file globs. returns matches with line numbers, files with the most matches first"""
+        try:
+            root = Path(directory).expanduser().resolve()
+            if not root.is_dir():
+                return {
+                    "success": False,
+                    "error": f"not a directory: {directory}"
+                }
+            
+            flags = 0 if case_sensitive else re.IGNORECASE
+            source = query if regex else re.escape(query)
+            pattern = re.compile(source.encode("utf-8"), flags | re.MULTILINE)
+            literals = _required_literals(query, regex)
+            if not case_sensitive:
+                # the index folds ascii case only
+                literals = [literal for literal in literals if literal.isascii()]
+            # the index runs off the loop: a first refresh of a big tree
+            # reads every file
+            return await asyncio.to_thread(
+                self._search, root, pattern, literals, include or [],
+                max(1, max_results), max(1, max_per_file)
+            )
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
     @staticmethod
-    def list_directory(directory: str = ".") -> Dict[str, Any]:
-        """list contents of a directory"""
+    def _search(
+        root: Path,
+        pattern,
+        literals: List[str],
+        include: List[str],
+        max_results: int,
+        max_per_file: int
+    ) -> Dict[str, Any]:
+        """refresh the index, then verify candidates with the real pattern"""
+        index = TrigramIndex.open(root)
+        refreshed = index.refresh()
+        candidates, skipped = index.candidates(literals)
+        if include:
+            candidates = [
+                path for path in candidates
+                if any(fnmatch.fnmatch(path, g) or fnmatch.fnmatch(os.path.basename(path), g) for g in include)
+            ]
+        
+        per_file = []
+        for rel_path in candidates:
+            try:
+                with open(root / rel_path, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+                        # large files, unindexed ones included, are scanned in place
+                        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        view = contextlib.nullcontext(f.read())
+            except (OSError, ValueError):
+                continue
+            hits = []
+            total = 0
+            line = 1
+            last = 0
+            with view as data:
+                for match in pattern.finditer(data):
+                    total += 1
+                    if len(hits) >= max_per_file:
+                        continue
+                    # sliced: an mmap has no count()
+                    line += data[last:match.start()].count(b"\n")
+                    last = match.start()
+                    start = data.rfind(b"\n", 0, match.start()) + 1
+                    end = data.find(b"\n", match.start())
+                    text = data[start:end if end != -1 else len(data)]
+                    hits.append({
+                        "path": rel_path,
+                        "line": line,
+                        "text": text[:200].decode("utf-8", errors="replace")
+                    })
+            if total:
+                per_file.append((total, rel_path, hits))
+        
+        per_file.sort(key=lambda entry: (-entry[0], entry[1]))
+        matches = [hit for _, _, hits in per_file for hit in hits]
+        total_matches = sum(total for total, _, _ in per_file)
+        return {
+            "success": True,
+            "path": str(root),
+            "matches": matches[:max_results],
+            "total_matches": total_matches,
+            "files_matched": len(per_file),
+            "candidates": len(candidates),
+            "truncated": total_matches > min(len(matches), max_results),
+            "skipped_files": skipped,
+            "index": refreshed
+        }
+    
+    def list_directory(
+        self,
+        directory: str = ".",
+        max_depth: int = 1,
+        include: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        respect_gitignore: bool = True,
+        cursor: Optional[str] = None,
+        limit: int = 500,
+        format: str = "json"
+    ) -> Dict[str, Any]:
+        """list contents of a directory. max_depth > 1 recurses (0 = unlimited); include/exclude are glob lists (include filters files, exclude prunes both); .gitignore is honored unless respect_gitignore is false. results are paged: pass the returned next_cursor to continue. format="tree" returns a compact indented tree instead of items"""
         try:
             path = Path(directory).expanduser().resolve()
             
@@ -148,18 +1637,327 @@ class LocalTools:
                     "error": f"not a directory: {directory}"
                 }
             
-            items = []
-            for item in path.iterdir():
-                items.append({
-                    "name": item.name,
-                    "type": "directory" if item.is_dir() else "file",
-                    "size": item.stat().st_size if item.is_file() else None
-                })
+            if format not in ("json", "tree"):
+                return {
+                    "success": False,
+                    "error": f"format must be 'json' or 'tree', got {format!r}"
+                }
+            
+            start = int(cursor) if cursor else 0
+            limit = max(1, limit)
+            walk = _walk_directory(
+                path, max_depth, include or [], exclude or [], respect_gitignore, self.cache
+            )
+            items = list(itertools.islice(walk, start, start + limit + 1))
+            next_cursor = str(start + limit) if len(items) > limit else None
+            items = items[:limit]
+            
+            result: Dict[str, Any] = {
+                "success": True,
+                "path": str(path)
+            }
+            if format == "tree":
+                result["tree"] = "\n".join(
+                    "  " * (item["path"].count("/"))
+                    + item["name"]
+                    + ("/" if item["type"] == "directory" else "")
+                    for item in items
+                )
+                result["count"] = len(items)
+            else:
+                result["items"] = items
+            if next_cursor is not None:
+                result["next_cursor"] = next_cursor
+            return result
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+
+class ToolDispatcher:
+    """runs tool calls concurrently, within per-tool limits
+
+    blocking tools go to a bounded thread pool instead of stalling the event
+    loop, so the independent calls of a model turn, which the sdk already
+    gathers, overlap. write_file and edit_file are serialized per path.
+    """
+    
+    # concurrent calls allowed per tool; tools not listed are unbounded
+    LIMITS = {
+        "read_file": 8,
+        "read_output": 8,
+        "list_directory": 4,
+        "search": 2,
+        "write_file": 4,
+        "edit_file": 4,
+    }
+    WRITE_TOOLS = ("write_file", "edit_file")
+    
+    def __init__(self, max_workers: int = 8):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vibeos-tool")
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.LIMITS.items()}
+        # resolved path -> (lock, calls holding or waiting for it)
+        self.path_locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+    
+    def close(self):
+        self.pool.shutdown(wait=False)
+    
+    @contextlib.asynccontextmanager
+    async def _path_lock(self, file_path: str):
+        """hold the lock of one path, dropping it once nobody needs it"""
+        key = os.path.realpath(os.path.expanduser(file_path))
+        lock, users = self.path_locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.path_locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.path_locks[key]
+            if users == 1:
+                del self.path_locks[key]
+            else:
+                self.path_locks[key] = (lock, users - 1)
+    
+    async def call(self, tool: Callable, *args, **kwargs) -> Any:
+        """one tool call under its limit, off the loop if it blocks"""
+        name = tool.__name__
+        started = time.perf_counter()
+        try:
+            return await self._call(name, tool, *args, **kwargs)
+        finally:
+            # queueing for a semaphore or path lock counts toward latency
+            seconds = time.perf_counter() - started
+            metrics = _run_metrics.get()
+            if metrics is not None:
+                metrics.tool_call(name, seconds)
+            else:
+                METRICS.observe("tool_call_seconds", "latency of one tool call", seconds, tool=name)
+    
+    async def _call(self, name: str, tool: Callable, *args, **kwargs) -> Any:
+        async with contextlib.AsyncExitStack() as stack:
+            if name in self.semaphores:
+                await stack.enter_async_context(self.semaphores[name])
+            file_path = kwargs.get("file_path", args[0] if args else None)
+            if name in self.WRITE_TOOLS and isinstance(file_path, str):
+                # without a path the tool reports the error itself
+                await stack.enter_async_context(self._path_lock(file_path))
             
+            if asyncio.iscoroutinefunction(tool):
+                return await tool(*args, **kwargs)
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, functools.partial(context.run, tool, *args, **kwargs)
+            )
+    
+    def wrap(self, tool: Callable) -> Callable:
+        """tool as an async function that goes through call()"""
+        @functools.wraps(tool)
+        async def wrapper(*args, **kwargs):
+            return await self.call(tool, *args, **kwargs)
+        return wrapper
+
+
+def _estimate_tokens(text: str) -> int:
+    """rough token count, about 4 bytes per token; no tokenizer needed"""
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+# tool results of the run on the current task, kept for the session history
+_tool_results: contextvars.ContextVar[Optional[List[Tuple[str, Any]]]] = contextvars.ContextVar(
+    "tool_results", default=None
+)
+
+
+def _recorded(tool: Callable) -> Callable:
+    """wrap a tool so its results land in the current run's _tool_results"""
+    def record(result: Any) -> Any:
+        results = _tool_results.get()
+        if results is not None:
+            results.append((tool.__name__, result))
+        return result
+    
+    if asyncio.iscoroutinefunction(tool):
+        @functools.wraps(tool)
+        async def wrapper(*args, **kwargs):
+            return record(await tool(*args, **kwargs))
+    else:
+        @functools.wraps(tool)
+        def wrapper(*args, **kwargs):
+            return record(tool(*args, **kwargs))
+    return wrapper
+
+
+class ConversationStore:
+    """chat history per session in sqlite, sent to the model as a bounded window
+
+    the newest turns go out verbatim while they fit the token budget; older
+    ones are folded into a running extractive summary, itself capped at a
+    quarter of the budget. tool results over INLINE_TOOL_BYTES stay in the
+    store and the history only carries a reference that recall() resolves,
+    so the prompt stays roughly the same size however long the chat gets.
+    """
+    
+    INLINE_TOOL_BYTES = 512
+    SUMMARY_LINE_CHARS = 200
+    MAX_AGE_SECONDS = 30 * 24 * 3600
+    _shared: Optional["ConversationStore"] = None
+    
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            cache_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "vibeos"
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            path = str(cache_dir / "conversations.sqlite")
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "session_id TEXT, seq INTEGER, role TEXT, content TEXT, tokens INTEGER, "
+            "created REAL, PRIMARY KEY (session_id, seq));"
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "session_id TEXT PRIMARY KEY, upto INTEGER, content TEXT);"
+            "CREATE TABLE IF NOT EXISTS tool_results ("
+            "ref TEXT PRIMARY KEY, session_id TEXT, tool TEXT, content TEXT);"
+        )
+        self.lock = threading.Lock()
+        self._prune()
+    
+    @classmethod
+    def open(cls) -> "ConversationStore":
+        """shared store, kept open for the life of the process"""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+    
+    def _prune(self):
+        """forget sessions nobody has written to in MAX_AGE_SECONDS"""
+        with self.lock:
+            stale = [
+                row[0] for row in self.db.execute(
+                    "SELECT session_id FROM turns GROUP BY session_id HAVING MAX(created) < ?",
+                    (time.time() - self.MAX_AGE_SECONDS,)
+                )
+            ]
+            for table in ("turns", "summaries", "tool_results"):
+                self.db.executemany(
+                    f"DELETE FROM {table} WHERE session_id = ?", [(s,) for s in stale]
+                )
+            self.db.commit()
+    
+    def _summary_line(self, role: str, content: str) -> str:
+        """one clipped line standing in for a compacted turn"""
+        text = " ".join(content.split())
+        if len(text) > self.SUMMARY_LINE_CHARS:
+            text = text[:self.SUMMARY_LINE_CHARS] + "..."
+        return f"{role}: {text}"
+    
+    def window(self, session_id: str, message: str, budget: int) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+        """messages to send with a new user message, compacting what doesn't fit"""
+        summary_budget = budget // 4
+        with self.lock:
+            row = self.db.execute(
+                "SELECT upto, content FROM summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            upto, summary = row if row else (-1, "")
+            turns = self.db.execute(
+                "SELECT seq, role, content, tokens FROM turns "
+                "WHERE session_id = ? AND seq > ? ORDER BY seq",
+                (session_id, upto)
+            ).fetchall()
+            
+            # newest turns first, as many as fit next to the new message
+            room = budget - summary_budget - _estimate_tokens(message)
+            keep = len(turns)
+            while keep > 0 and turns[keep - 1][3] <= room:
+                keep -= 1
+                room -= turns[keep][3]
+            
+            compacted = turns[:keep]
+            if compacted:
+                lines = summary.splitlines() if summary else []
+                lines += [self._summary_line(role, content) for _, role, content, _ in compacted]
+                # drop the oldest lines once the summary outgrows its share
+                while len(lines) > 1 and _estimate_tokens("\n".join(lines)) > summary_budget:
+                    lines.pop(0)
+                summary = "\n".join(lines)
+                upto = compacted[-1][0]
+                self.db.execute(
+                    "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+                    (session_id, upto, summary)
+                )
+                self.db.commit()
+        
+        messages = []
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": "summary of the earlier conversation:\n" + summary
+            })
+        messages += [{"role": role, "content": content} for _, role, content, _ in turns[keep:]]
+        messages.append({"role": "user", "content": message})
+        return messages, {
+            "turns_sent": len(turns) - keep,
+            "turns_compacted": len(compacted),
+            "tokens_sent": sum(_estimate_tokens(m["content"]) for m in messages)
+        }
+    
+    def _tool_note(self, session_id: str, tool: str, result: Any) -> str:
+        """a tool result as it appears in the history: inline or by reference"""
+        text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+        size = len(text.encode("utf-8"))
+        if size <= self.INLINE_TOOL_BYTES:
+            return f"[{tool} -> {text}]"
+        
+        ref = uuid.uuid4().hex[:12]
+        self.db.execute(
+            "INSERT INTO tool_results VALUES (?, ?, ?, ?)", (ref, session_id, tool, text)
+        )
+        first_line = text.strip().split("\n", 1)[0][:self.SUMMARY_LINE_CHARS]
+        return f"[{tool} -> {size} bytes stored as {ref}, starts: {first_line} ... use recall(\"{ref}\")]"
+    
+    def record(self, session_id: str, message: str, reply: str, tool_results: List[Tuple[str, Any]]):
+        """append one user turn and the assistant turn that answered it"""
+        with self.lock:
+            notes = [self._tool_note(session_id, tool, result) for tool, result in tool_results]
+            answer = "\n".join(notes + [reply]) if notes else reply
+            (seq,) = self.db.execute(
+                "SELECT COALESCE(MAX(seq), -1) FROM turns WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            now = time.time()
+            self.db.executemany(
+                "INSERT INTO turns VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, seq + 1, "user", message, _estimate_tokens(message), now),
+                    (session_id, seq + 2, "assistant", answer, _estimate_tokens(answer), now)
+                ]
+            )
+            self.db.commit()
+    
+    def recall(self, ref: str, offset: int = 0, length: int = 16384) -> Dict[str, Any]:
+        """read a tool result from earlier in the chat by its reference"""
+        try:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT tool, content FROM tool_results WHERE ref = ?", (ref,)
+                ).fetchone()
+            if row is None:
+                return {
+                    "success": False,
+                    "error": f"unknown reference: {ref}"
+                }
+            
+            tool, text = row
+            offset = max(0, offset)
+            content = text[offset:offset + max(0, length)]
             return {
                 "success": True,
-                "path": str(path),
-                "items": items
+                "tool": tool,
+                "content": content,
+                "offset": offset,
+                "length": len(content),
+                "total_chars": len(text),
+                "eof": offset + len(content) >= len(text)
             }
         except Exception as e:
             return {
@@ -168,117 +1966,922 @@ class LocalTools:
             }
 
 
+class ResponseCache:
+    """opt-in cache of final model responses in sqlite, with ttl and lru eviction
+
+    keyed on a hash of the model, the whitespace-normalized input (or history
+    window), the tool schemas and the mcp server list. rows past their ttl
+    are dropped on read; past max_bytes the least recently used rows go.
+    """
+    
+    _shared: Optional["ResponseCache"] = None
+    
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 64 * 1024 * 1024):
+        if path is None:
+            cache_dir = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "vibeos"
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            path = str(cache_dir / "responses.sqlite")
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, content TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def open(cls) -> "ResponseCache":
+        """shared cache, kept open for the life of the process"""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+    
+    @staticmethod
+    def key(model: Any, run_input: Dict[str, Any], mcp_servers: List[str]) -> str:
+        """hash of everything that decides the response"""
+        def normalize(text: Any) -> str:
+            return " ".join(str(text).split())
+        
+        if "messages" in run_input:
+            prompt = [[m["role"], normalize(m["content"])] for m in run_input["messages"]]
+        else:
+            prompt = normalize(run_input["input"])
+        tools = sorted(
+            [tool.__name__, str(inspect.signature(tool)), tool.__doc__ or ""]
+            for tool in run_input["tools"]
+        )
+        material = json.dumps(
+            [model, prompt, tools, sorted(mcp_servers)],
+            ensure_ascii=False, separators=(",", ":")
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT content, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - ttl:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+        return row[0]
+    
+    def put(self, key: str, content: str):
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now, now)
+            )
+            (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            if total > self.max_bytes:
+                # least recently used first, until back under the limit
+                doomed = []
+                for old_key, old_size in self.db.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed"
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    doomed.append((old_key,))
+                    total -= old_size
+                self.db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+            self.db.commit()
+
+
+class DedalusClientPool:
+    """the api client behind every run, kept warm between runs
+
+    mcp servers named in a run are connected, and their tools listed, by the
+    dedalus api itself, so those sessions can't be held from here. what the
+    runner owns is the https connection every run goes through: the pooled
+    client keeps it open for keepalive_expiry between runs, is rebuilt after
+    a connection failure, and is closed once idle for idle_timeout.
+    """
+    
+    def __init__(self, api_key: str, idle_timeout: float = 600, keepalive_expiry: float = 120):
+        self.api_key = api_key
+        self.idle_timeout = idle_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.client: Optional[AsyncDedalus] = None
+        self.runner: Optional[DedalusRunner] = None
+        # client -> runs still using it; a replaced client closes at zero
+        self.active: Dict[int, Tuple[AsyncDedalus, int]] = {}
+        self.last_used = 0.0
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.created = 0
+        self.reconnects = 0
+        self.idle_closes = 0
+    
+    def _new_client(self) -> AsyncDedalus:
+        options: Dict[str, Any] = {"api_key": self.api_key}
+        if os.getenv("DEDALUS_BASE_URL"):
+            # e.g. the stand-in server of scripts/bench-dedalus-runner.py
+            options["base_url"] = os.getenv("DEDALUS_BASE_URL")
+        if httpx is None:
+            return AsyncDedalus(**options)
+        # the sdk default drops idle connections after a few seconds, which
+        # makes nearly every chat turn pay a fresh tls handshake
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            timeout=httpx.Timeout(600, connect=10)
+        )
+        return AsyncDedalus(**options, http_client=http_client)
+    
+    def acquire(self) -> Tuple[AsyncDedalus, DedalusRunner]:
+        """the warm client and runner, building them if there are none"""
+        if self.client is None:
+            self.client = self._new_client()
+            self.runner = DedalusRunner(self.client)
+            self.created += 1
+        client, users = self.active.get(id(self.client), (self.client, 0))
+        self.active[id(client)] = (client, users + 1)
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        return self.client, self.runner
+    
+    async def release(self, client: AsyncDedalus, error: Optional[BaseException] = None):
+        """end one run; a connection failure retires the client it used"""
+        if error is not None and self._is_connection_error(error) and client is self.client:
+            self.client = self.runner = None
+            self.reconnects += 1
+        
+        client, users = self.active[id(client)]
+        if users > 1:
+            self.active[id(client)] = (client, users - 1)
+        else:
+            del self.active[id(client)]
+            if client is not self.client:
+                await self._close_client(client)
+        
+        self.last_used = time.monotonic()
+        if not self.active and self.client is not None and self.idle_timeout:
+            loop = asyncio.get_running_loop()
+            self.idle_timer = loop.call_later(
+                self.idle_timeout, lambda: loop.create_task(self._evict_idle())
+            )
+    
+    @staticmethod
+    def _is_connection_error(error: BaseException) -> bool:
+        """transport failures, as opposed to the api rejecting a request"""
+        if isinstance(error, (ConnectionError, asyncio.TimeoutError)):
+            return True
+        # APIConnectionError / APITimeoutError from the sdk, without importing
+        # its private exception module
+        return any(cls.__name__ in ("APIConnectionError", "APITimeoutError") for cls in type(error).__mro__)
+    
+    async def _evict_idle(self):
+        """close the client if nothing used it for idle_timeout"""
+        self.idle_timer = None
+        if self.active or self.client is None:
+            return
+        if time.monotonic() - self.last_used < self.idle_timeout:
+            return
+        client, self.client, self.runner = self.client, None, None
+        self.idle_closes += 1
+        await self._close_client(client)
+    
+    @staticmethod
+    async def _close_client(client: AsyncDedalus):
+        close = getattr(client, "close", None)
+        if close is None:
+            return
+        with contextlib.suppress(Exception):
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+    
+    async def close(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        clients = {id(client): client for client, _ in self.active.values()}
+        if self.client is not None:
+            clients[id(self.client)] = self.client
+        self.client = self.runner = None
+        self.active.clear()
+        for client in clients.values():
+            await self._close_client(client)
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "clients_created": self.created,
+            "reconnects": self.reconnects,
+            "idle_closes": self.idle_closes
+        }
+
+
 class DedalusStreamRunner:
     """runner for dedalus with streaming support"""
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, max_sessions: int = 32):
         self.api_key = api_key or os.getenv("DEDALUS_API_KEY")
         if not self.api_key:
             raise ValueError("dedalus api key required")
         
-        self.client = AsyncDedalus(api_key=self.api_key)
-        self.runner = DedalusRunner(self.client)
-        self.local_tools = LocalTools()
+        self.clients = DedalusClientPool(self.api_key)
+        # per chat session, so a daemon keeps each chat's shell apart
+        self.sessions: "OrderedDict[str, LocalTools]" = OrderedDict()
+        self.max_sessions = max_sessions
+        # opened on the first request with a session_id / cache_ttl
+        self.history: Optional[ConversationStore] = None
+        self.responses: Optional[ResponseCache] = None
+        # shared by every session, so write locks hold across sessions too
+        self.dispatcher = ToolDispatcher()
+    
+    async def _acquire_tools(
+        self,
+        session_id: Optional[str],
+        tool_options: Optional[Dict[str, Any]] = None
+    ) -> LocalTools:
+        """local tools of a chat session, or fresh ones for a one-off run
+
+        tool_options (e.g. max_output_bytes) only apply when the tools are
+        created; a session keeps the options of its first run.
+        """
+        if session_id is None:
+            return LocalTools(**(tool_options or {}))
+        
+        local_tools = self.sessions.pop(session_id, None) or LocalTools(**(tool_options or {}))
+        self.sessions[session_id] = local_tools
+        while len(self.sessions) > self.max_sessions:
+            _, evicted = self.sessions.popitem(last=False)
+            await evicted.close()
+        return local_tools
+    
+    async def _release_tools(self, session_id: Optional[str], local_tools: LocalTools):
+        """close tools that belong to a single run"""
+        if session_id is None:
+            await local_tools.close()
+    
+    async def close(self):
+        """close every session's tools"""
+        while self.sessions:
+            _, local_tools = self.sessions.popitem()
+            await local_tools.close()
+        self.dispatcher.close()
+        await self.clients.close()
     
-    def _create_local_tools(self) -> List[Any]:
+    def _create_local_tools(self, local_tools: LocalTools) -> List[Any]:
         """create local tool definitions for dedalus"""
-        return [
-            self.local_tools.bash,
-            self.local_tools.read_file,
-            self.local_tools.edit_file,
-            self.local_tools.write_file,
-            self.local_tools.list_directory
+        tools = [
+            local_tools.bash,
+            local_tools.read_output,
+            local_tools.read_file,
+            local_tools.edit_file,
+            local_tools.write_file,
+            local_tools.list_directory,
+            local_tools.search
         ]
+        return [self.dispatcher.wrap(tool) for tool in tools]
+    
+    def _prepare_run(
+        self,
+        input_text: str,
+        local_tools: LocalTools,
+        use_local_tools: bool,
+        session_id: Optional[str],
+        history_tokens: int,
+        cache_ttl: Optional[float]
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, int]]]:
+        """tools and input for one run, with the session's history window if any"""
+        tools = self._create_local_tools(local_tools) if use_local_tools else []
+        if session_id is not None or cache_ttl:
+            # the history keeps tool results, and the response cache must
+            # know whether any tool ran
+            _tool_results.set([])
+            tools = [_recorded(tool) for tool in tools]
+        if session_id is None:
+            return {"input": input_text, "tools": tools}, None
+        
+        if self.history is None:
+            self.history = ConversationStore.open()
+        messages, stats = self.history.window(session_id, input_text, history_tokens)
+        return {"messages": messages, "tools": tools + [self.history.recall]}, stats
+    
+    def _remember(self, session_id: Optional[str], input_text: str, reply: str):
+        """store a finished turn, with the tool results it produced"""
+        if session_id is not None:
+            self.history.record(session_id, input_text, reply, _tool_results.get() or [])
+    
+    def _cached_response(
+        self,
+        cache_ttl: Optional[float],
+        model: Any,
+        run_input: Dict[str, Any],
+        mcp_servers: List[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """(cache key, cached response) of a run; both None with the cache off"""
+        if not cache_ttl:
+            return None, None
+        if self.responses is None:
+            self.responses = ResponseCache.open()
+        key = ResponseCache.key(model, run_input, mcp_servers)
+        return key, self.responses.get(key, cache_ttl)
+    
+    def _store_response(self, key: Optional[str], content: str):
+        """cache a fresh response, unless it came out of tool calls
+        
+        replaying a run that used local tools would skip their side effects
+        (files written, commands run), so those responses are never stored.
+        """
+        if key is not None and not _tool_results.get():
+            self.responses.put(key, content)
     
     async def run_streaming(
         self,
         input_text: str,
         model: str = "openai/gpt-4o-mini",
         mcp_servers: Optional[List[str]] = None,
-        use_local_tools: bool = True
-    ):
-        """run dedalus with streaming output"""
+        use_local_tools: bool = True,
+        session_id: Optional[str] = None,
+        tool_options: Optional[Dict[str, Any]] = None,
+        coalesce_bytes: int = 4096,
+        coalesce_ms: float = 15,
+        history_tokens: int = 8000,
+        cache_ttl: Optional[float] = None
+    ) -> bool:
+        """run dedalus with streaming output, returns false on error"""
+        
+        coalescer = ChunkCoalescer(coalesce_bytes, coalesce_ms / 1000)
+        _coalescer.set(coalescer)
+        metrics = runner_metrics.RunMetrics(METRICS)
+        _run_metrics.set(metrics)
         
         # prepare tools
-        tools = self._create_local_tools() if use_local_tools else []
+        local_tools = await self._acquire_tools(session_id, tool_options)
         
         # prepare mcp servers
         mcp_servers = mcp_servers or []
         
         try:
-            # create streaming response
-            response = await self.runner.run(
-                input=input_text,
-                model=model,
-                tools=tools,
-                mcp_servers=mcp_servers,
-                stream=True
+            run_input, history = self._prepare_run(
+                input_text, local_tools, use_local_tools, session_id, history_tokens, cache_ttl
             )
+            cache_key, cached = self._cached_response(cache_ttl, model, run_input, mcp_servers)
             
-            # stream output to stdout for node.js to capture
-            async for chunk in stream_async(response):
-                # output json lines for easy parsing
-                output = {
-                    "type": "chunk",
-                    "content": chunk
-                }
-                print(json.dumps(output), flush=True)
+            if cached is not None:
+                # replay the cached text as ordinary chunk events; with
+                # coalescing off (coalesce_bytes <= 0) in 4 KiB slices
+                step = coalesce_bytes if coalesce_bytes > 0 else 4096
+                for start in range(0, len(cached), step):
+                    metrics.chunk(cached[start:start + step])
+                    coalescer.add(cached[start:start + step])
+                reply = [cached]
+            else:
+                client, runner = self.clients.acquire()
+                error = None
+                try:
+                    # create streaming response
+                    response = runner.run(
+                        **run_input,
+                        model=model,
+                        mcp_servers=mcp_servers,
+                        stream=True
+                    )
+                    
+                    # stream output to stdout for node.js to capture,
+                    # coalescing token-sized chunks into fewer lines
+                    reply = []
+                    async for chunk in _stream_text(response):
+                        metrics.chunk(chunk)
+                        reply.append(chunk)
+                        coalescer.add(chunk)
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    await self.clients.release(client, error)
+                self._store_response(cache_key, "".join(reply))
             
-            # send completion signal
-            print(json.dumps({
+            # send completion signal; cache counters are cumulative for the
+            # chat session if there is one
+            coalescer.flush()
+            self._remember(session_id, input_text, "".join(reply))
+            complete = {
                 "type": "complete",
-                "status": "success"
-            }), flush=True)
+                "status": "success",
+                "cached": cached is not None,
+                "tool_cache": local_tools.cache_stats(),
+                "stream_stats": coalescer.stats()
+            }
+            if history is not None:
+                complete["history"] = history
+            # metrics go first so complete stays the last event of a run
+            emit(metrics.finish("success"))
+            emit(complete)
+            return True
             
+        except asyncio.CancelledError:
+            # a cancel request or SIGTERM; text already streamed stays sent
+            emit(metrics.finish("cancelled"))
+            emit({"type": "cancelled"})
+            raise
         except Exception as e:
-            # send error
-            print(json.dumps({
-                "type": "error",
-                "error": str(e)
-            }), flush=True)
-            sys.exit(1)
+            # send error, after whatever text made it out
+            emit(metrics.finish("error"))
+            emit(_error_event(e))
+            return False
+        finally:
+            coalescer.flush()
+            _coalescer.set(None)
+            _run_metrics.set(None)
+            await self._release_tools(session_id, local_tools)
     
     async def run_sync(
         self,
         input_text: str,
         model: str = "openai/gpt-4o-mini",
         mcp_servers: Optional[List[str]] = None,
-        use_local_tools: bool = True
-    ):
-        """run dedalus synchronously"""
+        use_local_tools: bool = True,
+        session_id: Optional[str] = None,
+        tool_options: Optional[Dict[str, Any]] = None,
+        history_tokens: int = 8000,
+        cache_ttl: Optional[float] = None
+    ) -> bool:
+        """run dedalus synchronously, returns false on error"""
+        
+        metrics = runner_metrics.RunMetrics(METRICS)
+        _run_metrics.set(metrics)
         
         # prepare tools
-        tools = self._create_local_tools() if use_local_tools else []
+        local_tools = await self._acquire_tools(session_id, tool_options)
         
         # prepare mcp servers
         mcp_servers = mcp_servers or []
         
         try:
-            result = await self.runner.run(
-                input=input_text,
-                model=model,
-                tools=tools,
-                mcp_servers=mcp_servers,
-                stream=False
+            run_input, history = self._prepare_run(
+                input_text, local_tools, use_local_tools, session_id, history_tokens, cache_ttl
             )
+            cache_key, content = self._cached_response(cache_ttl, model, run_input, mcp_servers)
+            cached = content is not None
+            
+            if not cached:
+                client, runner = self.clients.acquire()
+                error = None
+                try:
+                    result = await runner.run(
+                        **run_input,
+                        model=model,
+                        mcp_servers=mcp_servers,
+                        stream=False
+                    )
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    await self.clients.release(client, error)
+                content = result.final_output
+                self._store_response(cache_key, str(content))
             
             # output result
-            print(json.dumps({
+            self._remember(session_id, input_text, str(content))
+            complete = {
                 "type": "complete",
-                "content": result.final_output,
-                "status": "success"
-            }), flush=True)
+                "content": content,
+                "status": "success",
+                "cached": cached,
+                "tool_cache": local_tools.cache_stats()
+            }
+            if history is not None:
+                complete["history"] = history
+            emit(metrics.finish("success"))
+            emit(complete)
+            return True
             
+        except asyncio.CancelledError:
+            # a cancel request or SIGTERM; text already streamed stays sent
+            emit(metrics.finish("cancelled"))
+            emit({"type": "cancelled"})
+            raise
         except Exception as e:
-            print(json.dumps({
-                "type": "error",
-                "error": str(e)
-            }), flush=True)
-            sys.exit(1)
+            emit(metrics.finish("error"))
+            emit(_error_event(e))
+            return False
+        finally:
+            _run_metrics.set(None)
+            await self._release_tools(session_id, local_tools)
+
+
+async def run_config(runner: DedalusStreamRunner, config: Dict[str, Any]) -> bool:
+    """run one request config in streaming or sync mode"""
+    kwargs = {
+        "input_text": config["input"],
+        "model": config.get("model", "openai/gpt-4o-mini"),
+        "mcp_servers": config.get("mcp_servers", []),
+        "use_local_tools": config.get("use_local_tools", True),
+        "session_id": config.get("session_id"),
+        "tool_options": config.get("tool_options"),
+        "history_tokens": config.get("history_tokens", 8000),
+        # seconds a cached response stays valid; the cache is off without it
+        "cache_ttl": config.get("cache_ttl"),
+    }
+    if config.get("stream", True):
+        return await runner.run_streaming(
+            **kwargs,
+            coalesce_bytes=config.get("coalesce_bytes", 4096),
+            coalesce_ms=config.get("coalesce_ms", 15)
+        )
+    return await runner.run_sync(**kwargs)
+
+
+class RatePacer:
+    """spaces request starts to at most rate per second, backing off on 429s
+
+    a rate limit halves the rate (down to a tenth of the configured one) and
+    pauses every start for the backoff delay; each success wins back 10%.
+    without a configured rate only the pauses apply.
+    """
+    
+    def __init__(self, rate: Optional[float]):
+        self.max_rate = rate
+        self.rate = rate
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def wait(self):
+        async with self.lock:
+            delay = self.next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            interval = 1 / self.rate if self.rate else 0
+            self.next_start = max(self.next_start, time.monotonic()) + interval
+    
+    def backoff(self, delay: float):
+        if self.rate:
+            self.rate = max(self.max_rate / 10, self.rate / 2)
+        self.next_start = max(self.next_start, time.monotonic() + delay)
+    
+    def recover(self):
+        if self.rate:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+# the sdk's "Error code: 429 - ..." or a rate limit in words, for errors
+# that reach a run without their status code (e.g. through an mcp server)
+_RATE_LIMITED = re.compile(r"\berror code: 429\b|\brate[ _-]?limit|\btoo many requests\b", re.IGNORECASE)
+
+
+def _is_rate_limit(error: Dict[str, Any]) -> bool:
+    """whether a run's error event is the api pushing back"""
+    if error.get("status_code") == 429:
+        return True
+    return bool(_RATE_LIMITED.search(str(error.get("error", ""))))
+
+
+async def run_batch(
+    runner: DedalusStreamRunner,
+    source: str,
+    concurrency: int = 8,
+    rate: Optional[float] = None,
+    checkpoint: Optional[str] = None,
+    max_retries: int = 5,
+    framed: bool = False
+) -> bool:
+    """run every request of a jsonl file ("-" for stdin), returns false if any failed
+    
+    requests default to stream false. each one's events are held until it
+    finishes and then written together, tagged with its "id" (its line number
+    if it has none) and "line". ids that complete are appended to the
+    checkpoint file, and ids already in it are skipped, so a rerun resumes.
+    framed reads request frames instead of lines; "line" then counts frames.
+    """
+    max_retries = max(0, max_retries)
+    done_ids: Set[str] = set()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, encoding="utf-8") as f:
+            done_ids = {line.strip() for line in f if line.strip()}
+    checkpoint_file = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+    
+    pacer = RatePacer(rate)
+    slots = asyncio.Semaphore(concurrency)
+    counts = {"succeeded": 0, "failed": 0, "skipped": 0}
+    tasks: set = set()
+    started = time.monotonic()
+    
+    async def run_one(line_number: int, request: Dict[str, Any]):
+        request_id = str(request.get("id", line_number))
+        request.setdefault("stream", False)
+        _request_id.set(request_id)
+        try:
+            for attempt in range(max_retries + 1):
+                events: List[Dict[str, Any]] = []
+                _sink.set(events.append)
+                await pacer.wait()
+                try:
+                    ok = await run_config(runner, request)
+                except Exception as e:
+                    ok = False
+                    events.append({"id": request_id, "type": "error", "error": f"bad request: {e!r}"})
+                
+                error = events[-1] if events else {}
+                if ok or attempt == max_retries or not _is_rate_limit(error):
+                    break
+                # rate limited: drop this attempt's events and try again later
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                pacer.backoff(delay)
+            
+            for event in events:
+                _stdout.write_event({**event, "line": line_number})
+            if ok:
+                pacer.recover()
+                counts["succeeded"] += 1
+                if checkpoint_file is not None:
+                    checkpoint_file.write(request_id + "\n")
+                    checkpoint_file.flush()
+            else:
+                counts["failed"] += 1
+        finally:
+            slots.release()
+    
+    stream = sys.stdin.buffer if source == "-" else open(source, "rb")
+    loop = asyncio.get_running_loop()
+    line_number = 0
+    try:
+        while True:
+            line = await loop.run_in_executor(None, runner_protocol.read_message, stream, framed)
+            if line is None:
+                break
+            line_number += 1
+            if not line:
+                continue
+            
+            try:
+                request = json.loads(line)
+                error = None
+                if not isinstance(request, dict):
+                    error = f"invalid request: expected a json object, got {type(request).__name__}"
+            except ValueError as e:
+                error = f"invalid json request: {e}"
+            if error is not None:
+                _stdout.write_event({
+                    "id": str(line_number),
+                    "type": "error",
+                    "error": error,
+                    "line": line_number
+                })
+                counts["failed"] += 1
+                continue
+            
+            if str(request.get("id", line_number)) in done_ids:
+                counts["skipped"] += 1
+                continue
+            
+            # a slot before the task, so a huge file never becomes a huge
+            # number of waiting tasks
+            await slots.acquire()
+            task = asyncio.create_task(run_one(line_number, request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+    
+    _stdout.write_event({
+        "type": "batch_complete",
+        **counts,
+        "seconds": round(time.monotonic() - started, 3)
+    })
+    return counts["failed"] == 0
+
+
+async def _handle_request(
+    runner: DedalusStreamRunner,
+    request: Dict[str, Any],
+    sink: Optional[Callable[[Dict[str, Any]], None]]
+):
+    """run one serve-mode request with its id and sink bound to this task"""
+    _request_id.set(str(request.get("id", "")))
+    _sink.set(sink)
+    try:
+        await run_config(runner, request)
+    except asyncio.CancelledError:
+        # the run reported it; this only ends the task quietly
+        pass
+    except Exception as e:
+        # malformed request (e.g. missing "input"); the run never started
+        emit({
+            "type": "error",
+            "error": f"bad request: {e!r}"
+        })
+
+
+async def _serve_requests(
+    runner: DedalusStreamRunner,
+    read_message: Callable[[], Any],
+    sink: Optional[Callable[[Dict[str, Any]], None]]
+):
+    """dispatch json requests (lines or frames) until eof, then drain
+
+    {"type": "cancel", "id": ...} cancels the running request with that id.
+    """
+    # protocol errors go to the same connection as the replies
+    _sink.set(sink)
+    tasks: set = set()
+    running: Dict[str, asyncio.Task] = {}
+    try:
+        while True:
+            message = await read_message()
+            if message is None:
+                break
+            if not message:
+                continue
+            
+            try:
+                request = json.loads(message)
+            except ValueError as e:
+                emit({
+                    "type": "error",
+                    "error": f"invalid json request: {e}"
+                })
+                continue
+            if not isinstance(request, dict):
+                emit({
+                    "type": "error",
+                    "error": f"invalid request: expected a json object, got {type(request).__name__}"
+                })
+                continue
+            
+            request_id = str(request.get("id", ""))
+            if request.get("type") == "cancel":
+                task = running.get(request_id)
+                if task is not None:
+                    task.cancel()
+                else:
+                    token = _request_id.set(request_id)
+                    emit({
+                        "type": "error",
+                        "error": f"no running request with id {request_id!r}"
+                    })
+                    _request_id.reset(token)
+                continue
+            
+            task = asyncio.create_task(_handle_request(runner, request, sink))
+            tasks.add(task)
+            # with a reused id, cancel reaches the newest request
+            running[request_id] = task
+            
+            def done(task: asyncio.Task, request_id: str = request_id):
+                tasks.discard(task)
+                if running.get(request_id) is task:
+                    del running[request_id]
+            
+            task.add_done_callback(done)
+    except asyncio.CancelledError:
+        # SIGTERM: cancel every run so each reports and cleans up its tools
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def serve(
+    runner: DedalusStreamRunner,
+    socket_path: Optional[str] = None,
+    framed: bool = False,
+    metrics_address: Optional[str] = None
+):
+    """serve requests from stdin, or from a unix socket if a path is given"""
+    
+    if metrics_address is not None:
+        # listens until the process exits
+        await runner_metrics.serve_metrics(METRICS, metrics_address)
+    
+    if socket_path is None:
+        loop = asyncio.get_running_loop()
+        messages: asyncio.Queue = asyncio.Queue()
+        
+        def read_forever():
+            while True:
+                message = runner_protocol.read_message(sys.stdin.buffer, framed)
+                loop.call_soon_threadsafe(messages.put_nowait, message)
+                if message is None:
+                    return
+        
+        # a daemon thread rather than run_in_executor: a read blocked on
+        # stdin must not keep the process alive after SIGTERM
+        threading.Thread(target=read_forever, daemon=True).start()
+        read_stdin = messages.get
+        
+        emit({"type": "ready"})
+        runner_metrics.record_ready(METRICS)
+        await _serve_requests(runner, read_stdin, None)
+        return
+    
+    async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def sink(event: Dict[str, Any]):
+            if not writer.is_closing():
+                writer.write(_stdout.encode(event))
+        
+        async def read_socket():
+            return await runner_protocol.read_message_async(reader, framed)
+        
+        try:
+            await _serve_requests(runner, read_socket, sink)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    # a stale socket file from a previous daemon would make bind fail
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    
+    server = await asyncio.start_unix_server(on_connection, path=socket_path)
+    emit({"type": "ready", "socket": socket_path})
+    runner_metrics.record_ready(METRICS)
+    async with server:
+        await server.serve_forever()
 
 
 async def main():
     """main entry point"""
+    global _stdout
+    
+    # node stops a run by killing the process. as cancellation the run's
+    # shell and its whole process group are cleaned up instead of orphaned
+    # (the shell is in a session of its own, so it outlives a plain kill)
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signum, main_task.cancel)
+    
+    # opt-in length-prefixed frames instead of jsonl, in both directions
+    framed = "--framed" in sys.argv
+    if framed:
+        sys.argv.remove("--framed")
+        _stdout = runner_protocol.FramedWriter(sys.stdout.buffer)
+    
+    # long-lived daemon mode
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        socket_path = None
+        if "--socket" in sys.argv[2:]:
+            socket_path = sys.argv[sys.argv.index("--socket") + 1]
+        metrics_address = None
+        if "--metrics" in sys.argv[2:]:
+            metrics_address = sys.argv[sys.argv.index("--metrics") + 1]
+        
+        runner = DedalusStreamRunner()
+        try:
+            await serve(runner, socket_path, framed, metrics_address)
+        except asyncio.CancelledError:
+            await runner.close()
+            # the stdin reader thread may be blocked in a read, and a normal
+            # interpreter shutdown aborts on its lock; every event is flushed
+            os._exit(0)
+        await runner.close()
+        return
+    
+    # offline jobs: many requests from a jsonl file in one process
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        def option(name: str, default: Any, cast: Callable = str) -> Any:
+            if name in sys.argv[3:]:
+                return cast(sys.argv[sys.argv.index(name) + 1])
+            return default
+        
+        runner = DedalusStreamRunner()
+        try:
+            ok = await run_batch(
+                runner,
+                sys.argv[2] if len(sys.argv) > 2 else "-",
+                concurrency=option("--concurrency", 8, int),
+                rate=option("--rate", None, float),
+                checkpoint=option("--checkpoint", None),
+                max_retries=option("--max-retries", 5, int),
+                framed=framed
+            )
+        except asyncio.CancelledError:
+            await runner.close()
+            # see serve mode: a stdin read may still be blocked
+            os._exit(1)
+        await runner.close()
+        if not ok:
+            sys.exit(1)
+        return
     
     # parse arguments from stdin or command line
     if len(sys.argv) > 1:
@@ -292,8 +2895,14 @@ async def main():
         }
     else:
         # stdin mode for json config
-        config_str = sys.stdin.read()
-        config = json.loads(config_str)
+        if framed:
+            message = runner_protocol.read_message(sys.stdin.buffer, True)
+            if message is None:
+                emit({"type": "error", "error": "no request frame on stdin"})
+                sys.exit(1)
+            config = json.loads(message)
+        else:
+            config = json.loads(sys.stdin.read())
     
     # get api key from env or config
     api_key = config.get("api_key") or os.getenv("DEDALUS_API_KEY")
@@ -302,21 +2911,15 @@ async def main():
     runner = DedalusStreamRunner(api_key=api_key)
     
     # run based on stream mode
-    if config.get("stream", True):
-        await runner.run_streaming(
-            input_text=config["input"],
-            model=config.get("model", "openai/gpt-4o-mini"),
-            mcp_servers=config.get("mcp_servers", []),
-            use_local_tools=config.get("use_local_tools", True)
-        )
-    else:
-        await runner.run_sync(
-            input_text=config["input"],
-            model=config.get("model", "openai/gpt-4o-mini"),
-            mcp_servers=config.get("mcp_servers", []),
-            use_local_tools=config.get("use_local_tools", True)
-        )
+    try:
+        ok = await run_config(runner, config)
+    except asyncio.CancelledError:
+        ok = False
+    finally:
+        await runner.close()
+    if not ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
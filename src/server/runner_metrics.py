@@ -0,0 +1,258 @@
+"""
+latency and throughput metrics shared by the python runners
+
+each run collects a RunMetrics and emits it as one {"type": "metrics"}
+event; the same numbers go into process-wide histograms that a long-lived
+runner serves in prometheus text format with `--metrics HOST:PORT` (or a
+unix socket path).
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# seconds; tool calls and model latencies span ms to minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def process_age() -> Optional[float]:
+    """seconds since this process was started, interpreter startup included"""
+    try:
+        with open("/proc/self/stat") as f:
+            # field 22, after the parenthesised command name
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Histogram:
+    """cumulative-bucket histogram, one series per label set"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # labels -> (bucket counts, sum, count)
+        self.series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        counts, total, count = self.series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.series[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key, le=_number(bound))} {bucket}")
+            lines.append(f"{self.name}_bucket{_labels(key, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class Gauge:
+    """last value per label set"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.series: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_labels(key)} {_number(value)}")
+        return lines
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _labels(key: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Registry:
+    """every metric of one runner process"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics: Dict[str, object] = {}
+        # tool calls may observe from worker threads
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, help_text: str) -> Histogram:
+        name = f"{self.prefix}_{name}"
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, help_text)
+        return self.metrics[name]
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        name = f"{self.prefix}_{name}"
+        if name not in self.metrics:
+            self.metrics[name] = Gauge(name, help_text)
+        return self.metrics[name]
+
+    def observe(self, name: str, help_text: str, value: float, **labels: str):
+        with self.lock:
+            self.histogram(name, help_text).observe(value, **labels)
+
+    def set(self, name: str, help_text: str, value: float, **labels: str):
+        with self.lock:
+            self.gauge(name, help_text).set(value, **labels)
+
+    def render(self) -> str:
+        """prometheus text exposition format, version 0.0.4"""
+        with self.lock:
+            lines = []
+            for name in sorted(self.metrics):
+                lines += self.metrics[name].render()
+        return "\n".join(lines) + "\n"
+
+
+class RunMetrics:
+    """timings of one run, for its metrics event and the registry"""
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.started = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        self.last_chunk: Optional[float] = None
+        self.chunks = 0
+        self.bytes = 0
+        # (name, seconds) per tool call or browser step
+        self.tools: List[Tuple[str, float]] = []
+        self.steps: List[float] = []
+        # resource type -> requests a browser blocking profile failed
+        self.blocked: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def chunk(self, text: str):
+        now = time.perf_counter()
+        if self.first_chunk is None:
+            self.first_chunk = now
+            self.registry.observe(
+                "time_to_first_chunk_seconds", "run start to first model output", now - self.started
+            )
+        self.last_chunk = now
+        self.chunks += 1
+        self.bytes += len(text.encode("utf-8"))
+
+    def tool_call(self, name: str, seconds: float):
+        with self.lock:
+            self.tools.append((name, seconds))
+        self.registry.observe("tool_call_seconds", "latency of one tool call", seconds, tool=name)
+
+    def step(self, seconds: float):
+        self.steps.append(seconds)
+        self.registry.observe("step_seconds", "latency of one browser agent step", seconds)
+
+    def block(self, resource_type: str):
+        with self.lock:
+            self.blocked[resource_type] = self.blocked.get(resource_type, 0) + 1
+
+    def finish(self, status: str) -> Dict[str, object]:
+        """the run's metrics event; also records its totals"""
+        elapsed = time.perf_counter() - self.started
+        self.registry.observe("run_seconds", "wall time of one run", elapsed, status=status)
+        event: Dict[str, object] = {
+            "type": "metrics",
+            "status": status,
+            "run_seconds": round(elapsed, 6)
+        }
+
+        if self.first_chunk is not None:
+            streaming = max(self.last_chunk - self.first_chunk, 1e-6)
+            event["time_to_first_chunk_seconds"] = round(self.first_chunk - self.started, 6)
+            event["chunks"] = self.chunks
+            event["bytes"] = self.bytes
+            if self.chunks > 1:
+                event["chunks_per_second"] = round(self.chunks / streaming, 2)
+                event["bytes_per_second"] = round(self.bytes / streaming, 2)
+                self.registry.observe(
+                    "stream_bytes_per_second", "model output throughput of one run",
+                    self.bytes / streaming
+                )
+
+        if self.tools:
+            tools: Dict[str, Dict[str, float]] = {}
+            for name, seconds in self.tools:
+                entry = tools.setdefault(name, {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                entry["calls"] += 1
+                entry["total_seconds"] = round(entry["total_seconds"] + seconds, 6)
+                entry["max_seconds"] = round(max(entry["max_seconds"], seconds), 6)
+            event["tools"] = tools
+
+        if self.steps:
+            event["steps"] = len(self.steps)
+            event["step_seconds"] = [round(seconds, 6) for seconds in self.steps]
+
+        if self.blocked:
+            event["blocked_requests"] = sum(self.blocked.values())
+            event["blocked_by_type"] = dict(self.blocked)
+        return event
+
+
+def record_startup(registry: Registry, import_seconds: float):
+    """import time of the runner's heavy dependencies"""
+    registry.set("import_seconds", "time spent importing the runner's sdk", import_seconds)
+
+
+def record_ready(registry: Registry):
+    """process start to ready, interpreter startup included"""
+    age = process_age()
+    if age is not None:
+        registry.set("start_to_ready_seconds", "process start until the runner was ready", age)
+
+
+async def serve_metrics(registry: Registry, address: str) -> asyncio.AbstractServer:
+    """serve registry.render() over http at HOST:PORT, :PORT or a unix socket path"""
+
+    async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # the request itself doesn't matter; every path gets the metrics
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if ":" in address and not address.startswith(("/", ".")):
+        host, port = address.rsplit(":", 1)
+        return await asyncio.start_server(on_connection, host or "127.0.0.1", int(port))
+    if os.path.exists(address):
+        os.unlink(address)
+    return await asyncio.start_unix_server(on_connection, path=address)
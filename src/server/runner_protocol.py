@@ -0,0 +1,173 @@
+"""
+wire protocol shared by the python runners (dedalus-runner.py,
+browser-use-runner.py) and the node side that spawns them
+
+jsonl (default): one json object per line, both directions.
+
+framed (opt-in, --framed): length-prefixed binary frames, both directions.
+
+    +----------+-----+--------+----------+------+
+    | len: u32 | tag | id_len | id       | body |
+    +----------+-----+--------+----------+------+
+
+len is big-endian and counts every byte after itself. id is the utf-8
+request id (id_len 0 when the event is untagged). the body depends on tag:
+
+    0 EVENT        json object holding the whole event, "type" included
+    1 CHUNK        raw utf-8 chunk content
+    2 COMPLETE     json object, the event without "type"/"id"
+    3 ERROR        json object, the event without "type"/"id"
+    4 TOOL_OUTPUT  u8 stream (0 stdout, 1 stderr), u8 tool name length,
+                   tool name, raw utf-8 content
+
+requests sent to a runner are EVENT frames whose body is the json request.
+frames never need a newline scan and a chunk split across two reads is
+just an incomplete frame, so there is no partial-line parsing.
+"""
+
+import json
+import struct
+from typing import Any, BinaryIO, Dict, Optional
+
+EVENT = 0
+CHUNK = 1
+COMPLETE = 2
+ERROR = 3
+TOOL_OUTPUT = 4
+
+_TYPE_TAGS = {"complete": COMPLETE, "error": ERROR}
+_TAG_TYPES = {tag: name for name, tag in _TYPE_TAGS.items()}
+_STREAMS = ("stdout", "stderr")
+_HEADER = struct.Struct(">I")
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_frame(event: Dict[str, Any]) -> bytes:
+    """one event as a frame"""
+    request_id = event.get("id")
+    rid = str(request_id).encode("utf-8") if request_id is not None else b""
+    if len(rid) > 255:
+        raise ValueError("request id longer than 255 bytes")
+    kind = event.get("type")
+
+    if kind == "chunk" and isinstance(event.get("content"), str) and len(event) == 2 + bool(rid):
+        tag, body = CHUNK, event["content"].encode("utf-8")
+    elif kind == "tool_output" and event.get("stream") in _STREAMS and len(event) == 4 + bool(rid):
+        tool = str(event.get("tool", "")).encode("utf-8")[:255]
+        tag = TOOL_OUTPUT
+        body = (
+            bytes((_STREAMS.index(event["stream"]), len(tool)))
+            + tool
+            + str(event.get("content", "")).encode("utf-8")
+        )
+    elif kind in _TYPE_TAGS:
+        tag = _TYPE_TAGS[kind]
+        rest = {k: v for k, v in event.items() if k not in ("type", "id")}
+        body = _encoder.encode(rest).encode("utf-8")
+    else:
+        tag = EVENT
+        rest = {k: v for k, v in event.items() if k != "id"}
+        body = _encoder.encode(rest).encode("utf-8")
+
+    payload = bytes((tag, len(rid))) + rid + body
+    return _HEADER.pack(len(payload)) + payload
+
+
+def decode_frame(payload: bytes) -> Dict[str, Any]:
+    """an event from a frame's payload (everything after the length)"""
+    tag, id_len = payload[0], payload[1]
+    rid = payload[2:2 + id_len].decode("utf-8")
+    body = payload[2 + id_len:]
+
+    if tag == CHUNK:
+        event = {"type": "chunk", "content": body.decode("utf-8")}
+    elif tag == TOOL_OUTPUT:
+        tool_len = body[1]
+        event = {
+            "type": "tool_output",
+            "tool": body[2:2 + tool_len].decode("utf-8"),
+            "stream": _STREAMS[body[0]],
+            "content": body[2 + tool_len:].decode("utf-8")
+        }
+    elif tag in _TAG_TYPES:
+        event = {"type": _TAG_TYPES[tag], **json.loads(body)}
+    else:
+        event = json.loads(body)
+
+    if id_len:
+        event = {"id": rid, **event}
+    return event
+
+
+def _split_request(payload: bytes) -> bytes:
+    """json body of a request frame, with the header id folded back in"""
+    if not payload[1]:
+        return payload[2:]
+    return _encoder.encode(decode_frame(payload)).encode("utf-8")
+
+
+def read_message(stream: BinaryIO, framed: bool) -> Optional[bytes]:
+    """next request as json bytes from a blocking binary stream, None at eof
+
+    in jsonl mode a blank line comes back as b"" and should be skipped.
+    """
+    if not framed:
+        line = stream.readline()
+        return line.strip() if line else None
+
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    (length,) = _HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return _split_request(payload)
+
+
+async def read_message_async(reader, framed: bool) -> Optional[bytes]:
+    """next request as json bytes from an asyncio StreamReader, None at eof"""
+    if not framed:
+        line = await reader.readline()
+        return line.strip() if line else None
+
+    try:
+        (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        return _split_request(await reader.readexactly(length))
+    except Exception:
+        # IncompleteReadError at eof, or the peer went away mid-frame
+        return None
+
+
+class JsonlWriter:
+    """the one writer for events on a runner's binary output stream
+
+    encoder and stream are set up once instead of per event, and every
+    event is written and flushed with a single call.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.lines = 0
+        self.bytes = 0
+
+    @staticmethod
+    def encode(event: Dict[str, Any]) -> bytes:
+        return _encoder.encode(event).encode("utf-8") + b"\n"
+
+    def write_event(self, event: Dict[str, Any]):
+        data = self.encode(event)
+        self.stream.write(data)
+        self.stream.flush()
+        self.lines += 1
+        self.bytes += len(data)
+
+
+class FramedWriter(JsonlWriter):
+    """JsonlWriter that writes length-prefixed frames instead of lines"""
+
+    @staticmethod
+    def encode(event: Dict[str, Any]) -> bytes:
+        return encode_frame(event)
+
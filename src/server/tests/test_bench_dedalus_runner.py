@@ -0,0 +1,86 @@
+"""
+tests for scripts/bench-dedalus-runner.py
+
+run from the repo root with the dedalus runner's dependencies installed:
+
+  python -m unittest discover -s src/server/tests
+"""
+
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent.parent.parent
+BENCH = REPO / "scripts" / "bench-dedalus-runner.py"
+
+# the script has a hyphenated name, so it is loaded by path
+_spec = importlib.util.spec_from_file_location("bench_dedalus_runner", BENCH)
+bench = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bench)
+
+
+class SummaryTest(unittest.TestCase):
+    def test_percentiles(self):
+        values = [0.001 * n for n in range(1, 101)]
+        self.assertEqual(bench.summarize(values), {"p50": 51.0, "p95": 95.0, "mean": 50.5})
+        self.assertEqual(bench.summarize([]), {"p50": None, "p95": None, "mean": None})
+
+    def test_compare_flags_regressions_past_the_threshold(self):
+        def report(latency):
+            timing = {"p50": latency, "p95": latency, "mean": latency}
+            return {
+                "cold_start": {"spawn_to_first_chunk_ms": timing, "spawn_to_exit_ms": timing},
+                "serve": [{
+                    "concurrency": 1, "time_to_first_chunk_ms": timing, "latency_ms": timing,
+                    "per_token_overhead_us": timing, "tool_call_ms": timing, "rss_kb": 1000,
+                }],
+            }
+
+        with open(os.devnull, "w") as devnull, mock.patch("sys.stdout", devnull):
+            self.assertTrue(bench.compare(report(110), report(100), fail_over=15))
+            self.assertFalse(bench.compare(report(120), report(100), fail_over=15))
+            self.assertTrue(bench.compare(report(120), report(100), fail_over=None))
+
+
+class SmokeTest(unittest.TestCase):
+    def test_benchmarks_the_runner_against_the_stand_in_server(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "report.json")
+            command = [
+                sys.executable, str(BENCH),
+                "--runner-cmd", f"{sys.executable} {REPO / 'src' / 'server' / 'dedalus-runner.py'}",
+                "--tokens", "5", "--token-rate", "0", "--first-token-ms", "0",
+                "--cold-runs", "1", "--concurrency", "1,2", "--requests", "2",
+                "--out", out,
+            ]
+            env = {**os.environ, "TMPDIR": tmp}
+            subprocess.run(command, check=True, capture_output=True, timeout=300, env=env)
+            report = json.loads(Path(out).read_text())
+
+            # a second run compared against the first, with a loose threshold
+            compared = subprocess.run(
+                command + ["--baseline", out, "--fail-over", "1000", "--out", os.path.join(tmp, "again.json")],
+                capture_output=True, timeout=300, env=env
+            )
+            self.assertEqual(compared.returncode, 0, compared.stderr)
+
+        self.assertEqual(report["meta"]["script"]["tool_calls"], 1)
+        # one tool call turn and one reply per request: the cold run, the
+        # untimed warm-up and two per level
+        self.assertEqual(report["meta"]["model_requests"], 2 * (1 + 1 + 2 * 2))
+        self.assertIsNotNone(report["cold_start"]["spawn_to_first_chunk_ms"]["p50"])
+        self.assertEqual([level["concurrency"] for level in report["serve"]], [1, 2])
+        for level in report["serve"]:
+            self.assertIsNotNone(level["latency_ms"]["p50"])
+            self.assertIsNotNone(level["tool_call_ms"]["p50"])
+            self.assertGreater(level["rss_kb"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
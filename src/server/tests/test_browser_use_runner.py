@@ -0,0 +1,751 @@
+"""
+tests for browser-use-runner.py
+
+run from the repo root with the runner's dependencies installed:
+
+  python -m unittest discover -s src/server/tests
+"""
+
+import asyncio
+import base64
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+from pathlib import Path
+
+SERVER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SERVER))
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "false")
+
+# the runner is a script with a hyphenated name, so it is loaded by path
+_spec = importlib.util.spec_from_file_location("browser_use_runner", SERVER / "browser-use-runner.py")
+browser_runner = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(browser_runner)
+
+# RunnerTestCase stands in for it
+_complete_event = browser_runner.complete_event
+
+
+class RunnerTestCase(unittest.TestCase):
+    """captures the runner's events and stands in for the browser"""
+
+    def setUp(self):
+        self.out = io.BytesIO()
+        for patch in (
+            mock.patch.object(browser_runner, "_stdout", browser_runner.runner_protocol.JsonlWriter(self.out)),
+            mock.patch.object(browser_runner.BrowserWorker, "run_task", self.run_task),
+            mock.patch.object(browser_runner, "complete_event", self.complete_event),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.configs = []
+
+    async def run_task(self, config, metrics, request_id=None, own_tab=False):
+        self.configs.append(config)
+        return config.get("task"), None
+
+    @staticmethod
+    def complete_event(result, replay=None):
+        return {"type": "complete", "content": result, "status": "success"}
+
+    def events(self):
+        return [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+
+class ServeTest(RunnerTestCase):
+    def serve(self, lines):
+        stdin = types.SimpleNamespace(buffer=io.BytesIO("".join(line + "\n" for line in lines).encode()))
+        with mock.patch("sys.stdin", stdin):
+            asyncio.run(browser_runner.serve())
+        return self.events()
+
+    def test_survives_requests_that_are_not_objects(self):
+        events = self.serve(['[1, 2]', '"x"', '{"id": 7, "task": "look"}'])
+        self.assertEqual(events[0], {"type": "ready"})
+        errors = [event["error"] for event in events if event["type"] == "error"]
+        self.assertEqual(errors, [
+            "invalid request: expected a json object, got list",
+            "invalid request: expected a json object, got str",
+        ])
+        self.assertEqual(events[-1], {"id": "7", "type": "complete", "content": "look", "status": "success"})
+
+    def test_a_failed_task_drops_the_session_but_not_the_worker(self):
+        async def run_task(worker, config, metrics, request_id=None, own_tab=False):
+            if config["task"] == "boom":
+                raise ConnectionError("cdp connection lost")
+            return config["task"], None
+
+        closed = []
+
+        async def close(worker):
+            closed.append(worker)
+
+        with mock.patch.object(browser_runner.BrowserWorker, "run_task", run_task), \
+                mock.patch.object(browser_runner.BrowserWorker, "close", close):
+            events = self.serve(['{"id": 1, "task": "boom"}', '{"id": 2, "task": "look"}'])
+
+        outcomes = [(event["id"], event["type"]) for event in events if event["type"] in ("complete", "error")]
+        self.assertEqual(outcomes, [("1", "error"), ("2", "complete")])
+        self.assertEqual(events[2]["error"], "cdp connection lost")
+        # once after the failure, once at eof; one worker throughout
+        self.assertEqual(len(closed), 2)
+        self.assertIs(closed[0], closed[1])
+
+
+class FakeBrowserSession:
+    """records what the worker does with its browser session"""
+
+    sessions = []
+
+    def __init__(self, cdp_url, keep_alive=False):
+        self.cdp_url = cdp_url
+        self.keep_alive = keep_alive
+        self.calls = []
+        self.sessions.append(self)
+
+    async def start(self):
+        self.calls.append("start")
+
+    async def stop(self):
+        self.calls.append("stop")
+
+
+class WorkerTest(unittest.TestCase):
+    def test_keeps_its_session_and_llms_between_tasks(self):
+        FakeBrowserSession.sessions = []
+        runs = []
+
+        async def run_browser_task(config, browser_session, llm, metrics, request_id=None):
+            runs.append((browser_session, llm))
+            return config["task"], None
+
+        async def run():
+            worker = browser_runner.BrowserWorker("ws://one")
+            metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+            for config in (
+                {"task": "a"},
+                {"task": "b"},
+                {"task": "c", "model": "gpt-5"},
+                {"task": "d", "cdp_url": "ws://two"},
+            ):
+                await worker.run_task(config, metrics)
+            await worker.close()
+
+        with mock.patch.object(browser_runner, "BrowserSession", FakeBrowserSession), \
+                mock.patch.object(browser_runner, "create_llm", lambda model: types.SimpleNamespace(model=model)), \
+                mock.patch.object(browser_runner, "run_browser_task", run_browser_task):
+            asyncio.run(run())
+
+        first, second = FakeBrowserSession.sessions
+        self.assertEqual((first.cdp_url, second.cdp_url), ("ws://one", "ws://two"))
+        self.assertTrue(first.keep_alive)
+        self.assertEqual(first.calls, ["start", "stop"])
+        self.assertEqual(second.calls, ["start", "stop"])
+        self.assertEqual([session for session, _ in runs], [first, first, first, second])
+        llms = [llm for _, llm in runs]
+        self.assertIs(llms[0], llms[1])
+        self.assertIs(llms[0], llms[3])
+        self.assertEqual((llms[0].model, llms[2].model), ("claude-sonnet-5", "gpt-5"))
+
+
+class FakeCdp:
+    """the Target domain of a cdp client, recording every command"""
+
+    def __init__(self):
+        self.commands = []
+        target = types.SimpleNamespace(**{
+            name: self.command(f"Target.{name}", result)
+            for name, result in (
+                ("createBrowserContext", {"browserContextId": "ctx-1"}),
+                ("createTarget", {"targetId": "tab-1"}),
+                ("closeTarget", {"success": True}),
+                ("disposeBrowserContext", {}),
+            )
+        })
+        self.send = types.SimpleNamespace(Target=target)
+
+    def command(self, method, result):
+        async def send(params=None, session_id=None):
+            self.commands.append((method, params))
+            return result
+        return send
+
+
+class TabTest(unittest.TestCase):
+    def worker(self, switch=None):
+        dispatched = []
+
+        async def dispatch(event):
+            dispatched.append(event.target_id)
+            if switch is not None:
+                raise switch
+
+        worker = browser_runner.BrowserWorker("ws://one")
+        worker.browser_session = types.SimpleNamespace(
+            cdp_client=FakeCdp(), event_bus=types.SimpleNamespace(dispatch=dispatch)
+        )
+        return worker, worker.browser_session.cdp_client.commands, dispatched
+
+    def test_an_isolated_tab_gets_its_own_browser_context(self):
+        worker, commands, dispatched = self.worker()
+
+        async def run():
+            tab = await worker.open_tab(isolated=True)
+            await worker.close_tab(tab)
+            return tab
+
+        tab = asyncio.run(run())
+        self.assertEqual(tab, {"browserContextId": "ctx-1", "targetId": "tab-1"})
+        self.assertEqual(dispatched, ["tab-1"])
+        self.assertEqual(commands, [
+            ("Target.createBrowserContext", {"disposeOnDetach": True}),
+            ("Target.createTarget", {"url": "about:blank", "browserContextId": "ctx-1"}),
+            ("Target.closeTarget", {"targetId": "tab-1"}),
+            ("Target.disposeBrowserContext", {"browserContextId": "ctx-1"}),
+        ])
+
+    def test_a_tab_that_cant_be_switched_to_is_closed(self):
+        worker, commands, _ = self.worker(switch=RuntimeError("no such tab"))
+        with self.assertRaises(RuntimeError):
+            asyncio.run(worker.open_tab(isolated=False))
+        self.assertEqual([method for method, _ in commands], ["Target.createTarget", "Target.closeTarget"])
+
+    def test_a_task_in_its_own_tab_closes_it_when_it_fails(self):
+        worker, commands, _ = self.worker()
+
+        async def attach(cdp_url):
+            return worker.browser_session
+
+        async def run_browser_task(config, browser_session, llm, metrics, request_id=None):
+            raise ValueError("agent failed")
+
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        with mock.patch.object(worker, "attach", attach), \
+                mock.patch.object(browser_runner, "create_llm", lambda model: None), \
+                mock.patch.object(browser_runner, "run_browser_task", run_browser_task):
+            with self.assertRaises(ValueError):
+                asyncio.run(worker.run_task({"task": "x"}, metrics, own_tab=True))
+        self.assertEqual([method for method, _ in commands], ["Target.createTarget", "Target.closeTarget"])
+
+
+class FetchCdp:
+    """a cdp client with cdp_use's real event registry and a recorded Fetch domain"""
+
+    def __init__(self):
+        from cdp_use.cdp.registration_library import CDPRegistrationLibrary
+        from cdp_use.cdp.registry import EventRegistry
+
+        self.sent = []
+        self._event_registry = EventRegistry()
+        self.register = CDPRegistrationLibrary(self._event_registry)
+        self.send = types.SimpleNamespace(Fetch=types.SimpleNamespace(**{
+            name: self.command(name) for name in ("enable", "disable", "failRequest", "continueRequest")
+        }))
+
+    def command(self, name):
+        async def send(params=None, session_id=None):
+            self.sent.append((name, params, session_id))
+        return send
+
+    async def pause(self, event, session_id):
+        await self._event_registry.handle_event("Fetch.requestPaused", event, session_id)
+        # replies are fire and forget
+        await asyncio.sleep(0)
+
+
+class ResourceBlockerTest(unittest.TestCase):
+    def blocker(self, profile="minimal", proxy=None, tab="S1"):
+        cdp = FetchCdp()
+        tabs = {"focused": tab}
+
+        async def get_or_create_cdp_session(focus=True):
+            return types.SimpleNamespace(session_id=tabs["focused"])
+
+        session = types.SimpleNamespace(
+            cdp_client=cdp,
+            browser_profile=types.SimpleNamespace(proxy=proxy),
+            get_or_create_cdp_session=get_or_create_cdp_session,
+        )
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        return browser_runner.ResourceBlocker(profile, session, metrics), cdp, metrics, tabs
+
+    def test_fails_matching_requests_on_covered_tabs(self):
+        blocker, cdp, metrics, tabs = self.blocker()
+
+        async def run():
+            await blocker.cover()
+            await blocker.cover()
+            await cdp.pause({"requestId": "r1", "resourceType": "Image"}, "S1")
+            tabs["focused"] = "S2"
+            await blocker.cover()
+            await cdp.pause({"requestId": "r2", "resourceType": "Script"}, "S2")
+            await blocker.release()
+            await cdp.pause({"requestId": "r3", "resourceType": "Image"}, "S1")
+
+        asyncio.run(run())
+        enabled = [(params, session_id) for name, params, session_id in cdp.sent if name == "enable"]
+        self.assertEqual([session_id for _, session_id in enabled], ["S1", "S2"])
+        patterns = enabled[0][0]["patterns"]
+        self.assertIn({"resourceType": "Image", "requestStage": "Request"}, patterns)
+        self.assertIn({"urlPattern": "*doubleclick.net/*", "requestStage": "Request"}, patterns)
+        self.assertNotIn("handleAuthRequests", enabled[0][0])
+
+        replies = [(name, params["requestId"]) for name, params, _ in cdp.sent if name.endswith("Request")]
+        # a request paused after release goes on
+        self.assertEqual(replies, [("failRequest", "r1"), ("failRequest", "r2"), ("continueRequest", "r3")])
+        self.assertEqual(metrics.blocked, {"Image": 1, "Script": 1})
+        self.assertEqual(sorted(session_id for name, _, session_id in cdp.sent if name == "disable"), ["S1", "S2"])
+
+    def test_leaves_browser_uses_proxy_auth_working(self):
+        proxy = types.SimpleNamespace(username="user", password="secret")
+        blocker, cdp, metrics, _ = self.blocker(proxy=proxy)
+        theirs = []
+
+        def auth_handler(event, session_id=None):
+            theirs.append((event["requestId"], session_id))
+
+        cdp.register.Fetch.requestPaused(auth_handler)
+
+        async def run():
+            await blocker.cover()
+            await cdp.pause({"requestId": "r1", "resourceType": "Font"}, "S1")
+            # interception on a tab the blocker doesn't cover
+            await cdp.pause({"requestId": "r2", "resourceType": "Image"}, "OTHER")
+            await blocker.release()
+
+        asyncio.run(run())
+        self.assertEqual(theirs, [("r2", "OTHER")])
+        enables = [params for name, params, _ in cdp.sent if name == "enable"]
+        self.assertTrue(enables[0]["handleAuthRequests"])
+        # released: back to browser-use's own auth-only interception
+        self.assertEqual(enables[1], {"handleAuthRequests": True})
+        self.assertNotIn("disable", [name for name, _, _ in cdp.sent])
+        self.assertIs(cdp._event_registry._handlers["Fetch.requestPaused"], auth_handler)
+        self.assertEqual(metrics.blocked, {"Font": 1})
+
+    def test_profiles(self):
+        blocker, cdp, _, _ = self.blocker(profile="none")
+        asyncio.run(blocker.cover())
+        self.assertEqual(cdp.sent, [])
+        with self.assertRaises(ValueError):
+            self.blocker(profile="everything")
+
+
+class BatchTest(RunnerTestCase):
+    def run_batch(self, lines, **options):
+        source = io.BytesIO("".join(line + "\n" for line in lines).encode())
+        with mock.patch("sys.stdin", types.SimpleNamespace(buffer=source)):
+            ok = asyncio.run(browser_runner.run_batch("-", **options))
+        return ok, self.events()
+
+    def test_counts_lines_that_are_not_objects_as_failed(self):
+        ok, events = self.run_batch(['"str"', '{"task": "look"}'])
+        self.assertFalse(ok)
+        self.assertEqual(events[0], {
+            "id": "1", "type": "error", "error": "invalid task: expected a json object, got str"
+        })
+        self.assertEqual(self.configs, [{"task": "look", "id": "2", "isolated": False}])
+        self.assertEqual((events[-1]["succeeded"], events[-1]["failed"]), (1, 1))
+
+    def test_runs_tasks_concurrently_in_their_own_tabs(self):
+        running = []
+        overlap = []
+
+        async def run_task(worker, config, metrics, request_id=None, own_tab=False):
+            running.append(worker)
+            overlap.append(len(running))
+            await asyncio.sleep(0.05)
+            running.remove(worker)
+            self.configs.append((config, request_id, own_tab))
+            return config["task"], None
+
+        async def close(worker):
+            pass
+
+        lines = ['{"task": "t%d"}' % number for number in range(5)] + ['{"task": "own", "isolated": false}']
+        with mock.patch.object(browser_runner.BrowserWorker, "run_task", run_task), \
+                mock.patch.object(browser_runner.BrowserWorker, "close", close):
+            ok, events = self.run_batch(lines, concurrency=2, isolate=True)
+        self.assertTrue(ok)
+        self.assertEqual(max(overlap), 2)
+        self.assertTrue(all(own_tab for _, _, own_tab in self.configs))
+        isolated = {config["task"]: config["isolated"] for config, _, _ in self.configs}
+        self.assertEqual(isolated, {**{f"t{number}": True for number in range(5)}, "own": False})
+        self.assertEqual(sorted(request_id for _, request_id, _ in self.configs), ["1", "2", "3", "4", "5", "6"])
+        self.assertEqual(events[-1]["succeeded"], 6)
+
+
+def _action_types():
+    """browser-use's action and agent output models with its default tools"""
+    from browser_use.agent.views import AgentOutput
+    from browser_use.tools.service import Tools
+
+    action_model = Tools().registry.create_action_model()
+    return action_model, AgentOutput.type_with_custom_actions(action_model)
+
+
+def _history_item(output_type, action_model, actions, url, title, step_number, results=None):
+    """one recorded step, as browser-use's Agent would have saved it"""
+    from browser_use.agent.views import ActionResult, AgentHistory, StepMetadata
+    from browser_use.browser.views import BrowserStateHistory
+
+    return AgentHistory(
+        model_output=output_type(
+            evaluation_previous_goal="", memory="", next_goal=f"step {step_number}",
+            action=[action_model(**action) for action in actions],
+        ),
+        result=[ActionResult(**result) for result in results or [{} for _ in actions]],
+        state=BrowserStateHistory(
+            url=url, title=title, tabs=[], interacted_element=[None] * len(actions), screenshot_path=None
+        ),
+        metadata=StepMetadata(step_number=step_number, step_start_time=0.0, step_end_time=1.0),
+    )
+
+
+class FakeAgent:
+    """runs recorded steps through browser-use's step hooks"""
+
+    def __init__(self, items, llm=None):
+        self.items = items
+        self.llm = llm
+        self.history = types.SimpleNamespace(history=[])
+        self.state = types.SimpleNamespace(n_steps=1)
+        self.token_cost_service = types.SimpleNamespace(usage_history=[])
+
+    async def run(self, on_step_start=None, on_step_end=None):
+        from browser_use.agent.views import AgentHistoryList
+
+        for item in self.items:
+            await on_step_start(self)
+            if self.llm is not None:
+                await self.llm.ainvoke(_page_request(3, _blank_image()))
+            usage = types.SimpleNamespace(prompt_tokens=100, prompt_cached_tokens=40, completion_tokens=7)
+            self.token_cost_service.usage_history.append(types.SimpleNamespace(usage=usage))
+            self.history.history.append(item)
+            await on_step_end(self)
+            self.state.n_steps += 1
+        return AgentHistoryList(history=self.items)
+
+
+class StepEventTest(RunnerTestCase):
+    def test_emits_a_step_event_per_step_then_completes(self):
+        action_model, output_type = _action_types()
+        url = "https://example.test/"
+        items = [
+            _history_item(output_type, action_model, [{"click": {"index": 4}}], url, "Home", 1),
+            _history_item(
+                output_type, action_model, [{"done": {"text": "found it", "success": True}}], url, "Home", 2,
+                results=[{"extracted_content": "found it", "is_done": True, "success": True}],
+            ),
+        ]
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        history = asyncio.run(browser_runner.run_agent(FakeAgent(items), metrics, "r1"))
+
+        steps = self.events()
+        self.assertEqual([(event["id"], event["type"], event["step"]) for event in steps], [
+            ("r1", "step", 1), ("r1", "step", 2),
+        ])
+        first = steps[0]
+        self.assertEqual(first["actions"], [{"click": {"index": 4}}])
+        self.assertEqual((first["url"], first["title"], first["next_goal"]), (url, "Home", "step 1"))
+        self.assertEqual(
+            (first["llm_calls"], first["input_tokens"], first["cached_input_tokens"], first["output_tokens"]),
+            (1, 100, 40, 7)
+        )
+        self.assertNotIn("payload", first)
+        self.assertEqual(len(metrics.steps), 2)
+
+        complete = _complete_event(history)
+        self.assertEqual(complete["content"], "found it")
+        self.assertEqual(complete["history"]["steps"], 2)
+        self.assertTrue(complete["history"]["is_successful"])
+        self.assertEqual(complete["history"]["actions"], ["click", "done"])
+
+    def test_step_events_carry_the_shrinkers_payload(self):
+        action_model, output_type = _action_types()
+        items = [_history_item(output_type, action_model, [{"click": {"index": 1}}], "about:blank", "", 1)]
+        llm = browser_runner.PageStateShrinker(FakeLlm(), {"max_elements": 1})
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        asyncio.run(browser_runner.run_agent(FakeAgent(items, llm), metrics))
+
+        payload = self.events()[0]["payload"]
+        self.assertEqual((payload["llm_calls"], payload["images"]), (1, 1))
+        self.assertLess(payload["bytes_after"], payload["bytes_before"])
+
+
+class FakePage:
+    """a browser tab that only knows navigation"""
+
+    def __init__(self, titles):
+        self.titles = titles
+        self.url = "about:blank"
+        self.actions = []
+
+    async def get_current_page_url(self):
+        return self.url
+
+    async def get_current_page_title(self):
+        return self.titles.get(self.url, self.url)
+
+    async def execute(self, item, delay):
+        for action in item.model_output.action:
+            name, params = next(iter(action.model_dump(exclude_unset=True).items()))
+            self.actions.append(name)
+            if name == "navigate":
+                self.url = params["url"]
+        return [types.SimpleNamespace(error=None)]
+
+
+class ReplayTest(RunnerTestCase):
+    def test_replays_a_trace_that_starts_from_a_url(self):
+        from browser_use.agent.views import AgentHistoryList
+
+        action_model, output_type = _action_types()
+        url = "https://example.test/inbox"
+        trace = AgentHistoryList(history=[
+            # what browser-use records for a url in the task
+            _history_item(output_type, action_model, [{"navigate": {"url": url, "new_tab": False}}], url, "Initial Actions", 0),
+            _history_item(output_type, action_model, [{"click": {"index": 4}}], url, "Inbox (3)", 1),
+            _history_item(output_type, action_model, [{"done": {"text": "ok", "success": True}}], url, "Inbox (3)", 2),
+        ])
+        # round-trips through the store's json like a real trace
+        trace = AgentHistoryList.load_from_dict(json.loads(json.dumps(trace.model_dump())), output_type)
+
+        page = FakePage({url: "Inbox (5)"})
+        agent = types.SimpleNamespace(browser_session=page, _execute_history_step=page.execute, sensitive_data=None)
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        with mock.patch.object(browser_runner, "_SETTLE_SECONDS", 0.5):
+            replayed, reason = asyncio.run(browser_runner.replay_trace(agent, trace, metrics))
+
+        self.assertEqual((replayed, reason), (2, None))
+        self.assertEqual(page.actions, ["navigate", "click"])
+        steps = [event for event in self.events() if event["type"] == "step"]
+        self.assertEqual([step["step"] for step in steps], [1, 2])
+
+    def test_stops_where_the_page_no_longer_matches(self):
+        action_model, output_type = _action_types()
+        url = "https://example.test/"
+        trace = types.SimpleNamespace(history=[
+            _history_item(output_type, action_model, [{"click": {"index": 1}}], url, "Home", 1),
+            _history_item(output_type, action_model, [{"click": {"index": 2}}], url + "next", "Next", 2),
+            _history_item(output_type, action_model, [{"done": {"text": "ok", "success": True}}], url, "Next", 3),
+        ])
+        page = FakePage({url: "Home", url + "next": "Next"})
+        page.url = url
+        agent = types.SimpleNamespace(browser_session=page, _execute_history_step=page.execute, sensitive_data=None)
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        with mock.patch.object(browser_runner, "_SETTLE_SECONDS", 0.1):
+            replayed, reason = asyncio.run(browser_runner.replay_trace(agent, trace, metrics))
+
+        # the click didn't navigate, so step 2's page never shows up
+        self.assertEqual(replayed, 1)
+        self.assertEqual(reason, "step 2: page is 'example.test|home', recorded 'example.test/next|next'")
+        self.assertEqual(page.actions, ["click"])
+
+
+class FakeLlm:
+    """an llm client that records the messages it's sent"""
+
+    provider = "openai"
+    model = "fake"
+
+    def __init__(self):
+        self.requests = []
+
+    async def ainvoke(self, messages, output_format=None, **kwargs):
+        self.requests.append(messages)
+        return "ok"
+
+
+def _page_request(elements, image):
+    """a browser-use step request: a dom listing and a png screenshot"""
+    from browser_use.llm.messages import ContentPartImageParam, ContentPartTextParam, ImageURL, UserMessage
+
+    listing = "".join(f"\t[{index}]<button>item {index}</button>\n" for index in range(elements))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    url = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+    return [UserMessage(content=[
+        ContentPartTextParam(text=f"<browser_state>\n{listing}</browser_state>"),
+        ContentPartImageParam(image_url=ImageURL(url=url)),
+    ])]
+
+
+def _blank_image():
+    from PIL import Image
+
+    return Image.new("RGB", (8, 8))
+
+
+class PageStateTest(unittest.TestCase):
+    def shrink(self, page_state, request):
+        llm = FakeLlm()
+        shrinker = browser_runner.PageStateShrinker(llm, page_state)
+        asyncio.run(shrinker.ainvoke(request))
+        return llm.requests[0][0].content, shrinker.take_stats()
+
+    def test_quality_alone_reencodes_as_jpeg(self):
+        from PIL import Image
+
+        noise = Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+        (text, image), stats = self.shrink({"quality": 75}, _page_request(2, noise))
+        self.assertTrue(image.image_url.url.startswith("data:image/jpeg;base64,"))
+        self.assertEqual(image.image_url.media_type, "image/jpeg")
+        self.assertLess(stats["bytes_after"], stats["bytes_before"])
+        self.assertEqual((stats["llm_calls"], stats["images"]), (1, 1))
+
+    def test_caps_the_element_listing(self):
+        (text, image), stats = self.shrink({"max_elements": 3}, _page_request(10, _blank_image()))
+        self.assertIn("[2]<button>", text.text)
+        self.assertNotIn("[3]<button>", text.text)
+        self.assertIn("[7 more elements not listed]", text.text)
+        self.assertTrue(text.text.endswith("</browser_state>"))
+        self.assertTrue(image.image_url.url.startswith("data:image/png;"))
+
+    def test_only_shrinks_when_a_shrinking_option_is_set(self):
+        agents = []
+
+        def agent(**options):
+            agents.append(options)
+            return types.SimpleNamespace(**options)
+
+        async def run_agent(agent, metrics, request_id=None, blocker=None):
+            return agent
+
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        with mock.patch.object(browser_runner, "Agent", agent), \
+                mock.patch.object(browser_runner, "run_agent", run_agent):
+            for page_state in ({}, {"screenshot_size": [800, 600]}, {"grayscale": True}):
+                config = {"task": "look", "page_state": page_state}
+                asyncio.run(browser_runner.run_browser_task(config, None, FakeLlm(), metrics))
+
+        llms = [options["llm"] for options in agents]
+        self.assertEqual([type(llm).__name__ for llm in llms], ["TaskLlm", "TaskLlm", "PageStateShrinker"])
+        self.assertEqual(agents[1]["llm_screenshot_size"], (800, 600))
+        self.assertEqual(llms[2].image_format, "jpeg")
+        self.assertEqual(llms[0].model, "fake")
+        self.assertIsNot(llms[0].llm, llms[1].llm)
+
+
+class TraceStoreTest(unittest.TestCase):
+    def test_key_ignores_case_spacing_query_and_fragment(self):
+        key = browser_runner.TraceStore.key
+        base = key("Log in  and check the inbox", "https://Mail.example.test/inbox/?session=1#top")
+        self.assertEqual(base, key("log in and check the inbox\n", "https://mail.example.test/inbox"))
+        self.assertNotEqual(base, key("log in and check the outbox", "https://mail.example.test/inbox"))
+        self.assertNotEqual(base, key("log in and check the inbox", "https://mail.example.test/sent"))
+
+    def test_fingerprints_mask_digits(self):
+        self.assertEqual(
+            browser_runner.page_fingerprint("https://x.test/reports/2026-10-17?page=2", "Inbox  (3)"),
+            browser_runner.page_fingerprint("https://X.test/reports/2025-01-01/", "inbox (12)"),
+        )
+
+    def test_missing_secrets(self):
+        action_model, _ = _action_types()
+        actions = [
+            action_model(input={"index": 1, "text": "<secret>user</secret>"}),
+            action_model(input={"index": 2, "text": "<secret>password</secret>"}),
+        ]
+        missing = browser_runner._missing_secrets
+        self.assertEqual(missing(actions, None), ["password", "user"])
+        self.assertEqual(missing(actions, {"user": "me"}), ["password"])
+        self.assertEqual(missing(actions, {"https://*.example.test": {"user": "me", "password": "pw"}}), [])
+
+
+class RecordAndReplayTest(RunnerTestCase):
+    """run_browser_task with "replay", on a stand-in agent and browser"""
+
+    URL = "https://mail.example.test/login"
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        store = browser_runner.TraceStore(os.path.join(tmp.name, "traces.sqlite"))
+        self.addCleanup(store.db.close)
+        patch = mock.patch.object(browser_runner.TraceStore, "_shared", store)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.store = store
+
+        self.action_model, self.output_type = _action_types()
+        self.page = FakePage({self.URL: "Sign in"})
+        self.page.url = self.URL
+        self.agents = []
+
+    def item(self, actions, step_number, results=None):
+        return _history_item(self.output_type, self.action_model, actions, self.URL, "Sign in", step_number, results)
+
+    def run_task(self, config, steps):
+        """run config, the agent taking steps[i] as its i-th run's history"""
+        from browser_use.agent.views import AgentHistoryList
+
+        test = self
+        page = self.page
+
+        class Agent:
+            AgentOutput = self.output_type
+
+            def __init__(self, task, browser_session, llm, sensitive_data=None, **options):
+                self.task = task
+                self.options = options
+                self.browser_session = browser_session
+                self.sensitive_data = sensitive_data
+                self._execute_history_step = page.execute
+                test.agents.append(self)
+
+            async def run(self, on_step_start=None, on_step_end=None):
+                return AgentHistoryList(history=steps.pop(0))
+
+        async def start():
+            pass
+
+        page.start = start
+        metrics = browser_runner.runner_metrics.RunMetrics(browser_runner.METRICS)
+        with mock.patch.object(browser_runner, "Agent", Agent):
+            return asyncio.run(browser_runner.run_browser_task({**config, "replay": True}, page, FakeLlm(), metrics))
+
+    def test_records_then_replays_with_secrets_kept_out_of_the_trace(self):
+        done = {"done": {"text": "signed in", "success": True}}
+        done_result = [{"extracted_content": "signed in", "is_done": True, "success": True}]
+        recorded = [
+            self.item([{"input": {"index": 2, "text": "hunter2"}}], 1),
+            self.item([{"click": {"index": 3}}], 2),
+            self.item([done], 3, done_result),
+        ]
+        config = {"task": "Sign in", "sensitive_data": {"password": "hunter2"}}
+
+        _, replay = self.run_task(config, [recorded])
+        self.assertEqual(replay, {"hit": False, "steps_replayed": 0, "steps_recorded": 0})
+        (stored,) = self.store.db.execute("SELECT history FROM traces").fetchone()
+        self.assertNotIn("hunter2", stored)
+        self.assertIn("<secret>password</secret>", stored)
+
+        # the same task again: replayed up to the answer, which the model gives
+        self.agents.clear()
+        _, replay = self.run_task(config, [[self.item([done], 1, done_result)]])
+        self.assertEqual(replay, {"hit": True, "steps_replayed": 2, "steps_recorded": 3})
+        self.assertEqual(self.page.actions, ["input", "click"])
+        taking_over = self.agents[-1]
+        self.assertIn("already carried out", taking_over.task)
+        self.assertEqual(taking_over.options, {"directly_open_url": False})
+        (hits,) = self.store.db.execute("SELECT hits FROM traces").fetchone()
+        self.assertEqual(hits, 1)
+
+        # without the secret the trace can't be typed, and the model runs it all
+        self.page.actions.clear()
+        _, replay = self.run_task({"task": "sign in"}, [recorded])
+        self.assertEqual(replay["diverged"], "step 1: no sensitive_data value for password")
+        self.assertEqual((replay["hit"], replay["steps_replayed"]), (False, 0))
+        self.assertEqual(self.page.actions, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1130 @@
+"""
+tests for dedalus-runner.py
+
+run from the repo root with the runner's dependencies installed:
+
+  python -m unittest discover -s src/server/tests
+"""
+
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+from pathlib import Path
+
+SERVER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SERVER))
+
+# the runner is a script with a hyphenated name, so it is loaded by path
+_spec = importlib.util.spec_from_file_location("dedalus_runner", SERVER / "dedalus-runner.py")
+dedalus_runner = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(dedalus_runner)
+
+
+class ShellSessionTest(unittest.TestCase):
+    def run_commands(self, *commands, timeout=30):
+        """run commands in one shell, returning each result and its stdout"""
+        async def run():
+            shell = dedalus_runner.ShellSession(timeout=timeout)
+            results = []
+            try:
+                for command in commands:
+                    output = []
+                    result = await shell.run(command, lambda stream, text: output.append(text) if stream == "stdout" else None)
+                    results.append((result, "".join(output)))
+            finally:
+                await shell.close()
+            return results
+
+        return asyncio.run(run())
+
+    def test_keeps_state_between_commands(self):
+        (_, first), (result, second) = self.run_commands("cd /tmp && export GREETING=hi", "echo $GREETING $PWD")
+        self.assertEqual(result["returncode"], 0)
+        self.assertEqual(second, "hi /tmp\n")
+
+    def test_exit_ends_the_shell(self):
+        (result, _), (after, output) = self.run_commands("exit 3", "echo again")
+        self.assertEqual(result["returncode"], 3)
+        self.assertIn("shell exited", result["message"])
+        self.assertEqual(output, "again\n")
+
+    def test_exit_with_a_background_job_holding_the_pipes(self):
+        started = time.monotonic()
+        (result, _), = self.run_commands("sleep 30 & exit 4", timeout=20)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(result["returncode"], 4)
+        self.assertIn("shell exited", result["message"])
+
+    def test_timeout_keeps_the_shell(self):
+        (result, _), (after, output) = self.run_commands("sleep 5", "echo alive", timeout=0.5)
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "command timed out after 0.5 seconds")
+        self.assertEqual(output, "alive\n")
+
+
+def _group_members(pgid):
+    """live pids in process group pgid, read from /proc; zombies don't count"""
+    members = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    state, _, pgrp = f.read().rsplit(")", 1)[1].split()[:3]
+                if int(pgrp) == pgid and state != "Z":
+                    members.append(int(entry))
+            except (OSError, ValueError, IndexError):
+                continue
+    return members
+
+
+@unittest.skipUnless(os.path.isdir("/proc"), "needs /proc")
+class CancelTest(unittest.TestCase):
+    def test_cancelled_command_takes_its_children_but_not_the_shell(self):
+        async def run():
+            shell = dedalus_runner.ShellSession(timeout=30)
+            try:
+                await shell.run("export KEPT=yes", lambda stream, text: None)
+                command = asyncio.create_task(shell.run("sleep 30 & sleep 31 | cat", lambda stream, text: None))
+                await asyncio.sleep(0.5)
+                during = _group_members(shell.process.pid)
+                command.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await command
+                # SIGKILL lands asynchronously; give the children a moment
+                for _ in range(40):
+                    after = _group_members(shell.process.pid)
+                    if after == [shell.process.pid]:
+                        break
+                    await asyncio.sleep(0.05)
+
+                output = []
+                result = await shell.run(
+                    "echo $KEPT", lambda stream, text: output.append(text) if stream == "stdout" else None
+                )
+                return shell.process.pid, during, after, result, "".join(output)
+            finally:
+                await shell.close()
+
+        shell_pid, during, after, result, output = asyncio.run(run())
+        self.assertGreaterEqual(len(during), 4)
+        self.assertEqual(after, [shell_pid])
+        self.assertEqual((result["returncode"], output), (0, "yes\n"))
+
+    def test_cancelled_run_reports_and_releases_its_tools(self):
+        events = []
+        closed = []
+
+        class Runner:
+            def run(self, **options):
+                async def stream():
+                    yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content="partial"))])
+                    await asyncio.sleep(30)
+                return stream()
+
+        async def close(tools):
+            closed.append(tools)
+
+        async def run():
+            dedalus_runner._sink.set(events.append)
+            runner = dedalus_runner.DedalusStreamRunner(api_key="test")
+            with mock.patch.object(runner.clients, "acquire", lambda: (None, Runner())), \
+                    mock.patch.object(runner.clients, "release", mock.AsyncMock()) as release, \
+                    mock.patch.object(dedalus_runner.LocalTools, "close", close):
+                task = asyncio.create_task(runner.run_streaming("hello", coalesce_bytes=0))
+                await asyncio.sleep(0.2)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            runner.dispatcher.close()
+            return release
+
+        release = asyncio.run(run())
+        self.assertEqual([event["type"] for event in events], ["chunk", "metrics", "cancelled"])
+        self.assertEqual(events[1]["status"], "cancelled")
+        self.assertEqual(len(closed), 1)
+        # a cancel is no connection failure, the client stays warm
+        self.assertIsNone(release.await_args.args[1])
+
+
+class BashTest(unittest.TestCase):
+    def bash(self, command, **options):
+        """run command with the bash tool, returning its result and events"""
+        events = []
+
+        async def run():
+            dedalus_runner._sink.set(events.append)
+            tools = dedalus_runner.LocalTools(**options)
+            try:
+                return await tools.bash(command), tools
+            finally:
+                await tools.shell.close()
+
+        result, tools = asyncio.run(run())
+        self.addCleanup(lambda: asyncio.run(tools.close()))
+        return result, events, tools
+
+    def test_streams_each_stream_as_tool_output(self):
+        result, events, _ = self.bash("echo first; sleep 0.2; echo second >&2; echo third")
+        streamed = {"stdout": "", "stderr": ""}
+        for event in events:
+            self.assertEqual((event["type"], event["tool"]), ("tool_output", "bash"))
+            streamed[event["stream"]] += event["content"]
+        self.assertEqual(streamed, {"stdout": "first\nthird\n", "stderr": "second\n"})
+        self.assertEqual((result["stdout"], result["stderr"]), ("first\nthird\n", "second\n"))
+        self.assertEqual(result["returncode"], 0)
+
+    def test_output_events_arrive_before_the_command_ends(self):
+        arrived = []
+
+        async def run():
+            tools = dedalus_runner.LocalTools()
+            dedalus_runner._sink.set(lambda event: arrived.append(time.monotonic()))
+            try:
+                started = time.monotonic()
+                await tools.bash("echo early; sleep 0.5")
+                return started, time.monotonic()
+            finally:
+                await tools.close()
+
+        started, ended = asyncio.run(run())
+        self.assertLess(arrived[0] - started, ended - started - 0.3)
+
+
+class OutputCaptureTest(unittest.TestCase):
+    def test_keeps_short_output_whole(self):
+        capture = dedalus_runner.OutputCapture(100, 10)
+        capture.write("one\n")
+        capture.write("two\n")
+        self.assertEqual(capture.finish(), ("one\ntwo\n", None))
+
+    def test_cuts_long_output_to_head_and_tail_and_spills_it(self):
+        capture = dedalus_runner.OutputCapture(1000, 10)
+        lines = [f"line {number}\n" for number in range(100)]
+        for line in lines:
+            capture.write(line)
+        text, spill_path = capture.finish()
+        self.addCleanup(os.unlink, spill_path)
+
+        self.assertTrue(text.startswith("".join(lines[:5]) + "\n... ["))
+        self.assertTrue(text.endswith("] ...\n" + "".join(lines[-5:])))
+        self.assertIn(f"of {len(''.join(lines))}, 100 lines]", text)
+        with open(spill_path) as f:
+            self.assertEqual(f.read(), "".join(lines))
+
+    def test_long_output_is_readable_by_handle(self):
+        result, _, tools = BashTest.bash(self, "seq 1 20000", max_output_bytes=2048, max_output_lines=40)
+        self.assertTrue(result["stdout_truncated"])
+        self.assertTrue(result["stdout"].startswith("1\n2\n"))
+        self.assertTrue(result["stdout"].endswith("19999\n20000\n"))
+
+        handle = result["stdout_handle"]
+        expected = "".join(f"{number}\n" for number in range(1, 20001))
+        first = tools.read_output(handle, 0, 2048)
+        self.assertEqual(first["content"], expected[:2048])
+        self.assertEqual(first["total_bytes"], len(expected))
+        self.assertFalse(first["eof"])
+        last = tools.read_output(handle, len(expected) - 6)
+        self.assertEqual((last["content"], last["eof"]), ("20000\n", True))
+        self.assertFalse(tools.read_output("out-nope")["success"])
+
+        path, _ = tools.outputs[handle]
+        asyncio.run(tools.close())
+        self.assertFalse(os.path.exists(path))
+
+
+class ConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = dedalus_runner.ConversationStore(os.path.join(tmp.name, "conversations.sqlite"))
+        self.addCleanup(self.store.db.close)
+
+    def test_sends_the_whole_chat_while_it_fits(self):
+        self.store.record("s", "hello", "hi there", [])
+        self.store.record("other", "unrelated", "yes", [])
+        messages, stats = self.store.window("s", "and now?", 1000)
+        self.assertEqual(messages, [
+            {"role": "user", "content": "hello"},
+            {"role": "assistant", "content": "hi there"},
+            {"role": "user", "content": "and now?"},
+        ])
+        self.assertEqual((stats["turns_sent"], stats["turns_compacted"]), (2, 0))
+
+    def test_compacts_the_oldest_turns_into_a_summary(self):
+        for number in range(10):
+            self.store.record("s", f"question {number} " + "x" * 80, f"answer {number} " + "y" * 80, [])
+        messages, stats = self.store.window("s", "next", 200)
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertIn("summary of the earlier conversation", messages[0]["content"])
+        self.assertEqual(messages[-1], {"role": "user", "content": "next"})
+        self.assertEqual(stats["turns_sent"] + stats["turns_compacted"], 20)
+        self.assertGreater(stats["turns_compacted"], 0)
+        self.assertLessEqual(stats["tokens_sent"], 200)
+        # the newest turns go out verbatim
+        self.assertTrue(messages[-2]["content"].startswith("answer 9 "))
+
+        # compacted turns stay compacted
+        _, again = self.store.window("s", "next", 200)
+        self.assertEqual(again["turns_compacted"], 0)
+        self.assertEqual(again["turns_sent"], stats["turns_sent"])
+
+    def test_large_tool_results_are_stored_by_reference(self):
+        output = "first line\n" + "z" * 5000
+        self.store.record("s", "run it", "done", [("bash", "ok"), ("read_file", output)])
+        messages, _ = self.store.window("s", "next", 10000)
+        answer = messages[1]["content"]
+        self.assertTrue(answer.startswith("[bash -> ok]\n[read_file -> 5011 bytes stored as "))
+        self.assertTrue(answer.endswith("\ndone"))
+
+        ref = answer.split("stored as ", 1)[1].split(",", 1)[0]
+        recalled = self.store.recall(ref, offset=5000, length=100)
+        self.assertEqual(recalled["content"], output[5000:])
+        self.assertEqual((recalled["tool"], recalled["total_chars"], recalled["eof"]), ("read_file", 5011, True))
+        self.assertFalse(self.store.recall("nope")["success"])
+
+    def test_forgets_idle_sessions(self):
+        self.store.record("old", "hello", "hi", [])
+        with mock.patch.object(dedalus_runner.time, "time", return_value=time.time() + 31 * 24 * 3600):
+            self.store._prune()
+        messages, _ = self.store.window("old", "again", 1000)
+        self.assertEqual(messages, [{"role": "user", "content": "again"}])
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = dedalus_runner.ResponseCache(os.path.join(tmp.name, "responses.sqlite"), max_bytes=10)
+        self.addCleanup(self.cache.db.close)
+        self.now = 1000.0
+        clock = mock.patch.object(dedalus_runner.time, "time", lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_key_covers_what_decides_the_response(self):
+        def read_file(file_path: str):
+            """read a file"""
+
+        key = dedalus_runner.ResponseCache.key
+        base = key("m", {"input": "hello  world\n", "tools": [read_file]}, ["a", "b"])
+        self.assertEqual(base, key("m", {"input": "hello world", "tools": [read_file]}, ["b", "a"]))
+        for other in (
+            key("n", {"input": "hello world", "tools": [read_file]}, ["a", "b"]),
+            key("m", {"input": "hello there", "tools": [read_file]}, ["a", "b"]),
+            key("m", {"input": "hello world", "tools": []}, ["a", "b"]),
+            key("m", {"input": "hello world", "tools": [read_file]}, ["a"]),
+            key("m", {"messages": [{"role": "user", "content": "hello world"}], "tools": [read_file]}, ["a", "b"]),
+        ):
+            self.assertNotEqual(other, base)
+
+    def test_entries_expire_after_their_ttl(self):
+        self.cache.put("k", "reply")
+        self.now += 59
+        self.assertEqual(self.cache.get("k", ttl=60), "reply")
+        self.now += 2
+        self.assertIsNone(self.cache.get("k", ttl=60))
+        # an expired row is gone, whatever the next ttl
+        self.assertIsNone(self.cache.get("k", ttl=3600))
+
+    def test_evicts_least_recently_used_past_max_bytes(self):
+        for key in ("a", "b", "c"):
+            self.cache.put(key, "xxx")
+            self.now += 1
+        self.assertEqual(self.cache.get("a", ttl=60), "xxx")
+        self.now += 1
+        self.cache.put("d", "xxx")
+        self.assertIsNone(self.cache.get("b", ttl=60))
+        for key in ("a", "c", "d"):
+            self.assertEqual(self.cache.get(key, ttl=60), "xxx")
+        # too big to keep at all
+        self.cache.put("e", "x" * 11)
+        self.assertIsNone(self.cache.get("e", ttl=60))
+
+
+class FakeClient:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class APIConnectionError(Exception):
+    """named like the sdk's, which the pool recognizes by name"""
+
+
+class ClientPoolTest(unittest.TestCase):
+    def setUp(self):
+        for patch in (
+            mock.patch.object(dedalus_runner.DedalusClientPool, "_new_client", lambda pool: FakeClient()),
+            mock.patch.object(dedalus_runner, "DedalusRunner", lambda client: ("runner", client)),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_reuses_one_client_between_runs(self):
+        async def run():
+            pool = dedalus_runner.DedalusClientPool("key")
+            first, runner = pool.acquire()
+            await pool.release(first)
+            second, _ = pool.acquire()
+            await pool.release(second, ValueError("the api said no"))
+            third, _ = pool.acquire()
+            await pool.release(third)
+            await pool.close()
+            return pool, first, second, third, runner
+
+        pool, first, second, third, runner = asyncio.run(run())
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+        self.assertEqual(runner, ("runner", first))
+        self.assertTrue(first.closed)
+        self.assertEqual(pool.stats(), {"clients_created": 1, "reconnects": 0, "idle_closes": 0})
+
+    def test_a_connection_failure_retires_the_client_after_its_runs(self):
+        async def run():
+            pool = dedalus_runner.DedalusClientPool("key")
+            broken, _ = pool.acquire()
+            sharing, _ = pool.acquire()
+            await pool.release(broken, APIConnectionError("reset by peer"))
+            # still in use by the other run
+            closed_early = broken.closed
+            fresh, _ = pool.acquire()
+            await pool.release(sharing)
+            await pool.release(fresh)
+            return pool, broken, fresh, closed_early
+
+        pool, broken, fresh, closed_early = asyncio.run(run())
+        self.assertFalse(closed_early)
+        self.assertTrue(broken.closed)
+        self.assertIsNot(fresh, broken)
+        self.assertFalse(fresh.closed)
+        self.assertEqual(pool.stats()["reconnects"], 1)
+
+    def test_closes_the_client_once_idle(self):
+        async def run():
+            pool = dedalus_runner.DedalusClientPool("key", idle_timeout=0.05)
+            client, _ = pool.acquire()
+            await pool.release(client)
+            await asyncio.sleep(0.2)
+            again, _ = pool.acquire()
+            await pool.release(again)
+            await pool.close()
+            return pool, client, again
+
+        pool, client, again = asyncio.run(run())
+        self.assertTrue(client.closed)
+        self.assertIsNot(again, client)
+        self.assertEqual(pool.stats(), {"clients_created": 2, "reconnects": 0, "idle_closes": 1})
+
+
+class CachedReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.runner = dedalus_runner.DedalusStreamRunner(api_key="test")
+        self.runner.responses = dedalus_runner.ResponseCache(os.path.join(self.tmp.name, "responses.sqlite"))
+        self.events = []
+
+    def run_cached(self, content, **options):
+        run_input = {"input": "hello", "tools": []}
+        key = dedalus_runner.ResponseCache.key("openai/gpt-4o-mini", run_input, [])
+        self.runner.responses.put(key, content)
+
+        async def run():
+            dedalus_runner._sink.set(self.events.append)
+            try:
+                return await self.runner.run_streaming(
+                    "hello", use_local_tools=False, cache_ttl=60, **options
+                )
+            finally:
+                await self.runner.close()
+
+        return asyncio.run(run())
+
+    def test_replays_cache_with_coalescing_off(self):
+        content = "cached reply " * 1000
+        self.assertTrue(self.run_cached(content, coalesce_bytes=0))
+
+        chunks = [event["content"] for event in self.events if event["type"] == "chunk"]
+        self.assertEqual("".join(chunks), content)
+        self.assertGreater(len(chunks), 1)
+        complete = self.events[-1]
+        self.assertEqual(complete["type"], "complete")
+        self.assertTrue(complete["cached"])
+
+    def test_replays_cache_in_coalesce_sized_chunks(self):
+        content = "x" * 10000
+        self.assertTrue(self.run_cached(content, coalesce_bytes=4096))
+
+        chunks = [event["content"] for event in self.events if event["type"] == "chunk"]
+        self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 1808])
+
+
+class ChunkCoalescerTest(unittest.TestCase):
+    def coalesce(self, script, **options):
+        """run script(coalescer) with the coalescer bound, returning the events"""
+        events = []
+
+        async def run():
+            dedalus_runner._sink.set(events.append)
+            coalescer = dedalus_runner.ChunkCoalescer(**options)
+            dedalus_runner._coalescer.set(coalescer)
+            await script(coalescer)
+            coalescer.flush()
+            return coalescer.stats()
+
+        return asyncio.run(run()), events
+
+    def test_flushes_at_max_bytes(self):
+        async def script(coalescer):
+            for _ in range(10):
+                coalescer.add("abc")
+
+        stats, events = self.coalesce(script, max_bytes=8, max_latency=60)
+        self.assertEqual([event["content"] for event in events], ["abcabcabc"] * 3 + ["abc"])
+        self.assertEqual(stats, {"chunks": 10, "flushes": 4, "bytes": 30, "largest_flush": 9})
+
+    def test_flushes_after_max_latency(self):
+        async def script(coalescer):
+            coalescer.add("a")
+            coalescer.add("b")
+            await asyncio.sleep(0.05)
+            coalescer.add("c")
+
+        _, events = self.coalesce(script, max_bytes=4096, max_latency=0.01)
+        self.assertEqual([event["content"] for event in events], ["ab", "c"])
+
+    def test_other_events_never_overtake_buffered_text(self):
+        async def script(coalescer):
+            coalescer.add("before ")
+            dedalus_runner.emit({"type": "tool_output", "content": "tool"})
+            coalescer.add("after")
+
+        _, events = self.coalesce(script, max_bytes=4096, max_latency=60)
+        self.assertEqual([(event["type"], event["content"]) for event in events], [
+            ("chunk", "before "), ("tool_output", "tool"), ("chunk", "after"),
+        ])
+
+    def test_zero_bytes_emits_every_chunk(self):
+        async def script(coalescer):
+            for chunk in ("a", "b", "c"):
+                coalescer.add(chunk)
+
+        _, events = self.coalesce(script, max_bytes=0)
+        self.assertEqual([event["content"] for event in events], ["a", "b", "c"])
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name) / "tree"
+        self.root.mkdir()
+        # the index lives under the cache dir
+        cache = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(tmp.name, "cache")})
+        cache.start()
+        self.addCleanup(cache.stop)
+        self.addCleanup(dedalus_runner.TrigramIndex._open.clear)
+
+    def search(self, query, **options):
+        tools = dedalus_runner.LocalTools()
+        return asyncio.run(tools.search(query, directory=str(self.root), **options))
+
+    def test_finds_matches_in_files_too_large_to_index(self):
+        size = dedalus_runner.TrigramIndex.MAX_FILE_BYTES
+        filler = b"filler line\n" * (size // 12 + 1)
+        (self.root / "large.log").write_bytes(filler + b"needle here\n" + filler)
+        (self.root / "small.txt").write_text("no match\nneedle too\n")
+        (self.root / "other.txt").write_text("nothing to see\n")
+
+        result = self.search("needle")
+        self.assertTrue(result["success"])
+        self.assertEqual(sorted(hit["path"] for hit in result["matches"]), ["large.log", "small.txt"])
+        large = next(hit for hit in result["matches"] if hit["path"] == "large.log")
+        self.assertEqual(large["line"], filler.count(b"\n") + 1)
+        self.assertEqual(large["text"], "needle here")
+        self.assertEqual(result["skipped_files"], 0)
+
+    def test_skips_large_binary_files(self):
+        size = dedalus_runner.TrigramIndex.MAX_FILE_BYTES
+        (self.root / "large.bin").write_bytes(b"\0needle" * (size // 7 + 1))
+
+        result = self.search("needle")
+        self.assertEqual(result["matches"], [])
+        self.assertEqual(result["skipped_files"], 1)
+
+
+class ReadFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        self.tools = dedalus_runner.LocalTools()
+
+    def test_tail_of_a_large_file_reads_only_the_tail(self):
+        path = self.dir / "large.log"
+        lines = [f"line {number}\n" for number in range(200000)]
+        path.write_text("".join(lines))
+        size = path.stat().st_size
+        self.assertGreaterEqual(size, dedalus_runner.MMAP_THRESHOLD)
+
+        with mock.patch.object(dedalus_runner, "LineIndex", side_effect=AssertionError("indexed")):
+            result = self.tools.read_file(str(path), offset=-3)
+        self.assertTrue(result["success"])
+        self.assertEqual(result["content"], "".join(lines[-3:]))
+        self.assertIsNone(result["total_lines"])
+        self.assertIsNone(result["offset"])
+        self.assertEqual(result["byte_offset"], size - len("".join(lines[-3:])))
+        self.assertTrue(result["eof"])
+
+        # the byte offset pages back through the same file
+        before = self.tools.read_file(str(path), offset=result["byte_offset"] - 24, limit=24, unit="bytes")
+        self.assertEqual(before["content"], "".join(lines[-5:-3]))
+
+    def test_tail_of_an_indexed_large_file_reports_line_numbers(self):
+        path = self.dir / "large.log"
+        lines = [f"line {number}\n" for number in range(200000)]
+        path.write_text("".join(lines))
+        # a read by line indexes the file
+        self.tools.read_file(str(path), offset=0, limit=1)
+
+        result = self.tools.read_file(str(path), offset=-3)
+        self.assertEqual(result["content"], "".join(lines[-3:]))
+        self.assertEqual((result["offset"], result["total_lines"], result["next_offset"]), (199997, 200000, 200000))
+        self.assertNotIn("byte_offset", result)
+
+    def test_tail_of_an_unterminated_file(self):
+        path = self.dir / "small.txt"
+        path.write_text("a\nb\nc")
+
+        result = self.tools.read_file(str(path), offset=-2)
+        self.assertEqual(result["content"], "b\nc")
+        self.assertEqual((result["offset"], result["total_lines"]), (1, 3))
+
+        result = self.tools.read_file(str(path), offset=-10)
+        self.assertEqual(result["content"], "a\nb\nc")
+        self.assertEqual(result["offset"], 0)
+
+
+class EditFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+        self.path = self.dir / "notes.txt"
+        self.tools = dedalus_runner.LocalTools()
+
+    def test_edits_apply_in_one_pass_over_the_original(self):
+        self.path.write_text("red green red blue\n")
+        os.chmod(self.path, 0o640)
+        result = self.tools.edit_file(str(self.path), edits=[
+            {"old": "red", "new": "green", "expected_count": 2},
+            {"old": "green", "new": "red"},
+        ])
+        self.assertTrue(result["success"], result)
+        self.assertEqual(result["counts"], [2, 1])
+        # swapped, not chained
+        self.assertEqual(self.path.read_text(), "green red green blue\n")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+
+    def test_a_failed_edit_writes_nothing(self):
+        self.path.write_text("one two one\n")
+        result = self.tools.edit_file(str(self.path), edits=[
+            {"old": "one", "new": "1", "expected_count": 1},
+            {"old": "two", "new": "2"},
+        ])
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "edit 0: expected 1 occurrence(s), found 2")
+        self.assertEqual(self.path.read_text(), "one two one\n")
+        self.assertEqual(os.listdir(self.dir), ["notes.txt"])
+
+        result = self.tools.edit_file(str(self.path), "three", "3")
+        self.assertEqual(result["error"], "old content not found in file")
+        for edits, error in (
+            ([], "no edits given"),
+            ([{"old": "", "new": "x"}], "old content must not be empty"),
+            ([{"old": "one", "new": "1"}, {"old": "one", "new": "i"}], "each edit needs a distinct old content"),
+        ):
+            self.assertEqual(self.tools.edit_file(str(self.path), edits=edits)["error"], error)
+
+    def test_matches_across_chunk_boundaries(self):
+        text = "".join(f"line {number} needle\n" for number in range(500))
+        self.path.write_text(text)
+        with mock.patch.object(dedalus_runner, "EDIT_CHUNK", 7):
+            result = self.tools.edit_file(str(self.path), edits=[
+                {"old": "needle", "new": "pin"},
+                {"old": "needle\nline", "new": "NL"},
+            ])
+        self.assertTrue(result["success"], result)
+        # the longer old content wins where both match
+        self.assertEqual(result["counts"], [1, 499])
+        self.assertEqual(self.path.read_text(), text.replace("needle\nline", "NL").replace("needle", "pin"))
+
+    def test_a_cached_read_sees_the_edit(self):
+        self.path.write_text("before\n")
+        self.assertEqual(self.tools.read_file(str(self.path))["content"], "before\n")
+        self.tools.edit_file(str(self.path), "before", "after")
+        self.assertEqual(self.tools.read_file(str(self.path))["content"], "after\n")
+
+
+class ListDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.checkout = Path(tmp.name)
+        (self.checkout / ".git").mkdir()
+        (self.checkout / ".gitignore").write_text("*.log\n!keep.log\nbuild/\n")
+        self.root = self.checkout / "project"
+        for name, content in {
+            "a.py": "a",
+            "debug.log": "",
+            "keep.log": "",
+            "build/out.bin": "",
+            "src/build": "a file, not the ignored directory",
+            "src/main.py": "main",
+            "src/.gitignore": "/generated.py\n",
+            "src/generated.py": "",
+            "src/deep/generated.py": "",
+        }.items():
+            path = self.root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+        self.tools = dedalus_runner.LocalTools()
+
+    def paths(self, **options):
+        result = self.tools.list_directory(str(self.root), **options)
+        self.assertTrue(result["success"], result)
+        return [item["path"] for item in result["items"]]
+
+    def test_lists_one_level_by_default(self):
+        result = self.tools.list_directory(str(self.root))
+        self.assertEqual(result["items"], [
+            {"name": "a.py", "path": "a.py", "type": "file", "size": 1},
+            {"name": "keep.log", "path": "keep.log", "type": "file", "size": 0},
+            {"name": "src", "path": "src", "type": "directory", "size": None},
+        ])
+
+    def test_honors_gitignores_above_and_below(self):
+        self.assertEqual(self.paths(max_depth=0), [
+            "a.py", "keep.log", "src", "src/.gitignore", "src/build",
+            "src/deep", "src/deep/generated.py", "src/main.py",
+        ])
+        self.assertIn("build/out.bin", self.paths(max_depth=0, respect_gitignore=False))
+
+    def test_filters_and_pages(self):
+        self.assertEqual(self.paths(max_depth=0, include=["*.py"]), [
+            "a.py", "src", "src/deep", "src/deep/generated.py", "src/main.py",
+        ])
+        self.assertEqual(self.paths(max_depth=0, exclude=["deep"]), [
+            "a.py", "keep.log", "src", "src/.gitignore", "src/build", "src/main.py",
+        ])
+
+        pages, cursor = [], None
+        while True:
+            result = self.tools.list_directory(str(self.root), max_depth=0, limit=3, cursor=cursor)
+            pages.append([item["path"] for item in result["items"]])
+            cursor = result.get("next_cursor")
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), self.paths(max_depth=0))
+
+    def test_tree_format(self):
+        result = self.tools.list_directory(str(self.root / "src"), max_depth=2, format="tree")
+        self.assertEqual(result["tree"], ".gitignore\nbuild\ndeep/\n  generated.py\nmain.py")
+        self.assertEqual(result["count"], 5)
+
+    def test_sees_new_files_through_the_cache(self):
+        self.assertEqual(self.paths(), ["a.py", "keep.log", "src"])
+        (self.root / "b.py").write_text("bb")
+        (self.root / "a.py").write_text("aaa")
+        result = self.tools.list_directory(str(self.root))
+        self.assertEqual([(item["path"], item["size"]) for item in result["items"]], [
+            ("a.py", 3), ("b.py", 2), ("keep.log", 0), ("src", None),
+        ])
+
+
+class FileCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used_to_fit(self):
+        cache = dedalus_runner.FileCache(100)
+        key = (1, 10, 1)
+        cache.put("text", "/a", key, "a", 40)
+        cache.put("text", "/b", key, "b", 40)
+        self.assertEqual(cache.get("text", "/a", key), "a")
+        cache.put("text", "/c", key, "c", 40)
+        self.assertIsNone(cache.get("text", "/b", key))
+        self.assertEqual(cache.get("text", "/a", key), "a")
+        # too big to cache at all
+        cache.put("text", "/d", key, "d", 101)
+        self.assertIsNone(cache.get("text", "/d", key))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.size, 80)
+
+    def test_serves_only_entries_of_an_unchanged_file(self):
+        cache = dedalus_runner.FileCache(100)
+        cache.put("text", "/a", (1, 10, 1), "old", 10)
+        cache.put("lines", "/a", (1, 10, 1), "index", 10)
+        self.assertIsNone(cache.get("text", "/a", (2, 10, 1)))
+        cache.invalidate("/a")
+        self.assertIsNone(cache.get("lines", "/a", (1, 10, 1)))
+        self.assertEqual((cache.size, cache.hits, cache.misses), (0, 0, 2))
+
+    def test_tools_share_the_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.txt")
+            tools = dedalus_runner.LocalTools()
+            tools.write_file(path, "one\n")
+            self.assertEqual(tools.read_file(path)["content"], "one\n")
+            misses = tools.cache_stats()["misses"]
+            for _ in range(2):
+                self.assertEqual(tools.read_file(path)["content"], "one\n")
+            self.assertEqual(tools.cache_stats()["misses"], misses)
+            self.assertGreater(tools.cache_stats()["hits"], 0)
+
+            tools.write_file(path, "two\n")
+            self.assertEqual(tools.read_file(path)["content"], "two\n")
+            # changed behind the tools' back: the stat no longer matches
+            with open(path, "a") as f:
+                f.write("three\n")
+            self.assertEqual(tools.read_file(path)["content"], "two\nthree\n")
+
+
+class ServeTest(unittest.TestCase):
+    def serve(self, messages, run_config=None):
+        """feed messages to _serve_requests, return the events it emitted"""
+        events = []
+        queue = list(messages) + [None]
+
+        async def read_message():
+            return queue.pop(0)
+
+        async def default_run_config(runner, config):
+            dedalus_runner.emit({"type": "complete", "status": "success", "input": config.get("input")})
+            return True
+
+        with mock.patch.object(dedalus_runner, "run_config", run_config or default_run_config):
+            asyncio.run(dedalus_runner._serve_requests(None, read_message, events.append))
+        return events
+
+    def test_runs_requests_tagged_with_their_id(self):
+        events = self.serve([b'{"id": "a", "input": "one"}', b"", b'{"id": 2, "input": "two"}'])
+        self.assertEqual(
+            sorted((event["id"], event["input"]) for event in events),
+            [("2", "two"), ("a", "one")]
+        )
+
+    def test_survives_requests_that_are_not_objects(self):
+        events = self.serve([b"[1, 2]", b'"x"', b"3", b"not json", b'{"id": "a", "input": "one"}'])
+        errors = [event for event in events if event["type"] == "error"]
+        self.assertEqual(len(errors), 4)
+        self.assertIn("expected a json object, got list", errors[0]["error"])
+        self.assertEqual(events[-1], {"id": "a", "type": "complete", "status": "success", "input": "one"})
+
+    def test_cancel_ends_only_the_named_request(self):
+        started = {}
+
+        async def run_config(runner, config):
+            started[config["id"]].set()
+            try:
+                await asyncio.sleep(config.get("seconds", 0))
+            except asyncio.CancelledError:
+                dedalus_runner.emit({"type": "cancelled"})
+                raise
+            dedalus_runner.emit({"type": "complete", "status": "success"})
+            return True
+
+        async def run():
+            events = []
+            started.update(slow=asyncio.Event(), quick=asyncio.Event())
+            messages = [
+                b'{"id": "slow", "input": "x", "seconds": 30}',
+                b'{"id": "quick", "input": "x"}',
+                started["slow"].wait,
+                b'{"type": "cancel", "id": "slow"}',
+                b'{"type": "cancel", "id": "gone"}',
+            ]
+
+            async def read_message():
+                if not messages:
+                    return None
+                message = messages.pop(0)
+                return message if isinstance(message, bytes) else await message() and b""
+
+            with mock.patch.object(dedalus_runner, "run_config", run_config):
+                await asyncio.wait_for(dedalus_runner._serve_requests(None, read_message, events.append), 10)
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual(sorted((event["id"], event["type"]) for event in events), [
+            ("gone", "error"), ("quick", "complete"), ("slow", "cancelled")
+        ])
+        error, = [event["error"] for event in events if event["type"] == "error"]
+        self.assertIn("no running request with id 'gone'", error)
+
+    def test_reports_requests_without_input(self):
+        events = self.serve([b'{"id": "a"}'], run_config=dedalus_runner.run_config)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["id"], "a")
+        self.assertIn("bad request: KeyError('input')", events[0]["error"])
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.source = os.path.join(tmp.name, "requests")
+        self.out = io.BytesIO()
+        writer = mock.patch.object(dedalus_runner, "_stdout", dedalus_runner.runner_protocol.JsonlWriter(self.out))
+        writer.start()
+        self.addCleanup(writer.stop)
+
+    def run_batch(self, run_config, **options):
+        with mock.patch.object(dedalus_runner, "run_config", run_config):
+            ok = asyncio.run(dedalus_runner.run_batch(None, self.source, **options))
+        return ok, [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+    def test_reads_framed_requests(self):
+        requests = [{"id": "a", "input": "first"}, {"id": "b", "input": "second"}]
+        with open(self.source, "wb") as f:
+            for request in requests:
+                f.write(dedalus_runner.runner_protocol.encode_frame(request))
+
+        async def run_config(runner, config):
+            dedalus_runner.emit({"type": "complete", "status": "success", "input": config["input"]})
+            return True
+
+        ok, events = self.run_batch(run_config, framed=True)
+        self.assertTrue(ok)
+        results = sorted((event["id"], event["line"], event["input"]) for event in events[:-1])
+        self.assertEqual(results, [("a", 1, "first"), ("b", 2, "second")])
+        self.assertEqual(events[-1]["type"], "batch_complete")
+        self.assertEqual(events[-1]["succeeded"], 2)
+
+    def test_negative_max_retries_runs_once(self):
+        with open(self.source, "w") as f:
+            f.write('{"id": "a", "input": "hello"}\n')
+        calls = []
+
+        async def run_config(runner, config):
+            calls.append(config)
+            dedalus_runner.emit({"type": "error", "error": "rate limit exceeded (429)"})
+            return False
+
+        ok, events = self.run_batch(run_config, max_retries=-1)
+        self.assertFalse(ok)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(events[-1]["failed"], 1)
+
+    def test_counts_lines_that_are_not_objects_as_failed(self):
+        with open(self.source, "w") as f:
+            f.write('"str"\n[1]\n{"id": "a", "input": "hello"}\n')
+
+        async def run_config(runner, config):
+            dedalus_runner.emit({"type": "complete", "status": "success"})
+            return True
+
+        ok, events = self.run_batch(run_config)
+        self.assertFalse(ok)
+        errors = [(event["line"], event["error"]) for event in events if event["type"] == "error"]
+        self.assertEqual(errors, [
+            (1, "invalid request: expected a json object, got str"),
+            (2, "invalid request: expected a json object, got list"),
+        ])
+        self.assertEqual((events[-1]["succeeded"], events[-1]["failed"]), (1, 2))
+
+
+    def test_checkpoint_resumes_where_a_run_stopped(self):
+        checkpoint = self.source + ".done"
+        with open(self.source, "w") as f:
+            f.write('{"id": "a", "input": "ok"}\n{"input": "fails"}\n{"id": "c", "input": "ok"}\n')
+        calls = []
+        failing = {"fails"}
+
+        async def run_config(runner, config):
+            calls.append(config.get("id", config["input"]))
+            if config["input"] in failing:
+                dedalus_runner.emit({"type": "error", "error": "model said no"})
+                return False
+            dedalus_runner.emit({"type": "complete", "status": "success"})
+            return True
+
+        ok, events = self.run_batch(run_config, checkpoint=checkpoint, concurrency=1)
+        self.assertFalse(ok)
+        with open(checkpoint) as f:
+            self.assertEqual(f.read().split(), ["a", "c"])
+
+        failing.clear()
+        calls.clear()
+        self.out.seek(0)
+        self.out.truncate()
+        ok, events = self.run_batch(run_config, checkpoint=checkpoint)
+        self.assertTrue(ok)
+        self.assertEqual(calls, ["fails"])
+        # the line number stands in for a missing id
+        self.assertEqual((events[0]["id"], events[0]["line"]), ("2", 2))
+        self.assertEqual((events[-1]["succeeded"], events[-1]["skipped"]), (1, 2))
+        with open(checkpoint) as f:
+            self.assertEqual(f.read().split(), ["a", "c", "2"])
+
+    def test_retries_rate_limited_requests(self):
+        with open(self.source, "w") as f:
+            f.write('{"id": "a", "input": "hello"}\n')
+        attempts = []
+        backoffs = []
+
+        async def run_config(runner, config):
+            attempts.append(config)
+            if len(attempts) < 3:
+                dedalus_runner.emit({"type": "error", "error": "Error code: 429 - slow down", "status_code": 429})
+                return False
+            dedalus_runner.emit({"type": "complete", "status": "success"})
+            return True
+
+        with mock.patch.object(dedalus_runner.RatePacer, "backoff", lambda pacer, delay: backoffs.append(delay)):
+            ok, events = self.run_batch(run_config)
+        self.assertTrue(ok)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(backoffs), 2)
+        self.assertTrue(0.5 <= backoffs[0] <= 1.5 and 1 <= backoffs[1] <= 3, backoffs)
+        # only the attempt that counted is reported
+        self.assertEqual([event["type"] for event in events], ["complete", "batch_complete"])
+
+
+class RatePacerTest(unittest.TestCase):
+    def test_spaces_starts_and_backs_off(self):
+        async def run():
+            pacer = dedalus_runner.RatePacer(20)
+            started = time.monotonic()
+            for _ in range(5):
+                await pacer.wait()
+            spaced = time.monotonic() - started
+
+            pacer.backoff(0.3)
+            halved = pacer.rate
+            started = time.monotonic()
+            await pacer.wait()
+            paused = time.monotonic() - started
+            for _ in range(3):
+                pacer.backoff(0)
+            floor = pacer.rate
+            for _ in range(100):
+                pacer.recover()
+            return spaced, halved, paused, floor, pacer.rate
+
+        spaced, halved, paused, floor, recovered = asyncio.run(run())
+        self.assertGreaterEqual(spaced, 0.19)
+        self.assertEqual((halved, floor, recovered), (10, 2, 20))
+        self.assertGreaterEqual(paused, 0.25)
+
+    def test_without_a_rate_only_pauses(self):
+        async def run():
+            pacer = dedalus_runner.RatePacer(None)
+            started = time.monotonic()
+            for _ in range(50):
+                await pacer.wait()
+            return time.monotonic() - started, pacer.rate
+
+        elapsed, rate = asyncio.run(run())
+        self.assertLess(elapsed, 0.1)
+        self.assertIsNone(rate)
+
+
+class OneShotTest(unittest.TestCase):
+    def test_framed_without_a_request_frame(self):
+        process = subprocess.run(
+            [sys.executable, str(SERVER / "dedalus-runner.py"), "--framed"],
+            input=b"", capture_output=True, timeout=60,
+            env={**os.environ, "DEDALUS_API_KEY": "test"}
+        )
+        self.assertEqual(process.returncode, 1)
+        output = process.stdout
+        self.assertEqual(
+            dedalus_runner.runner_protocol.decode_frame(output[4:]),
+            {"type": "error", "error": "no request frame on stdin"}
+        )
+
+
+class ToolDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = dedalus_runner.ToolDispatcher()
+        self.addCleanup(self.dispatcher.close)
+
+    def test_write_without_a_path_reaches_the_tool(self):
+        def write_file(file_path: str, content: str):
+            return {"success": True}
+
+        with self.assertRaisesRegex(TypeError, "file_path"):
+            asyncio.run(self.dispatcher.call(write_file, content="x"))
+        self.assertEqual(self.dispatcher.path_locks, {})
+
+    def test_writes_to_one_path_are_serialized(self):
+        active = []
+        overlapped = []
+
+        async def write_file(file_path: str, content: str):
+            active.append(file_path)
+            overlapped.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(file_path)
+            return {"success": True}
+
+        async def run():
+            wrapped = self.dispatcher.wrap(write_file)
+            await asyncio.gather(
+                wrapped("/tmp/a", "1"), wrapped(file_path="/tmp/a", content="2"), wrapped("/tmp/b", "3")
+            )
+
+        asyncio.run(run())
+        # a and b overlap, the two writes to a never do
+        self.assertEqual(max(overlapped), 2)
+        self.assertEqual(self.dispatcher.path_locks, {})
+
+    def test_blocking_tools_run_off_the_loop(self):
+        def read_file(file_path: str):
+            time.sleep(0.2)
+            return {"success": True, "path": file_path}
+
+        async def run():
+            wrapped = self.dispatcher.wrap(read_file)
+            started = time.monotonic()
+            results = await asyncio.gather(*(wrapped(f"/tmp/{n}") for n in range(4)))
+            return results, time.monotonic() - started
+
+        results, seconds = asyncio.run(run())
+        self.assertEqual([result["path"] for result in results], [f"/tmp/{n}" for n in range(4)])
+        self.assertLess(seconds, 0.6)
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_status_code(self):
+        self.assertTrue(dedalus_runner._is_rate_limit({"error": "slow down", "status_code": 429}))
+        self.assertFalse(dedalus_runner._is_rate_limit({"error": "bad gateway", "status_code": 502}))
+
+    def test_message(self):
+        for error in ("Error code: 429 - {'detail': 'busy'}", "Rate limit exceeded", "ratelimited", "Too Many Requests"):
+            self.assertTrue(dedalus_runner._is_rate_limit({"error": error}), error)
+        for error in ("no such file: report-4290.txt", "connection refused on port 1429", "read 429 bytes", ""):
+            self.assertFalse(dedalus_runner._is_rate_limit({"error": error}), error)
+
+    def test_error_event_keeps_the_status_code(self):
+        class RateLimitError(Exception):
+            status_code = 429
+
+        self.assertEqual(
+            dedalus_runner._error_event(RateLimitError("busy")),
+            {"type": "error", "error": "busy", "status_code": 429}
+        )
+        self.assertEqual(dedalus_runner._error_event(ValueError("bad")), {"type": "error", "error": "bad"})
+
+
+if __name__ == "__main__":
+    unittest.main()
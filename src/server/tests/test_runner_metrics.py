@@ -0,0 +1,120 @@
+"""
+tests for runner_metrics.py
+
+run from the repo root:
+
+  python -m unittest discover -s src/server/tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import runner_metrics
+
+
+class RegistryTest(unittest.TestCase):
+    def test_renders_prometheus_text(self):
+        registry = runner_metrics.Registry("vibeos_test")
+        registry.set("import_seconds", "sdk import time", 1.25)
+        registry.observe("tool_call_seconds", "one tool call", 0.003, tool="bash")
+        registry.observe("tool_call_seconds", "one tool call", 0.2, tool="bash")
+        registry.observe("tool_call_seconds", "one tool call", 500, tool='say "hi"\n')
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:3], [
+            "# HELP vibeos_test_import_seconds sdk import time",
+            "# TYPE vibeos_test_import_seconds gauge",
+            "vibeos_test_import_seconds 1.25",
+        ])
+        self.assertIn("# TYPE vibeos_test_tool_call_seconds histogram", lines)
+        for line in (
+            'vibeos_test_tool_call_seconds_bucket{tool="bash",le="0.005"} 1',
+            'vibeos_test_tool_call_seconds_bucket{tool="bash",le="0.1"} 1',
+            'vibeos_test_tool_call_seconds_bucket{tool="bash",le="0.25"} 2',
+            'vibeos_test_tool_call_seconds_bucket{tool="bash",le="+Inf"} 2',
+            'vibeos_test_tool_call_seconds_sum{tool="bash"} 0.203',
+            'vibeos_test_tool_call_seconds_count{tool="bash"} 2',
+            'vibeos_test_tool_call_seconds_bucket{tool="say \\"hi\\"\\n",le="300"} 0',
+            'vibeos_test_tool_call_seconds_bucket{tool="say \\"hi\\"\\n",le="+Inf"} 1',
+        ):
+            self.assertIn(line, lines)
+
+    def test_serves_the_registry_over_http(self):
+        registry = runner_metrics.Registry("vibeos_test")
+        registry.set("up", "always one", 1)
+
+        async def scrape(address, connect):
+            server = await runner_metrics.serve_metrics(registry, address)
+            try:
+                reader, writer = await connect(server)
+                writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        async def tcp(server):
+            return await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.sock")
+            for address, connect in ((":0", tcp), (path, lambda server: asyncio.open_unix_connection(path))):
+                with self.subTest(address=address):
+                    response = asyncio.run(scrape(address, connect))
+                    head, body = response.split(b"\r\n\r\n", 1)
+                    self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+                    self.assertIn(b"Content-Type: text/plain; version=0.0.4", head)
+                    self.assertTrue(body.endswith(b"vibeos_test_up 1\n"))
+
+
+class RunMetricsTest(unittest.TestCase):
+    def test_finish_reports_the_run(self):
+        registry = runner_metrics.Registry("vibeos_test")
+        clock = iter([0.0, 0.5, 1.0, 1.5, 2.0])
+        with mock.patch.object(runner_metrics.time, "perf_counter", lambda: next(clock)):
+            metrics = runner_metrics.RunMetrics(registry)
+            metrics.chunk("ab")
+            metrics.chunk("cd")
+            metrics.tool_call("bash", 0.25)
+            metrics.tool_call("bash", 0.5)
+            metrics.block("image")
+            metrics.block("image")
+            metrics.chunk("é")
+            event = metrics.finish("success")
+
+        self.assertEqual(event, {
+            "type": "metrics",
+            "status": "success",
+            "run_seconds": 2.0,
+            "time_to_first_chunk_seconds": 0.5,
+            "chunks": 3,
+            "bytes": 6,
+            "chunks_per_second": 3.0,
+            "bytes_per_second": 6.0,
+            "tools": {"bash": {"calls": 2, "total_seconds": 0.75, "max_seconds": 0.5}},
+            "blocked_requests": 2,
+            "blocked_by_type": {"image": 2},
+        })
+        text = registry.render()
+        self.assertIn('vibeos_test_run_seconds_count{status="success"} 1', text)
+        self.assertIn("vibeos_test_time_to_first_chunk_seconds_count 1", text)
+
+    def test_finish_without_output(self):
+        metrics = runner_metrics.RunMetrics(runner_metrics.Registry("vibeos_test"))
+        metrics.step(1.5)
+        event = metrics.finish("cancelled")
+        self.assertEqual(set(event), {"type", "status", "run_seconds", "steps", "step_seconds"})
+        self.assertEqual((event["steps"], event["step_seconds"]), (1, [1.5]))
+
+
+if __name__ == "__main__":
+    unittest.main()
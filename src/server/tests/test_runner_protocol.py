@@ -0,0 +1,100 @@
+"""
+tests for runner_protocol.py
+
+run from the repo root:
+
+  python -m unittest discover -s src/server/tests
+"""
+
+import asyncio
+import io
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import runner_protocol
+
+
+class FrameTest(unittest.TestCase):
+    def round_trip(self, event):
+        frame = runner_protocol.encode_frame(event)
+        self.assertEqual(int.from_bytes(frame[:4], "big"), len(frame) - 4)
+        self.assertEqual(runner_protocol.decode_frame(frame[4:]), event)
+        return frame[4]
+
+    def test_round_trips_every_kind_of_event(self):
+        for event, tag in (
+            ({"type": "chunk", "content": "héllo\n"}, runner_protocol.CHUNK),
+            ({"id": "r1", "type": "chunk", "content": ""}, runner_protocol.CHUNK),
+            ({"id": "r1", "type": "tool_output", "tool": "bash", "stream": "stderr", "content": "oops"},
+             runner_protocol.TOOL_OUTPUT),
+            ({"id": "r1", "type": "complete", "content": "done", "status": "success"}, runner_protocol.COMPLETE),
+            ({"type": "error", "error": "boom", "status_code": 429}, runner_protocol.ERROR),
+            ({"id": "7", "type": "metrics", "seconds": 1.5}, runner_protocol.EVENT),
+            # extra fields don't fit the compact frames
+            ({"type": "chunk", "content": "x", "extra": 1}, runner_protocol.EVENT),
+            ({"type": "tool_output", "tool": "bash", "stream": "stdin", "content": "x"}, runner_protocol.EVENT),
+        ):
+            with self.subTest(event=event):
+                self.assertEqual(self.round_trip(event), tag)
+
+    def test_rejects_long_request_ids(self):
+        with self.assertRaises(ValueError):
+            runner_protocol.encode_frame({"id": "x" * 256, "type": "chunk", "content": ""})
+
+
+class ReadMessageTest(unittest.TestCase):
+    def test_reads_request_frames_with_their_id(self):
+        stream = io.BytesIO(
+            runner_protocol.encode_frame({"input": "hi"})
+            + runner_protocol.encode_frame({"id": "a", "type": "cancel"})
+        )
+        self.assertEqual(runner_protocol.read_message(stream, framed=True), b'{"input":"hi"}')
+        self.assertEqual(runner_protocol.read_message(stream, framed=True), b'{"id":"a","type":"cancel"}')
+        self.assertIsNone(runner_protocol.read_message(stream, framed=True))
+
+    def test_a_truncated_frame_is_eof(self):
+        frame = runner_protocol.encode_frame({"input": "hi"})
+        for cut in (2, len(frame) - 1):
+            self.assertIsNone(runner_protocol.read_message(io.BytesIO(frame[:cut]), framed=True))
+
+    def test_reads_lines(self):
+        stream = io.BytesIO(b'{"input": "hi"}\n\n')
+        self.assertEqual(runner_protocol.read_message(stream, framed=False), b'{"input": "hi"}')
+        self.assertEqual(runner_protocol.read_message(stream, framed=False), b"")
+        self.assertIsNone(runner_protocol.read_message(stream, framed=False))
+
+    def test_reads_from_an_async_stream(self):
+        async def read_all(data, framed):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            messages = []
+            while (message := await runner_protocol.read_message_async(reader, framed)) is not None:
+                messages.append(message)
+            return messages
+
+        frame = runner_protocol.encode_frame({"id": 3, "input": "hi"})
+        self.assertEqual(asyncio.run(read_all(frame + frame[:5], True)), [b'{"id":"3","input":"hi"}'])
+        self.assertEqual(asyncio.run(read_all(b'{"a": 1}\n{"b": 2}', False)), [b'{"a": 1}', b'{"b": 2}'])
+
+
+class WriterTest(unittest.TestCase):
+    def test_writers_count_what_they_write(self):
+        event = {"type": "chunk", "content": "hi"}
+        for writer_type, expected in (
+            (runner_protocol.JsonlWriter, b'{"type":"chunk","content":"hi"}\n'),
+            (runner_protocol.FramedWriter, runner_protocol.encode_frame(event)),
+        ):
+            out = io.BytesIO()
+            writer = writer_type(out)
+            writer.write_event(event)
+            writer.write_event(event)
+            self.assertEqual(out.getvalue(), expected * 2)
+            self.assertEqual((writer.lines, writer.bytes), (2, 2 * len(expected)))
+
+
+if __name__ == "__main__":
+    unittest.main()